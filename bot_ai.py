@@ -0,0 +1,75 @@
+# bot_ai.py
+
+import random
+
+# A placement through n hits of a ship still afloat counts HIT_WEIGHT ** n times: once something is hit,
+# the cells that can finish it outweigh the whole rest of the board
+HIT_WEIGHT = 50
+
+
+class TargetingEngine:
+    # Hunt / target by probability density. Every placement of a ship still afloat that fits what is known
+    # (no misses, clear of sunk ships, not touching a hit it doesn't cover) adds its weight to its cells,
+    # and the densest cell not yet shot is fired at. placements is FleetGenerator's
+    # {size: [(ship mask, no-touch zone mask, cells)]}; cell (x, y) is bit x * cols + y, as in GameState
+    def __init__(self, rows, cols, placements):
+        self.rows = rows
+        self.cols = cols
+        self.placements = {size: [(mask, zone & ~mask, tuple(x * cols + y for x, y in cells))
+                                  for mask, zone, cells in items]
+                           for size, items in placements.items()}
+        self.zones = {mask: zone for items in placements.values() for mask, zone, _ in items}
+
+    def density(self, hits, blocked, remaining):
+        # hits are those of ships still afloat, blocked the cells known to be water or sunk;
+        # remaining maps ship size to how many of that size are afloat
+        density = [0] * (self.rows * self.cols)
+        for size, count in remaining.items():
+            if not count:
+                continue
+            for mask, ring, cells in self.placements[size]:
+                if mask & blocked or ring & hits:
+                    continue
+                covered = mask & hits
+                weight = count * HIT_WEIGHT ** bin(covered).count('1') if covered else count
+                for cell in cells:
+                    density[cell] += weight
+        return density
+
+    def choose(self, shots, hits, blocked, remaining, rng=random):
+        density = self.density(hits, blocked, remaining)
+        best = 0
+        candidates = []
+        for cell, value in enumerate(density):
+            if value < best or value == 0 or shots >> cell & 1:
+                continue
+            if value > best:
+                best = value
+                candidates = []
+            candidates.append(cell)
+        if not candidates:
+            # Nothing fits what is known (only with inconsistent input): any cell not shot yet
+            candidates = [cell for cell in range(self.rows * self.cols) if not shots >> cell & 1]
+        return divmod(rng.choice(candidates), self.cols)
+
+    def next_shot(self, state, rng=random):
+        # The shot against a GameState, using only what its owner would see: shots, hits, which ships sank
+        # and the sizes of the fleet
+        blocked = state.misses | state.sunk
+        remaining = {}
+        for mask, cells, left in zip(state.ship_masks, state.ship_cells, state.ship_remaining):
+            if left:
+                remaining[len(cells)] = remaining.get(len(cells), 0) + 1
+            else:
+                blocked |= self.zones[mask]
+        return self.choose(state.hits | state.misses, state.hits & ~state.sunk, blocked, remaining, rng)
+
+
+targeting_engines = {}
+
+
+def get_targeting_engine(generator):
+    key = (generator.rows, generator.cols, tuple(generator.ships))
+    if key not in targeting_engines:
+        targeting_engines[key] = TargetingEngine(generator.rows, generator.cols, generator.placements)
+    return targeting_engines[key]
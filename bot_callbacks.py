@@ -0,0 +1,82 @@
+# bot_callbacks.py
+
+import binascii
+import hmac
+import struct
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+CALLBACK_VERSION = 1
+
+ACTION_FIRE = 1
+ACTION_VIEW = 2
+ACTION_NEW_GAME = 3
+ACTION_BOARDS = 4
+ACTION_NAME_TG = 5
+ACTION_NAME_LASTUSED = 6
+ACTION_NAME_NEW = 7
+ACTION_LEADERBOARD_SHOW = 8
+ACTION_LEADERBOARD_SKIP = 9
+ACTION_DUEL = 10
+ACTION_PLACE = 11
+ACTION_PLACE_AUTO = 12
+ACTION_PLACE_RESET = 13
+ACTION_PVP_JOIN = 14
+ACTION_PVP_FIRE = 15
+ACTION_PVP_LEAVE = 16
+
+ACTION_NAMES = {
+    ACTION_FIRE: 'fire',
+    ACTION_VIEW: 'view',
+    ACTION_NEW_GAME: 'newgame',
+    ACTION_BOARDS: 'boards',
+    ACTION_NAME_TG: 'name',
+    ACTION_NAME_LASTUSED: 'name',
+    ACTION_NAME_NEW: 'name',
+    ACTION_LEADERBOARD_SHOW: 'leaderboard',
+    ACTION_LEADERBOARD_SKIP: 'leaderboard',
+    ACTION_DUEL: 'duel',
+    ACTION_PLACE: 'place',
+    ACTION_PLACE_AUTO: 'place',
+    ACTION_PLACE_RESET: 'place',
+    ACTION_PVP_JOIN: 'pvp',
+    ACTION_PVP_FIRE: 'pvp_fire',
+    ACTION_PVP_LEAVE: 'pvp',
+}
+
+CALLBACK_HEADER = struct.Struct('>BBI')
+MAC_SIZE = 6
+
+
+class CallbackCodec:
+    # callback_data is base64 of: version, action, 32-bit game id, one byte per argument, then a truncated
+    # HMAC-SHA256 of all of it. A fire on 8x8 is 16 bytes, 22 characters (Telegram allows 64 bytes)
+    def __init__(self, secret):
+        self.key = secret.encode() if isinstance(secret, str) else secret
+
+    def sign(self, body):
+        return hmac.digest(self.key, body, 'sha256')[:MAC_SIZE]
+
+    def encode(self, action, game_id=0, *args):
+        body = CALLBACK_HEADER.pack(CALLBACK_VERSION, action, game_id) + bytes(args)
+        return urlsafe_b64encode(body + self.sign(body)).rstrip(b'=').decode()
+
+    def decode(self, data):
+        # (action, game id, arguments), or None for data that is forged, truncated or signed with another key
+        if not data:
+            return None
+        try:
+            raw = urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        except (binascii.Error, ValueError):
+            return None
+        if len(raw) < CALLBACK_HEADER.size + MAC_SIZE or raw[0] != CALLBACK_VERSION:
+            return None
+        body = raw[:-MAC_SIZE]
+        if not hmac.compare_digest(raw[-MAC_SIZE:], self.sign(body)):
+            return None
+        _, action, game_id = CALLBACK_HEADER.unpack_from(body)
+        return action, game_id, tuple(body[CALLBACK_HEADER.size:])
+
+
+def action_name(action):
+    # None stands for data that didn't decode
+    return ACTION_NAMES.get(action, 'unknown') if action is not None else 'invalid'
@@ -0,0 +1,204 @@
+# bot_gamelog.py
+
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+
+from bot_metrics import metrics
+
+# Record: body length and CRC-32 of the body, then the body: the header, the ships mask (plus the hits and misses
+# masks of a game recorded from the middle), the shot cells as uint16 and their times as uint32 milliseconds
+# since the recording started. An 8x8 game of 40 shots is 294 bytes
+RECORD_PREFIX = struct.Struct('<II')
+RECORD_HEADER = struct.Struct('<BBqQdBBiiH')
+RECORD_VERSION = 1
+FLAG_FINISHED = 1
+FLAG_PARTIAL = 2
+
+
+class GameRecord:
+    # One solo game: its fleet as the ships mask (the same one GameState stores), and every shot in order.
+    # A game restored after a restart is recorded from where it was (PARTIAL, with the shots made before
+    # as masks, in no order) and start_score is the score it had then
+    __slots__ = ('user_id', 'seed', 'rows', 'cols', 'started', 'start_score', 'score', 'flags', 'ships', 'hits',
+                 'misses', 'cells', 'offsets', 'updated')
+
+    def __init__(self, user_id, seed, rows, cols, started, start_score=0, ships=0, hits=0, misses=0):
+        self.user_id = user_id
+        self.seed = seed
+        self.rows = rows
+        self.cols = cols
+        self.started = started
+        self.start_score = start_score
+        self.score = start_score
+        self.flags = FLAG_PARTIAL if hits or misses or start_score else 0
+        self.ships = ships
+        self.hits = hits
+        self.misses = misses
+        self.cells = array('H')
+        self.offsets = array('I')
+        self.updated = time.monotonic()
+
+    @property
+    def finished(self):
+        return bool(self.flags & FLAG_FINISHED)
+
+    @property
+    def partial(self):
+        return bool(self.flags & FLAG_PARTIAL)
+
+    def add_shot(self, cell, now):
+        self.cells.append(cell)
+        self.offsets.append(min(int((now - self.started) * 1000), 0xFFFFFFFF))
+        self.updated = time.monotonic()
+
+    def to_bytes(self):
+        size = (self.rows * self.cols + 7) // 8
+        masks = (self.ships, self.hits, self.misses) if self.partial else (self.ships,)
+        count = len(self.cells)
+        body = b''.join((
+            RECORD_HEADER.pack(RECORD_VERSION, self.flags, self.user_id, self.seed or 0, self.started, self.rows,
+                               self.cols, self.start_score, self.score, count),
+            *(mask.to_bytes(size, 'little') for mask in masks),
+            struct.pack(f'<{count}H', *self.cells),
+            struct.pack(f'<{count}I', *self.offsets),
+        ))
+        return RECORD_PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+    @classmethod
+    def from_bytes(cls, body):
+        (_, flags, user_id, seed, started, rows, cols, start_score, score,
+         count) = RECORD_HEADER.unpack_from(body)
+        size = (rows * cols + 7) // 8
+        offset = RECORD_HEADER.size
+        masks = [int.from_bytes(body[offset + i * size:offset + (i + 1) * size], 'little')
+                 for i in range(3 if flags & FLAG_PARTIAL else 1)]
+        offset += len(masks) * size
+        record = cls(user_id, seed, rows, cols, started, start_score, *masks)
+        record.flags = flags
+        record.score = score
+        record.cells = array('H', struct.unpack_from(f'<{count}H', body, offset))
+        record.offsets = array('I', struct.unpack_from(f'<{count}I', body, offset + count * 2))
+        return record
+
+
+def read_records(path):
+    # Records of one log file in the order they were written; a record cut short by a crash ends the file
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset, end = 0, len(data)
+            while offset + RECORD_PREFIX.size <= end:
+                length, crc = RECORD_PREFIX.unpack_from(data, offset)
+                start = offset + RECORD_PREFIX.size
+                body = data[start:start + length]
+                if len(body) < length or zlib.crc32(body) != crc or body[0] != RECORD_VERSION:
+                    return
+                yield GameRecord.from_bytes(body)
+                offset = start + length
+
+
+class GameLog:
+    # Solo games are kept as records while they are played and appended to the log once they are won, replaced
+    # by another game, idle for idle_ttl or the bot stops. Writes go through a large file buffer that the run
+    # loop flushes every flush_interval; past max_bytes the file is rotated to path.1 .. path.<backups>.
+    # Nothing is recorded until start() opens the log
+    def __init__(self):
+        self.path = None
+        self.max_bytes = 64 * 1024 * 1024
+        self.backups = 5
+        self.flush_interval = 5
+        self.idle_ttl = 3600
+        self.buffer_size = 1024 * 1024
+        self.games = {}
+        self.file = None
+        self.size = 0
+        self.task = None
+
+    def configure(self, path, max_bytes=64 * 1024 * 1024, backups=5, flush_interval=5, idle_ttl=3600):
+        self.path = path or None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+
+    def open(self):
+        self.file = open(self.path, 'ab', buffering=self.buffer_size)
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, record):
+        data = record.to_bytes()
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+        metrics.inc('game_log_records_total')
+
+    def shot(self, user_id, state, x, y, previous_score):
+        # Called once the shot is applied to state and its score counted; previous_score is the score before it
+        if self.file is None:
+            return
+        cell = x * state.cols + y
+        record = self.games.get(user_id)
+        if record is None or record.seed != state.seed:
+            if record is not None:
+                self.write(self.games.pop(user_id))
+            shot = ~(1 << cell)
+            record = self.games[user_id] = GameRecord(user_id, state.seed, state.rows, state.cols, time.time(),
+                                                      previous_score, state.ships, state.hits & shot, state.misses & shot)
+        record.add_shot(cell, time.time())
+        record.score = state.score
+        if state.is_won():
+            del self.games[user_id]
+            record.flags |= FLAG_FINISHED
+            self.write(record)
+
+    def write_idle(self, ttl):
+        deadline = time.monotonic() - ttl
+        for user_id in [user_id for user_id, record in self.games.items() if record.updated <= deadline]:
+            self.write(self.games.pop(user_id))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.write_idle(self.idle_ttl)
+                self.file.flush()
+            except Exception as e:
+                print(f"Error while writing the game log: {e}")
+
+    def start(self):
+        if self.task is not None or not self.path:
+            return
+        self.open()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        try:
+            self.write_idle(-1)
+        finally:
+            self.file.close()
+            self.file = None
+
+
+game_log = GameLog()
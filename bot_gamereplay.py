@@ -0,0 +1,250 @@
+# bot_gamereplay.py
+#
+# Offline replay of the game log (BOT_SETTINGS['game_log']) through GameLogic.
+#
+#   python bot_gamereplay.py verify games.log games.log.1
+#       re-plays every recorded game, reports scores that don't follow from the shots and players whose
+#       games look automated (shots faster than --min-interval, accuracy over --max-accuracy, first shots
+#       that hit far more often than chance)
+#   python bot_gamereplay.py verify games.log --user 123456
+#       the same for one player, listing every game
+#   python bot_gamereplay.py bench games.log
+#       times reading and re-playing the log
+#   python bot_gamereplay.py synthetic games_test.log --games 100000
+#       writes a log of random, targeted and cheating players to try the above on
+#
+# python bot_loadtest.py --gamelog games.log plays recorded games back as load-test traffic.
+
+import argparse
+import random
+import statistics
+import time
+
+import games_bot
+from bot_ai import get_targeting_engine
+from bot_gamelog import GameLog, GameRecord, FLAG_FINISHED, read_records
+
+
+def initial_state(record):
+    # The fleet, and for a game recorded from the middle the shots made before, as GameState stores them
+    size = (record.rows * record.cols + 7) // 8
+    return games_bot.GameState.from_bytes(
+        games_bot.GAME_HEADER.pack(record.rows, record.cols, record.start_score, record.seed)
+        + b''.join(mask.to_bytes(size, 'big') for mask in (record.ships, record.hits, record.misses)))
+
+
+class Replay:
+    __slots__ = ('record', 'score', 'won', 'shots', 'hits', 'first_hit', 'interval', 'problems')
+
+    def __init__(self, record):
+        self.record = record
+        self.score = record.start_score
+        self.won = False
+        self.shots = 0
+        self.hits = 0
+        self.first_hit = False
+        self.interval = None
+        self.problems = []
+
+    @property
+    def accuracy(self):
+        return self.hits / self.shots if self.shots else 0
+
+
+def replay(record):
+    # The shots go through GameLogic.fire and are scored like on_fire scores them
+    result = Replay(record)
+    game = games_bot.GameLogic(record.rows, record.cols, games_bot.EMPTY, games_bot.SHIP, initial_state(record))
+    cells = record.rows * record.cols
+    for cell in record.cells:
+        if cell >= cells:
+            result.problems.append(f"shot off the board at {cell}")
+            break
+        shot = game.fire(*divmod(cell, record.cols))
+        if shot is None:
+            # on_fire ignores a cell that was already shot, so it is never recorded
+            result.problems.append(f"cell {cell} shot twice")
+            break
+        result.score += games_bot.SHOT_POINTS[shot]
+        if shot != games_bot.SHOT_MISS:
+            result.hits += 1
+            result.first_hit = result.first_hit or result.shots == 0
+        result.shots += 1
+    result.won = game.check_if_won()
+    if result.score != record.score:
+        result.problems.append(f"score {record.score}, the shots give {result.score}")
+    if result.won != record.finished:
+        result.problems.append("won, but recorded as unfinished" if result.won else "recorded as won, but ships are left")
+    if len(record.offsets) > 1:
+        result.interval = statistics.median(b - a for a, b in zip(record.offsets, record.offsets[1:])) / 1000
+    return result
+
+
+def iter_records(paths, user_id=None):
+    for path in paths:
+        for record in read_records(path):
+            if user_id is None or record.user_id == user_id:
+                yield record
+
+
+def suspicions(result, min_interval, max_accuracy, min_shots=10):
+    # Only whole games played from the start say anything about how they were played
+    record = result.record
+    if record.partial or result.shots < min_shots:
+        return []
+    reasons = []
+    if result.interval is not None and result.interval < min_interval:
+        reasons.append(f"median {result.interval * 1000:.0f} ms between shots")
+    if record.finished and result.accuracy > max_accuracy:
+        reasons.append(f"{result.accuracy:.0%} of shots hit")
+    return reasons
+
+
+def verify(paths, user_id=None, min_interval=0.15, max_accuracy=0.85, min_games=5, min_share=0.5, first_hit_rate=0.8,
+           top=20):
+    started = time.perf_counter()
+    games = finished = partial = shots = 0
+    broken = []
+    players = {}
+    for record in iter_records(paths, user_id):
+        result = replay(record)
+        games += 1
+        finished += record.finished
+        partial += record.partial
+        shots += result.shots
+        if result.problems:
+            broken.append(result)
+        player = players.setdefault(record.user_id, [0, 0, 0, []])
+        reasons = suspicions(result, min_interval, max_accuracy)
+        if not record.partial and result.shots:
+            player[0] += 1
+            player[1] += result.first_hit
+        if reasons:
+            player[2] += 1
+            player[3].append(reasons)
+        if user_id is not None:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.started))} seed {record.seed:016x} "
+                  f"{record.rows}x{record.cols} shots {result.shots:3} score {record.score:4} "
+                  f"{'won' if record.finished else 'unfinished'}{' partial' if record.partial else ''} "
+                  f"{'; '.join(result.problems + reasons)}")
+    elapsed = time.perf_counter() - started
+
+    print(f"Games: {games} ({finished} won, {partial} recorded from the middle), shots: {shots}, "
+          f"replayed in {elapsed:.2f} s")
+    print(f"Scores that don't follow from the shots: {len(broken)}")
+    for result in broken[:top]:
+        record = result.record
+        print(f"  user {record.user_id} seed {record.seed:016x}: {'; '.join(result.problems)}")
+
+    # A lucky game is flagged now and then; a player is a suspect when most of their games are, or when their
+    # first shots hit far more often than the third of the time they do on every board mode
+    suspects = []
+    for player_id, (whole, first_hits, flagged, reasons) in players.items():
+        if whole < min_games:
+            continue
+        found = []
+        if flagged / whole >= min_share:
+            found.append(f"{flagged} of {whole} games flagged, e.g. {'; '.join(reasons[0])}")
+        if first_hits / whole > first_hit_rate:
+            found.append(f"first shot hit in {first_hits} of {whole} games")
+        if found:
+            suspects.append((flagged / whole, player_id, found))
+    suspects.sort(reverse=True)
+    print(f"Players whose games look automated: {len(suspects)}")
+    for _, player_id, found in suspects[:top]:
+        print(f"  user {player_id}: {'; '.join(found)}")
+
+
+def bench(paths, repeat=3):
+    for _ in range(repeat):
+        started = time.perf_counter()
+        records = list(iter_records(paths))
+        read = time.perf_counter() - started
+        started = time.perf_counter()
+        shots = sum(replay(record).shots for record in records)
+        elapsed = time.perf_counter() - started
+        print(f"{len(records)} games read in {read:.2f} s ({len(records) / read:.0f}/s), re-played in {elapsed:.2f} s "
+              f"({len(records) / elapsed:.0f} games/s, {shots / elapsed:.0f} shots/s)")
+
+
+def synthetic(path, games, seed, mode_name, max_bytes, users=1000, cheaters=5):
+    # Random players shoot anywhere, targeted ones like the vs-bot engine; cheaters know the fleet and click
+    # every 50 ms. Each player is one of the three for all their games
+    mode = games_bot.BOARD_MODES[mode_name]
+    generator = games_bot.get_fleet_generator(mode.rows, mode.cols, mode.ships)
+    engine = get_targeting_engine(generator)
+    rng = random.Random(seed)
+    log = GameLog()
+    log.configure(path, max_bytes=max_bytes)
+    log.open()
+    now = time.time() - games * 60
+    written = 0
+    started = time.perf_counter()
+    for _ in range(games):
+        user_id = rng.randrange(1, users + 1)
+        layout = generator.generate(rng.getrandbits(64))
+        if layout is None:
+            continue
+        state = games_bot.GameState(mode.rows, mode.cols, layout[0])
+        for cells in layout[1]:
+            state.add_ship(cells)
+        record = GameRecord(user_id, state.seed, mode.rows, mode.cols, now, ships=state.ships)
+        clock = now
+        order = list(range(mode.rows * mode.cols))
+        rng.shuffle(order)
+        while not state.is_won():
+            if user_id <= cheaters:
+                x, y = divmod((state.ships & ~state.hits).bit_length() - 1, mode.cols)
+                clock += 0.05
+            elif user_id % 2:
+                x, y = engine.next_shot(state, rng)
+                clock += rng.uniform(0.5, 4)
+            else:
+                x, y = divmod(order.pop(), mode.cols)
+                clock += rng.uniform(0.5, 4)
+            state.score += games_bot.SHOT_POINTS[state.fire(x, y)]
+            record.add_shot(x * mode.cols + y, clock)
+        record.score = state.score
+        record.flags |= FLAG_FINISHED
+        log.write(record)
+        written += 1
+        now += 60
+    log.file.close()
+    elapsed = time.perf_counter() - started
+    print(f"{written} games written to {path} in {elapsed:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline replay of recorded games")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    check = commands.add_parser('verify')
+    check.add_argument('paths', nargs='+')
+    check.add_argument('--user', type=int)
+    check.add_argument('--min-interval', type=float, default=0.15, help="seconds between shots below which a game is flagged")
+    check.add_argument('--max-accuracy', type=float, default=0.85, help="share of hits above which a won game is flagged")
+    check.add_argument('--min-games', type=int, default=5, help="whole games a player needs before being judged")
+    check.add_argument('--top', type=int, default=20)
+
+    timing = commands.add_parser('bench')
+    timing.add_argument('paths', nargs='+')
+    timing.add_argument('--repeat', type=int, default=3)
+
+    fake = commands.add_parser('synthetic')
+    fake.add_argument('path')
+    fake.add_argument('--games', type=int, default=100000)
+    fake.add_argument('--seed', type=int, default=1)
+    fake.add_argument('--mode', default=games_bot.DEFAULT_BOARD_MODE)
+    fake.add_argument('--max-bytes', type=int, default=64 * 1024 * 1024)
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        verify(args.paths, args.user, args.min_interval, args.max_accuracy, args.min_games, top=args.top)
+    elif args.command == 'bench':
+        bench(args.paths, args.repeat)
+    else:
+        synthetic(args.path, args.games, args.seed, args.mode, args.max_bytes)
+
+
+if __name__ == '__main__':
+    main()
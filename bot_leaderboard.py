@@ -0,0 +1,277 @@
+# bot_leaderboard.py
+
+import asyncio
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+# Boards by the period they rank: all time, the current week (from Monday) and today
+PERIODS = ('all', 'week', 'day')
+ALL_TIME_START = date(1970, 1, 1)
+
+
+def period_start(period, day):
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return ALL_TIME_START
+
+
+class ScoreRankIndex:
+    # Distinct scores in ascending order with a Fenwick tree over their counts:
+    # adding a score and counting the scores above it are both O(log n)
+    def __init__(self, score_counts=()):
+        self.scores = []
+        self.counts = []
+        self.slots = {}
+        self.tree = [0]
+        self.total = 0
+        for score, count in sorted(score_counts):
+            self.scores.append(score)
+            self.counts.append(count)
+            self.total += count
+        self.rebuild()
+
+    def rebuild(self):
+        self.slots = {score: i for i, score in enumerate(self.scores)}
+        self.tree = [0] * (len(self.counts) + 1)
+        for i, count in enumerate(self.counts, start=1):
+            self.tree[i] += count
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, score, count=1):
+        self.total += count
+        i = self.slots.get(score)
+        if i is None:
+            # A new distinct score is rare (the score range is small), so rebuilding is cheap
+            i = bisect_left(self.scores, score)
+            self.scores.insert(i, score)
+            self.counts.insert(i, count)
+            self.rebuild()
+            return
+        self.counts[i] += count
+        tree = self.tree
+        size = len(tree)
+        i += 1
+        while i < size:
+            tree[i] += count
+            i += i & -i
+
+    def position(self, score):
+        # Same as SELECT COUNT(*) + 1 ... WHERE score > %s
+        i = self.slots.get(score)
+        return self.total - self.prefix(i + 1 if i is not None else bisect_right(self.scores, score)) + 1
+
+
+class LeaderboardWindow:
+    # One board: every user's best score in a period (one row per user), the index ranking those
+    # scores and the top. A score only ever replaces the same user's lower one, so all of it is
+    # kept up to date per add without going back to the entries
+    def __init__(self, period, start, top_size, best=(), top=()):
+        self.period = period
+        self.start = start
+        self.top_size = top_size
+        self.best = dict(best)
+        self.index = ScoreRankIndex(Counter(self.best.values()).items())
+        self.top_entries = sorted(top, key=lambda entry: -entry['score'])[:top_size]
+        self.top_keys = [-entry['score'] for entry in self.top_entries]
+        self.snapshots = {}
+
+    def add(self, user_id, name, score, when):
+        # True when the top changed
+        previous = self.best.get(user_id)
+        if previous is not None and score <= previous:
+            return False
+        self.best[user_id] = score
+        if previous is not None:
+            self.index.add(previous, -1)
+        self.index.add(score)
+
+        if previous is not None and self.top_keys and -previous <= self.top_keys[-1]:
+            # The user's previous best may be in the top: their new one replaces it
+            for i, entry in enumerate(self.top_entries):
+                if entry['user_id'] == user_id:
+                    del self.top_entries[i]
+                    del self.top_keys[i]
+                    break
+        i = bisect_right(self.top_keys, -score)
+        if i >= self.top_size:
+            return False
+        self.top_entries.insert(i, {'user_id': user_id, 'name': name, 'score': score, 'date': when})
+        self.top_keys.insert(i, -score)
+        del self.top_entries[self.top_size:]
+        del self.top_keys[self.top_size:]
+        return True
+
+    def user_position(self, user_id):
+        # (position, score) of the user's best score, or None for users without one
+        score = self.best.get(user_id)
+        if score is None:
+            return None
+        return self.index.position(score), score
+
+
+class Leaderboard:
+    # Scores are written through the write-behind queue and added to one window per period, which
+    # answer with the rank at once. Each window's top is kept rendered as pages per language
+    # (render(language, period, entries, first_position, page, pages) returns a page's text),
+    # re-rendered by the run loop shortly after it changes and on every reload.
+    # load(top_size, starts) returns {period: (top entries, [(user_id, best score)])} for the periods
+    # starting on starts[period]
+    def __init__(self, load, writer, top_size=100, refresh_interval=300, page_size=10, render=None, languages=(),
+                 render_delay=1, periods=PERIODS):
+        self.load_rows = load
+        self.writer = writer
+        self.top_size = top_size
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        self.render = render
+        self.languages = languages
+        self.render_delay = render_delay
+        self.today = date.today
+        self.day = self.today()
+        self.windows = {period: LeaderboardWindow(period, period_start(period, self.day), top_size)
+                        for period in periods}
+        self.changed = None
+        self.task = None
+        self.loading = None
+
+    def roll(self):
+        # A day or week that is over is dropped as a whole: the next one starts empty
+        today = self.today()
+        if today == self.day:
+            return
+        self.day = today
+        for period, window in self.windows.items():
+            start = period_start(period, today)
+            if window.start != start:
+                self.windows[period] = LeaderboardWindow(period, start, self.top_size)
+
+    def window(self, period):
+        self.roll()
+        return self.windows[period]
+
+    async def load(self):
+        today = self.today()
+        starts = {period: period_start(period, today) for period in self.windows}
+        rows = await self.load_rows(self.top_size, starts)
+        # Rows still queued for MySQL are not in its rollups yet
+        pending = self.writer.pending_rows('score')
+        # Windows of a million users take seconds to build, so they are built and rendered off the event
+        # loop; scores added meanwhile go to the old windows and are added again to the new ones
+        self.loading = []
+        try:
+            windows = await asyncio.get_running_loop().run_in_executor(None, self.build_windows, rows, pending,
+                                                                       starts, today)
+            changed = False
+            for entry in self.loading:
+                for window in windows.values():
+                    changed = window.add(*entry) or changed
+        finally:
+            self.loading = None
+        self.windows = windows
+        self.day = today
+        if changed:
+            if self.changed is not None:
+                self.changed.set()
+            else:
+                self.render_snapshots()
+
+    def build_windows(self, rows, pending, starts, today):
+        windows = {}
+        for period, start in starts.items():
+            top, best = rows[period]
+            window = windows[period] = LeaderboardWindow(period, start, self.top_size, best, top)
+            for user_id, name, score, *when in pending:
+                # Rows journaled before scores carried their time count as now
+                day = date.fromisoformat(when[0][:10]) if when else today
+                if period_start(period, day) == start:
+                    window.add(user_id, name, score, when[0] if when else None)
+            self.render_window(window)
+        return windows
+
+    def render_window(self, window):
+        if self.render is None:
+            return
+        pages = max(1, -(-len(window.top_entries) // self.page_size))
+        chunks = [window.top_entries[page * self.page_size:(page + 1) * self.page_size] for page in range(pages)]
+        window.snapshots = {language: tuple(self.render(language, window.period, chunk, page * self.page_size + 1,
+                                                        page, pages)
+                                            for page, chunk in enumerate(chunks))
+                            for language in self.languages}
+
+    def render_snapshots(self):
+        for period in self.windows:
+            self.render_window(self.window(period))
+
+    def add(self, user_id, name, score):
+        # Returns the all-time place of this score, which is below the user's best when it doesn't beat it
+        when = datetime.now().isoformat(sep=' ', timespec='seconds')
+        self.writer.put('score', (user_id, name, score, when))
+        self.roll()
+        if self.loading is not None:
+            self.loading.append((user_id, name, score, when))
+        changed = False
+        for window in self.windows.values():
+            changed = window.add(user_id, name, score, when) or changed
+        if changed and self.changed is not None:
+            self.changed.set()
+        return self.windows['all'].index.position(score)
+
+    def top(self, limit=100, period='all'):
+        return self.window(period).top_entries[:limit]
+
+    def page(self, language, page, period='all'):
+        # (text, page, pages) of the last rendered snapshot; the page is clamped to the ones that exist
+        window = self.window(period)
+        if not window.snapshots:
+            self.render_window(window)
+        pages = window.snapshots.get(language) or ('',)
+        page = max(0, min(page, len(pages) - 1))
+        return pages[page], page, len(pages)
+
+    def user_position(self, user_id, period='all'):
+        return self.window(period).user_position(user_id)
+
+    async def run(self):
+        reload_at = time.monotonic() + self.refresh_interval if self.refresh_interval else None
+        while True:
+            timeout = max(reload_at - time.monotonic(), 0) if reload_at is not None else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if reload_at is not None and time.monotonic() >= reload_at:
+                    reload_at = time.monotonic() + self.refresh_interval
+                    self.changed.clear()
+                    # Picks up entries written by other worker processes
+                    await self.load()
+                else:
+                    # A burst of wins is rendered once
+                    await asyncio.sleep(self.render_delay)
+                    self.changed.clear()
+                    self.render_snapshots()
+            except Exception as e:
+                print(f"Error while loading leaderboard: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.changed = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,1447 @@
+# bot_loadtest.py
+#
+# Offline load test: plays synthetic games through start / handle_button / handle_text_message
+# with a fake bot and an in-memory stand-in for MySQL, no Telegram or database needed.
+#
+#   python bot_loadtest.py --players 2000 --games 1 --seed 1
+#   python bot_loadtest.py --players 2000 --db-latency 0.002 --api-latency 0.05
+#   python bot_loadtest.py --tracemalloc
+#       allocations per click, and of the board work of a fire click with the game rebuilt vs reused
+#   python bot_loadtest.py --game-memory
+#       memory of 100k concurrent games of the default board as emoji lists in user_data, as GameLogic in
+#       game_store and as saved blobs
+#   python bot_loadtest.py --db-pool
+#       profile lookups through DatabasePool (connection pool, ping, executor) against a connection per query on
+#       the event loop, with a MySQL stand-in whose round trips block: query latency and event loop lag
+#   python bot_loadtest.py --animations --players 100 --api-latency 0.05 [--rate-limits]
+#       players shoot only at ships, so their sunk-ship animations overlap: fire click latency by how many
+#       animations were running, next to the same clicks without animations, and edits per chat per second
+#   python bot_loadtest.py --outbox
+#       the outbox against a fake Bot API that raises RetryAfter over its own flood limits, with the configured
+#       limits and with limits twice the API's: calls per chat and in all per second, RetryAfter, coalesced edits,
+#       animation frames sent ahead of direct responses, and the latency of each
+#   python bot_loadtest.py --shots
+#       shots per second of the bitmask game state against the emoji lists games used to be kept in, on every board
+#   python bot_loadtest.py --messages
+#       rendering throughput of translations, templates and the main keyboard: compiled catalog against lookups
+#       and str.replace as they were
+#   python bot_loadtest.py --ranks
+#       submission, rank and top-100 latency on 1M leaderboard rows: SQL queries as they were against the windows
+#   python bot_loadtest.py --boards
+#       times fleet generation, shots and keyboard rendering for every board mode
+#   python bot_loadtest.py --callbacks
+#       times callback_data decoding and handler lookup per click
+#   python bot_loadtest.py --leaderboard --entries 10000000
+#       feeds a synthetic score history through the leaderboard windows and compares with recomputing from it
+#   python bot_loadtest.py --ai
+#       self-play of the vs-bot targeting for every board mode: move time and shots to win against random fire
+#   python bot_loadtest.py --pvp --players 4000 --api-latency 0.05
+#       players join the PvP lobby within a second and play their matches out, with double taps and players
+#       walking away mid-match; reports matchmaking latency, click latency and how the matches ended
+#   python bot_loadtest.py --players 2000 --record games_test.log
+#       records the games to a game log, as the bot does with BOT_SETTINGS['game_log']
+#   python bot_loadtest.py --players 2000 --gamelog games.log
+#       plays recorded games of the default board back: the same fleets, shot in the recorded order
+#   python bot_loadtest.py --players 100 --rate-limits
+#       keeps the configured outbox limits (otherwise Bot API calls are not rate limited)
+#   python bot_loadtest.py --workers 1 2 4 --players 200 [--kill-worker]
+#       webhook updates through the worker router to worker processes and a fake Bot API (needs aiohttp and
+#       python-telegram-bot): throughput per worker count and whether every user's clicks were answered in order;
+#       --kill-worker also kills a worker halfway and reports how the router brought it back
+
+import argparse
+import asyncio
+import bisect
+import functools
+import itertools
+import random
+import sqlite3
+import time
+import tracemalloc
+from collections import Counter
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+import bot_messages
+import games_bot
+from bot_ai import get_targeting_engine
+from bot_leaderboard import Leaderboard
+from bot_gamereplay import initial_state, iter_records
+from bot_callbacks import (ACTION_FIRE, ACTION_LEADERBOARD_SHOW, ACTION_NEW_GAME, ACTION_NAME_TG, ACTION_NAME_LASTUSED,
+                           ACTION_PVP_JOIN, ACTION_PVP_FIRE)
+from bot_outbox import Outbox, TokenBucket, PRIORITY_DIRECT, PRIORITY_ANIMATION
+from bot_storage import GameStore
+from bot_webhook import UserOrderedUpdateProcessor
+from bot_workers import RoutingWebhookServer, worker_starter, stop_workers
+
+
+class FakeDatabasePool:
+    # Same interface as DatabasePool.run; jobs are served from dicts instead of MySQL
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.users = {}
+        self.leaderboard = []
+        self.queries = 0
+        self.jobs = {
+            'fetch_user_info': self.fetch_user_info,
+            'prepare_leaderboard': self.prepare_leaderboard,
+            'load_leaderboard': self.load_leaderboard,
+            'write_batch': self.write_batch,
+        }
+
+    async def run(self, func, *args):
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.jobs[func.__name__](*args)
+
+    def close(self):
+        pass
+
+    def fetch_user_info(self, user_id):
+        return dict(self.users[user_id]) if user_id in self.users else -1
+
+    def prepare_leaderboard(self, starts):
+        pass
+
+    def load_leaderboard(self, limit, starts):
+        # What the best-score rollups hold: each user's best entry since the start of the period
+        boards = {}
+        for period, start in starts.items():
+            best = {}
+            for user_id, name, score, when in self.leaderboard:
+                if when[:10] >= start.isoformat() and (user_id not in best or score > best[user_id][1]):
+                    best[user_id] = (name, score, when)
+            top = sorted(best.items(), key=lambda item: -item[1][1])[:limit]
+            boards[period] = ([{'user_id': user_id, 'name': name, 'score': score, 'date': when}
+                               for user_id, (name, score, when) in top],
+                              [(user_id, score) for user_id, (_, score, _) in best.items()])
+        return boards
+
+    def write_batch(self, ops):
+        for kind, row in ops:
+            if kind == 'user':
+                self.users.setdefault(row[0], {'user_id': row[0], 'first_name': row[1], 'leader_board_name': None})
+            elif kind == 'name':
+                self.users[row[1]]['leader_board_name'] = row[0]
+            elif kind == 'score':
+                self.leaderboard.append(row)
+
+
+class FakeConnection:
+    # A mysql.connector connection whose round trips block like socket reads: a connect is a TCP and auth
+    # handshake, a ping and a query one round trip each
+    connect_latency = 0.005
+    query_latency = 0.001
+    ping_latency = 0.0002
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        time.sleep(self.connect_latency)
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        time.sleep(self.ping_latency)
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.connections.append(self)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, query, params=()):
+        time.sleep(self.conn.query_latency)
+        self.row = {'user_id': params[0], 'first_name': 'Player', 'leader_board_name': None}
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+class FakeConnectionPool:
+    # Stands in for pooling.MySQLConnectionPool, which also fails instead of waiting once every connection is out
+    def __init__(self, pool_name=None, pool_size=5, pool_reset_session=True, **config):
+        self.connections = [FakeConnection(self) for _ in range(pool_size)]
+
+    def get_connection(self):
+        if not self.connections:
+            raise RuntimeError("Failed getting connection; pool exhausted")
+        return self.connections.pop()
+
+
+class FakeBot:
+    def __init__(self, latency=0.0):
+        self.id = 1
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = 0
+
+    async def call(self, chat_id):
+        # Always yields to the loop, like a real HTTP request would
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(message_id=next(self.message_ids), chat_id=chat_id)
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        return await self.call(chat_id)
+
+    async def send_photo(self, chat_id, photo=None, **kwargs):
+        message = await self.call(chat_id)
+        message.photo = [SimpleNamespace(file_id=photo if isinstance(photo, str) else f'photo{message.message_id}')]
+        return message
+
+    async def edit_message_text(self, chat_id=None, message_id=None, **kwargs):
+        return await self.call(chat_id)
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs):
+        return await self.call(chat_id)
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.call(chat_id)
+
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = set()
+
+    def create_task(self, coroutine, update=None):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+class Player:
+    def __init__(self, user_id, bot, application, rng):
+        self.user = SimpleNamespace(id=user_id, first_name=f'Player{user_id}', last_name=None, username=None,
+                                    is_bot=False, language_code=rng.choice(['en', 'ru']), is_premium=False)
+        self.chat = SimpleNamespace(id=user_id)
+        self.context = SimpleNamespace(user_data={}, args=[], bot=bot, application=application)
+        self.rng = rng
+        self.message_id = 0
+
+    def message_update(self, text):
+        async def reply_text(text, **kwargs):
+            return await self.context.bot.send_message(self.chat.id, text)
+
+        message = SimpleNamespace(text=text, contact=None, reply_text=reply_text, message_id=0)
+        return SimpleNamespace(effective_user=self.user, effective_chat=self.chat, message=message)
+
+    def fire_data(self, state, x, y):
+        # What the button at row x, column y of this game's keyboard carries
+        return games_bot.callbacks.encode(ACTION_FIRE, state.game_id, x, y, 0, 0)
+
+    def callback_update(self, data):
+        async def answer(*args, **kwargs):
+            return True
+
+        query = SimpleNamespace(from_user=self.user, data=data, answer=answer,
+                                message=SimpleNamespace(message_id=self.message_id))
+        return SimpleNamespace(effective_user=self.user, effective_chat=self.chat, callback_query=query)
+
+
+class LoadTest:
+    def __init__(self, players, games, seed, db_latency=0.0, api_latency=0.0, rate_limits=False, record_path=None,
+                 records=()):
+        self.players = players
+        self.games = games
+        self.seed = seed
+        self.db = FakeDatabasePool(db_latency)
+        self.bot = FakeBot(api_latency)
+        self.application = FakeApplication()
+        self.latencies = {}
+        self.loop_lag = []
+        self.clicks = 0
+        self.rate_limits = rate_limits
+        self.record_path = record_path
+        self.records = records
+        self.replayed = itertools.count()
+        self.mismatches = 0
+
+    async def timed(self, name, handler, update, context):
+        started = time.perf_counter()
+        await handler(update, context)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def play(self, player):
+        await self.timed('start', games_bot.start, player.message_update('/start'), player.context)
+        for game in range(self.games):
+            if game:
+                await self.timed('newgame', games_bot.handle_button,
+                                 player.callback_update(games_bot.callbacks.encode(ACTION_NEW_GAME)), player.context)
+            state = (await games_bot.game_store.get(player.user.id)).state
+            record = self.records[next(self.replayed) % len(self.records)] if self.records else None
+            if record:
+                game = games_bot.GameLogic(record.rows, record.cols, games_bot.EMPTY, games_bot.SHIP, initial_state(record))
+                games_bot.game_store.put(player.user.id, game)
+                state = game.state
+                cells = [divmod(cell, record.cols) for cell in record.cells]
+            else:
+                cells = [(x, y) for x in range(state.rows) for y in range(state.cols)]
+                player.rng.shuffle(cells)
+            for x, y in cells:
+                await self.timed('fire', games_bot.handle_button, player.callback_update(player.fire_data(state, x, y)),
+                                 player.context)
+                self.clicks += 1
+                if state.is_won():
+                    break
+            if record and state.score != record.score:
+                self.mismatches += 1
+
+            user_info = await games_bot.user_profiles.get(player.user.id)
+            if user_info['leader_board_name'] or player.rng.random() < 0.5:
+                action = ACTION_NAME_LASTUSED if user_info['leader_board_name'] else ACTION_NAME_TG
+                # A double click must still add one entry
+                for _ in range(1 + (player.rng.random() < 0.2)):
+                    await self.timed('name', games_bot.handle_button,
+                                     player.callback_update(games_bot.callbacks.encode(action, state.game_id)), player.context)
+            else:
+                await self.timed('text', games_bot.handle_text_message, player.message_update(f'Nick{player.user.id}'),
+                                 player.context)
+            for page in range(player.rng.randrange(3)):
+                await self.timed('board', games_bot.handle_button,
+                                 player.callback_update(games_bot.callbacks.encode(ACTION_LEADERBOARD_SHOW, 0, page)),
+                                 player.context)
+
+    async def monitor_loop(self, interval=0.01):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - started - interval)
+
+    async def run(self):
+        random.seed(self.seed)
+        games_bot.db_pool = self.db
+        games_bot.media.path = None
+        games_bot.game_store = GameStore(None, lambda game: game.to_bytes(), games_bot.GameLogic.from_bytes)
+        if not self.rate_limits:
+            games_bot.outbox = Outbox(chat_rate=1e9, chat_burst=1e9, global_rate=1e9, global_burst=1e9)
+        games_bot.writes.journal_path = None
+        games_bot.writes.start()
+        await games_bot.leaderboard.load()
+        games_bot.leaderboard.start()
+        games_bot.game_log.configure(self.record_path)
+        games_bot.game_log.start()
+
+        players = [Player(user_id, self.bot, self.application, random.Random(self.seed * 1000003 + user_id))
+                   for user_id in range(1, self.players + 1)]
+        monitor = asyncio.get_running_loop().create_task(self.monitor_loop())
+        started = time.perf_counter()
+        await asyncio.gather(*(self.play(player) for player in players))
+        elapsed = time.perf_counter() - started
+        monitor.cancel()
+        for task in list(self.application.tasks):
+            task.cancel()
+        await games_bot.leaderboard.close()
+        await games_bot.writes.close()
+        await games_bot.game_log.close()
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        calls = sum(len(values) for values in self.latencies.values())
+        print(f"Players: {self.players}, games each: {self.games}, seed: {self.seed}")
+        print(f"Handler calls: {calls} in {elapsed:.2f} s, {calls / elapsed:.1f}/s; fire clicks: {self.clicks}")
+        print(f"Bot API calls: {self.bot.calls}, DB jobs: {self.db.queries}, leaderboard rows: {len(self.db.leaderboard)}")
+        print(f"User profile cache: {games_bot.user_profiles.hits} hits, {games_bot.user_profiles.misses} misses")
+        if self.records:
+            print(f"Recorded games played back: {next(self.replayed)}, scores different from the log: {self.mismatches}")
+        for name, values in sorted(self.latencies.items()):
+            print(f"  {name:8} n={len(values):7}  {format_percentiles(values)}")
+        print(f"Event loop lag: {format_percentiles(self.loop_lag)}")
+
+
+class EditRecordingBot(FakeBot):
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.edits = {}
+
+    async def edit_message_text(self, chat_id=None, message_id=None, **kwargs):
+        self.edits.setdefault(chat_id, []).append(time.monotonic())
+        return await self.call(chat_id)
+
+
+class AnimationLoadTest(LoadTest):
+    # Every player knows their fleet and shoots only at ships, a click every 0.1-0.6 s, so sunk-ship animations of
+    # all players run at the same time and a player's next click often lands on their own running animation.
+    # Fire click latency is grouped by how many animations were running when the click came in
+    def __init__(self, players, seed, api_latency=0.0, rate_limits=False, animate=True):
+        super().__init__(players, 1, seed, api_latency=api_latency, rate_limits=rate_limits)
+        self.bot = EditRecordingBot(api_latency)
+        self.animate = animate
+        self.running = []
+        self.sunk = 0
+
+    async def play(self, player):
+        await games_bot.start(player.message_update('/start'), player.context)
+        state = (await games_bot.game_store.get(player.user.id)).state
+        cells = [divmod(cell, state.cols) for cell in range(state.rows * state.cols) if state.ships >> cell & 1]
+        player.rng.shuffle(cells)
+        for x, y in cells:
+            await asyncio.sleep(player.rng.uniform(0.1, 0.6))
+            running = len(games_bot.animation_tasks)
+            started = time.perf_counter()
+            await games_bot.handle_button(player.callback_update(player.fire_data(state, x, y)), player.context)
+            self.latencies.setdefault('fire', []).append(time.perf_counter() - started)
+            self.running.append(running)
+            self.clicks += 1
+        self.sunk += len(games_bot.BOARD_MODES[games_bot.DEFAULT_BOARD_MODE].ships)
+        while (player.chat.id, player.message_id) in games_bot.animation_tasks:
+            await asyncio.sleep(0.05)
+
+    async def run(self):
+        blink = games_bot.start_blinking_sea_fight
+        if not self.animate:
+            games_bot.start_blinking_sea_fight = lambda *args, **kwargs: None
+        try:
+            await super().run()
+        finally:
+            games_bot.start_blinking_sea_fight = blink
+
+    def report(self, elapsed):
+        latencies = self.latencies.get('fire', [])
+        # Most edits any chat got within one second, frames and replies together
+        busiest = max((sum(1 for other in times[index:] if other - at < 1) for times in self.bot.edits.values()
+                       for index, at in enumerate(times)), default=0)
+        edits = sum(len(times) for times in self.bot.edits.values())
+        print(f"  {'animations' if self.animate else 'no animations':14} {self.clicks} clicks, {self.sunk} ships sunk "
+              f"in {elapsed:.2f} s; {edits} edits, at most {busiest} per chat in a second")
+        # With the outbox limits kept and every player clicking at once the API is the bottleneck: the mean is
+        # then set by its rate, and animations only show up if they take calls away from the clicks
+        print(f"    fire          {format_percentiles(latencies)}  mean {sum(latencies) / len(latencies) * 1000:.3f} ms")
+        for low, high in ((0, 1), (1, 10), (10, 50), (50, None)):
+            values = [latency for latency, running in zip(latencies, self.running)
+                      if running >= low and (high is None or running < high)]
+            if values and self.animate:
+                label = f"{low}+" if high is None else f"{low}-{high - 1}" if high - low > 1 else f"{low}"
+                print(f"      {label:>5} running {format_percentiles(values)}")
+        print(f"    loop lag      {format_percentiles(self.loop_lag)}")
+
+
+def benchmark_animations(players, seed, api_latency=0.0, rate_limits=False, margin=0.02):
+    # Fails if fire p99 with animations is more than margin seconds above the run without them. With the outbox
+    # limits kept the API rate sets the latency of both runs, so there is no bound to check
+    print(f"{players} players sinking their fleets, {games_bot.DELAY * 6:.1f} s animation per sunk ship, "
+          f"Bot API latency {api_latency * 1000:.0f} ms, outbox limits {'kept' if rate_limits else 'off'}")
+    p99 = []
+    for animate in (False, True):
+        test = AnimationLoadTest(players, seed, api_latency, rate_limits, animate)
+        asyncio.run(test.run())
+        latencies = sorted(test.latencies['fire'])
+        p99.append(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)])
+    if not rate_limits and p99[1] > p99[0] + margin:
+        raise SystemExit(f"FAILED: fire p99 {p99[1] * 1000:.3f} ms with animations, more than {margin * 1000:.0f} ms "
+                         f"above {p99[0] * 1000:.3f} ms without")
+
+
+class RateLimitedBot:
+    # A Bot API with flood limits of its own: a call over the per-chat or the global bucket raises RetryAfter.
+    # Every accepted call is kept with the text it carried, and whether the outbox still had a direct response of
+    # that chat queued when an animation frame went out
+    def __init__(self, outbox, chat_rate=1.0, chat_burst=4, global_rate=30.0, global_burst=30, latency=0.02,
+                 retry_after=1):
+        self.outbox = outbox
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+        self.latency = latency
+        self.retry_after = retry_after
+        self.calls = []
+        self.rejected = 0
+        self.frames_overtaking = 0
+
+    async def call(self, chat_id, text):
+        # The outbox has just taken this request off the chat's queue
+        if text.startswith('frame') and any(entry[0] == PRIORITY_DIRECT and not entry[2].is_cancelled()
+                                            for entry in self.outbox.chats[chat_id].heap):
+            self.frames_overtaking += 1
+        await asyncio.sleep(self.latency)
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        if bucket.take():
+            self.rejected += 1
+            raise RetryAfter(self.retry_after)
+        if self.global_bucket.take():
+            bucket.tokens += 1
+            self.rejected += 1
+            raise RetryAfter(self.retry_after)
+        self.calls.append((time.monotonic(), chat_id, text))
+        return SimpleNamespace(message_id=len(self.calls), chat_id=chat_id)
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        return await self.call(chat_id, text)
+
+    async def edit_message_text(self, chat_id=None, message_id=None, text=None, **kwargs):
+        return await self.call(chat_id, text)
+
+
+def most_in_a_second(times):
+    times = sorted(times)
+    return max((bisect.bisect_left(times, at + 1) - index for index, at in enumerate(times)), default=0)
+
+
+async def run_outbox_test(outbox, chats, seconds, seed):
+    # Each chat clicks every 0.5-2.5 s and waits for the edit that answers the click, one click in ten is a double
+    # tap; one click in five sinks a ship, whose six frames go out 0.4 s apart until the next click cancels them,
+    # and one in twenty wins the game with three messages at once. Edits carry a number per chat in the order
+    # they were queued
+    bot = RateLimitedBot(outbox)
+    latencies = {'direct': [], 'frame': [], 'message': []}
+    results = Counter()
+    delivered = []
+    end = time.monotonic() + seconds
+
+    async def send(kind, method, priority, chat_id, text):
+        started = time.monotonic()
+        try:
+            message = await outbox.send(bot, method, priority, chat_id=chat_id, message_id=1, text=text)
+        except RetryAfter:
+            results['failed'] += 1
+            return
+        latencies[kind].append(time.monotonic() - started)
+        delivered.append(message)
+        # A coalesced edit is answered by the call that carried a later edit of the message, never an earlier one
+        if kind != 'message' and int(bot.calls[message.message_id - 1][2].split()[1]) < int(text.split()[1]):
+            results['stale'] += 1
+
+    async def animate(chat_id, numbers):
+        for _ in range(6):
+            await asyncio.sleep(0.4)
+            await send('frame', 'edit_message_text', PRIORITY_ANIMATION, chat_id, f'frame {next(numbers)}')
+
+    async def chat(chat_id):
+        rng = random.Random(seed * 1000003 + chat_id)
+        numbers = itertools.count()
+        animation = None
+        while time.monotonic() < end:
+            await asyncio.sleep(rng.uniform(0.5, 2.5))
+            if animation:
+                if not animation.done():
+                    results['animations cancelled'] += 1
+                animation.cancel()
+            await asyncio.gather(*(send('direct', 'edit_message_text', PRIORITY_DIRECT, chat_id, f'direct {next(numbers)}')
+                                   for _ in range(1 + (rng.random() < 0.1))))
+            if rng.random() < 0.2:
+                animation = asyncio.ensure_future(animate(chat_id, numbers))
+            elif rng.random() < 0.05:
+                await asyncio.gather(*(send('message', 'send_message', PRIORITY_DIRECT, chat_id, 'win')
+                                       for _ in range(3)))
+        if animation:
+            await asyncio.gather(animation, return_exceptions=True)
+
+    await asyncio.gather(*(chat(chat_id) for chat_id in range(1, chats + 1)))
+    sent = sum(len(values) for values in latencies.values())
+    results['coalesced'] = sent - len({id(message) for message in delivered})
+
+    # Per chat, the numbers of delivered edits must only grow: a coalesced edit sends the latest content
+    last, reordered = {}, 0
+    for _, chat_id, text in bot.calls:
+        if text != 'win':
+            number = int(text.split()[1])
+            reordered += number < last.get(chat_id, -1)
+            last[chat_id] = number
+    per_chat = {}
+    for at, chat_id, _ in bot.calls:
+        per_chat.setdefault(chat_id, []).append(at)
+    return SimpleNamespace(bot=bot, latencies=latencies, results=results, sent=sent, reordered=reordered,
+                           chat_peak=max(map(most_in_a_second, per_chat.values())),
+                           global_peak=most_in_a_second([at for at, _, _ in bot.calls]))
+
+
+def benchmark_outbox(seed, chats=40, seconds=20):
+    # Fails if edits of a chat arrive out of order, a coalesced edit loses to an older one, or a frame goes out
+    # while a direct response of its chat is queued
+    limits = RateLimitedBot(None)
+    failed = []
+    print(f"{chats} chats for {seconds} s against a Bot API allowing {limits.chat_rate:g}/s (burst {limits.chat_burst}) "
+          f"per chat and {limits.global_bucket.rate:g}/s (burst {limits.global_bucket.burst}) in all")
+    for label, scale in (('configured limits', 1), ('limits twice the API', 2)):
+        outbox = Outbox(chat_rate=limits.chat_rate * scale, chat_burst=limits.chat_burst * scale,
+                        global_rate=limits.global_bucket.rate * scale, global_burst=limits.global_bucket.burst * scale)
+        test = asyncio.run(run_outbox_test(outbox, chats, seconds, seed))
+        print(f"  {label}: {test.sent} requests sent in {len(test.bot.calls)} calls, {test.bot.rejected} RetryAfter, "
+              f"{', '.join(f'{name} {count}' for name, count in sorted(test.results.items()))}")
+        print(f"    at most {test.chat_peak} calls per chat and {test.global_peak} in all within a second "
+              f"(the API allows {limits.chat_burst + limits.chat_rate:g} and "
+              f"{limits.global_bucket.burst + limits.global_bucket.rate:g})")
+        print(f"    frames sent while a direct response of the chat was queued: {test.bot.frames_overtaking}, "
+              f"edits delivered out of order: {test.reordered}")
+        for name, values in test.latencies.items():
+            print(f"    {name:8} {format_percentiles(values)}")
+        if test.reordered or test.results['stale'] or test.bot.frames_overtaking:
+            failed.append(label)
+    if failed:
+        raise SystemExit(f"FAILED: edits out of order, stale or overtaken with {' and '.join(failed)}")
+
+
+class PvpLoadTest:
+    # Every player joins the lobby at a random moment of join_window, waits to be paired and fires whenever it is
+    # their turn. Some clicks arrive twice at once (double taps), and a share of abandon players stop clicking
+    # mid-match, so their matches end by the idle timeout. The run fails if a player who joined is never paired
+    # (but the odd one out) or a match ends with both fleets sunk
+    def __init__(self, players, seed, api_latency=0.0, join_window=1.0, abandon=0.02, match_timeout=5):
+        self.players = players
+        self.seed = seed
+        self.join_window = join_window
+        self.abandon = abandon
+        self.match_timeout = match_timeout
+        self.db = FakeDatabasePool()
+        self.bot = FakeBot(api_latency)
+        self.application = FakeApplication()
+        self.latencies = {}
+        self.waits = []
+        self.results = {}
+        self.matches = set()
+
+    async def click(self, name, player, data):
+        started = time.perf_counter()
+        await games_bot.handle_button(player.callback_update(data), player.context)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def play(self, player):
+        await asyncio.sleep(player.rng.random() * self.join_window)
+        await self.click('join', player, games_bot.callbacks.encode(ACTION_PVP_JOIN))
+        user_id = player.user.id
+        while (match := games_bot.matchmaker.get(user_id)) is None:
+            # A paired player leaves the lobby before get() has their match; in_match covers that gap
+            if not games_bot.matchmaker.is_waiting(user_id) and not games_bot.matchmaker.in_match(user_id):
+                self.results['unmatched'] = self.results.get('unmatched', 0) + 1
+                return
+            await asyncio.sleep(0.05)
+        self.matches.add(match)
+        index = match.index(user_id)
+        self.waits.append(match.waited[index])
+        target = match.games[1 - index].state
+        cells = [(x, y) for x in range(target.rows) for y in range(target.cols)]
+        player.rng.shuffle(cells)
+        leaves = player.rng.random() < self.abandon
+        while not match.over:
+            if match.turn != index:
+                await asyncio.sleep(0.05)
+                continue
+            if leaves and player.rng.random() < 0.1:
+                return
+            x, y = cells.pop()
+            data = games_bot.callbacks.encode(ACTION_PVP_FIRE, target.game_id, x, y, 0, 0)
+            if player.rng.random() < 0.1:
+                await asyncio.gather(self.click('fire', player, data), self.click('fire', player, data))
+            else:
+                await self.click('fire', player, data)
+
+    async def run(self):
+        random.seed(self.seed)
+        games_bot.db_pool = self.db
+        games_bot.media.path = None
+        games_bot.outbox = Outbox(chat_rate=1e9, chat_burst=1e9, global_rate=1e9, global_burst=1e9)
+        games_bot.matchmaker.match_timeout = self.match_timeout
+        games_bot.matchmaker.sweep_interval = self.match_timeout / 4
+        games_bot.matchmaker.start()
+
+        players = [Player(user_id, self.bot, self.application, random.Random(self.seed * 1000003 + user_id))
+                   for user_id in range(1, self.players + 1)]
+        started = time.perf_counter()
+        await asyncio.gather(*(self.play(player) for player in players))
+        # Matches of players who walked away end with the sweep
+        while games_bot.matchmaker.matches:
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        while games_bot.matchmaker.tasks:
+            await asyncio.sleep(0.01)
+        await games_bot.matchmaker.close()
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        for match in self.matches:
+            won = [game.state.is_won() for game in match.games]
+            outcome = 'won' if any(won) else 'timed out'
+            self.results[outcome] = self.results.get(outcome, 0) + 1
+            if all(won):
+                self.results['corrupted'] = self.results.get('corrupted', 0) + 1
+        shots = sum(bin(game.state.hits | game.state.misses).count('1') for match in self.matches for game in match.games)
+        clicks = len(self.latencies.get('fire', ()))
+        print(f"Players: {self.players}, matches: {len(self.matches)} in {elapsed:.2f} s, seed: {self.seed}")
+        print(f"Matches: {', '.join(f'{name} {count}' for name, count in sorted(self.results.items()))}")
+        print(f"Fire clicks: {clicks}, shots applied: {shots}, rejected (double taps): {clicks - shots}; "
+              f"Bot API calls: {self.bot.calls}")
+        print(f"  matchmaking  {format_percentiles(self.waits)}")
+        for name, values in sorted(self.latencies.items()):
+            print(f"  {name:11}  {format_percentiles(values)}")
+        if self.results.get('unmatched', 0) > self.players % 2 or self.results.get('corrupted'):
+            raise SystemExit(f"FAILED: {self.results.get('unmatched', 0)} players unmatched, "
+                             f"{self.results.get('corrupted', 0)} matches corrupted")
+
+
+def format_percentiles(values):
+    if not values:
+        return '-'
+    values = sorted(values)
+    pick = lambda q: values[min(int(len(values) * q), len(values) - 1)] * 1000
+    return f"p50 {pick(0.5):.3f} ms  p99 {pick(0.99):.3f} ms  max {values[-1] * 1000:.3f} ms"
+
+
+async def measure_db_pool(pooled, users, queries, seed):
+    # Users look their profile up at random moments while a 10 ms ticker measures how late the event loop runs.
+    # Unpooled is how every query ran before the pool: a fresh connection, on the event loop
+    rng = random.Random(seed)
+    latencies, lag = [], []
+    pool = games_bot.DatabasePool(5, 'loadtest')
+    pool_module, games_bot.pooling = games_bot.pooling, SimpleNamespace(MySQLConnectionPool=FakeConnectionPool)
+
+    async def direct(func, *args):
+        conn = FakeConnection()
+        try:
+            return func(conn, *args)
+        finally:
+            conn.close()
+
+    async def user(user_id):
+        for _ in range(queries):
+            await asyncio.sleep(rng.uniform(0, 0.5))
+            started = time.perf_counter()
+            await (pool.run if pooled else direct)(games_bot.fetch_user_info, user_id)
+            latencies.append(time.perf_counter() - started)
+
+    async def ticker(interval=0.01):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag.append(time.perf_counter() - started - interval)
+
+    monitor = asyncio.ensure_future(ticker())
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(user(user_id) for user_id in range(users)))
+    finally:
+        monitor.cancel()
+        pool.close()
+        games_bot.pooling = pool_module
+    return latencies, lag, time.perf_counter() - started
+
+
+def benchmark_db_pool(seed, users=200, queries=20):
+    print(f"{users} users, {queries} profile lookups each; connect {FakeConnection.connect_latency * 1000:.1f} ms, "
+          f"query {FakeConnection.query_latency * 1000:.1f} ms, ping {FakeConnection.ping_latency * 1000:.1f} ms")
+    for pooled in (False, True):
+        latencies, lag, elapsed = asyncio.run(measure_db_pool(pooled, users, queries, seed))
+        print(f"  {'pool + executor' if pooled else 'connect per query':18} {len(latencies) / elapsed:7.0f} queries/s")
+        print(f"    query     {format_percentiles(latencies)}")
+        print(f"    loop lag  {format_percentiles(lag)}")
+
+
+async def measure_allocations(seed, clicks=200):
+    # Sequential clicks of one player under tracemalloc: memory allocated at peak per click
+    test = LoadTest(1, 1, seed)
+    random.seed(seed)
+    games_bot.db_pool = test.db
+    games_bot.media.path = None
+    games_bot.writes.journal_path = None
+    games_bot.writes.start()
+    games_bot.game_store = GameStore(None, lambda game: game.to_bytes(), games_bot.GameLogic.from_bytes)
+    games_bot.outbox = Outbox(chat_rate=1e9, chat_burst=1e9, global_rate=1e9, global_burst=1e9)
+    player = Player(1, test.bot, test.application, random.Random(seed))
+    await games_bot.start(player.message_update('/start'), player.context)
+
+    peaks = {}
+    tracemalloc.start()
+    for click in range(clicks):
+        game = await games_bot.game_store.get(1)
+        if game.state.is_won():
+            await games_bot.handle_button(player.callback_update(games_bot.callbacks.encode(ACTION_NEW_GAME)), player.context)
+            continue
+        if click % 10 == 9:
+            action, data = 'leaderboard_show', games_bot.callbacks.encode(ACTION_LEADERBOARD_SHOW)
+        else:
+            action, data = 'fire', player.fire_data(game.state, player.rng.randrange(game.rows), player.rng.randrange(game.cols))
+        update = player.callback_update(data)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await games_bot.handle_button(update, player.context)
+        peaks.setdefault(action, []).append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    for task in list(test.application.tasks):
+        task.cancel()
+    await games_bot.writes.close()
+    for action, values in peaks.items():
+        print(f"Allocated at peak per {action} click: avg {sum(values) / len(values) / 1024:.1f} KiB, "
+              f"max {max(values) / 1024:.1f} KiB")
+
+
+def measure_game_allocations(seed, games=20):
+    # The board work of a fire click under tracemalloc: a GameLogic rebuilt from the stored state on every
+    # click, as handlers used to do, against the session kept in game_store. Reusing it must allocate less on
+    # every board mode
+    print(f"{'mode':10} {'rebuilt KiB':>12} {'reused KiB':>11}")
+    failed = []
+    tracemalloc.start()
+    for mode in games_bot.BOARD_MODES.values():
+        generator = games_bot.get_fleet_generator(mode.rows, mode.cols, mode.ships)
+        keyboards = games_bot.SeaFightKeyboardCache()
+        rng = random.Random(seed)
+        peaks = {'rebuilt': [], 'reused': []}
+        for _ in range(games):
+            layout = generator.generate(rng.getrandbits(64))
+            if layout is None:
+                continue
+            for way, values in peaks.items():
+                game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+                game.generate_board(mode.ships, seed=layout[0])
+                cells = [(x, y) for x in range(mode.rows) for y in range(mode.cols)]
+                random.Random(layout[0]).shuffle(cells)
+                for x, y in cells:
+                    current, _ = tracemalloc.get_traced_memory()
+                    tracemalloc.reset_peak()
+                    if way == 'rebuilt':
+                        game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP, game.state)
+                    game.fire(x, y)
+                    keyboards.get_rows(game.player_board, x - games_bot.VIEWPORT_ROWS // 2, y - games_bot.VIEWPORT_COLS // 2)
+                    values.append(tracemalloc.get_traced_memory()[1] - current)
+                    if game.check_if_won():
+                        break
+        rebuilt, reused = (sum(values) / len(values) for values in (peaks['rebuilt'], peaks['reused']))
+        print(f"{mode.name:10} {rebuilt / 1024:12.2f} {reused / 1024:11.2f}")
+        if reused >= rebuilt:
+            failed.append(mode.name)
+    tracemalloc.stop()
+    if failed:
+        raise SystemExit(f"FAILED: reusing the game allocates no less than rebuilding it on {', '.join(failed)}")
+
+
+def measure_game_memory(seed, games=100000, layouts=1000):
+    # games concurrent games of the default board, each with half its cells shot, kept the ways a game has been
+    # held: user_data with the board and the player's board as emoji lists, the GameLogic in game_store (its
+    # rendered board is kept once the game was clicked in this process), and the blob a game store backend saves
+    mode = games_bot.BOARD_MODES[games_bot.DEFAULT_BOARD_MODE]
+    generator = games_bot.get_fleet_generator(mode.rows, mode.cols, mode.ships)
+    rng = random.Random(seed)
+    fleets = [layout for layout in (generator.generate(rng.getrandbits(64)) for _ in range(layouts)) if layout]
+    cells = [(x, y) for x in range(mode.rows) for y in range(mode.cols)]
+
+    def new_game(user_id):
+        game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+        game.generate_board(mode.ships, layout=fleets[user_id % len(fleets)])
+        return game, random.Random(user_id).sample(cells, len(cells) // 2)
+
+    def user_data(user_id):
+        game, shots = new_game(user_id)
+        lists = ListGame(game.state)
+        for x, y in shots:
+            game.fire(x, y)
+            lists.fire(x, y)
+        return {'board': lists.board, 'player_board': lists.player_board, 'score': game.state.score}
+
+    def game_store(user_id, rendered=False):
+        game, shots = new_game(user_id)
+        if rendered:
+            game.player_board
+        for x, y in shots:
+            game.fire(x, y)
+        return [game, time.monotonic()]
+
+    def blob(user_id):
+        game, shots = new_game(user_id)
+        for x, y in shots:
+            game.fire(x, y)
+        return game.to_bytes()
+
+    print(f"{games} games of {mode.label}, half their cells shot; a saved game is {len(blob(0))} bytes")
+    print(f"{'kept as':36} {'MiB':>8} {'bytes/game':>11}")
+    for label, build in (('user_data emoji lists', user_data), ('game_store GameLogic', game_store),
+                         ('game_store GameLogic, board rendered', functools.partial(game_store, rendered=True)),
+                         ('saved blob', blob)):
+        tracemalloc.start()
+        kept = {user_id: build(user_id) for user_id in range(games)}
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{label:36} {size / 1024 / 1024:8.1f} {size / len(kept):11.0f}")
+        del kept
+
+
+class ListGame:
+    # A game as it was kept before the bitmask state: rows of emoji strings compared cell by cell, a walk from the
+    # cell for the sunk check and a scan of every cell for the win check, which a click ran before and after the shot
+    def __init__(self, state):
+        self.rows = state.rows
+        self.cols = state.cols
+        self.board = [[games_bot.SHIP if state.ships >> (x * state.cols + y) & 1 else games_bot.EMPTY
+                       for y in range(state.cols)] for x in range(state.rows)]
+        self.player_board = [[games_bot.EMPTY] * state.cols for _ in range(state.rows)]
+
+    def check_if_killed(self, x, y):
+        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            for i in range(max(self.rows, self.cols)):
+                nx, ny = x + dx * i, y + dy * i
+                if 0 <= nx < self.rows and 0 <= ny < self.cols and self.board[nx][ny] == games_bot.SHIP:
+                    return False
+                elif 0 <= nx < self.rows and 0 <= ny < self.cols and self.board[nx][ny] == games_bot.EMPTY:
+                    break
+        return True
+
+    def check_if_won(self):
+        return all(cell != games_bot.SHIP for row in self.board for cell in row)
+
+    def fire(self, x, y):
+        if self.board[x][y] == games_bot.SHIP:
+            self.board[x][y] = self.player_board[x][y] = games_bot.BANG
+            return games_bot.SHOT_SUNK if self.check_if_killed(x, y) else games_bot.SHOT_HIT
+        if self.board[x][y] == games_bot.EMPTY:
+            # Only the board shown to the player marked misses
+            self.player_board[x][y] = games_bot.MISS
+            return games_bot.SHOT_MISS
+        return None
+
+
+def benchmark_shots(seed, games=200):
+    # The game work of a fire click, without rendering: win check, shot, sunk check, win check. Both engines
+    # play the same fleets with the same shots, and must agree on every result
+    print(f"{'mode':10} {'size':>7} {'lists shots/s':>14} {'bitmask shots/s':>16} {'speedup':>8}")
+    for mode in games_bot.BOARD_MODES.values():
+        generator = games_bot.get_fleet_generator(mode.rows, mode.cols, mode.ships)
+        rng = random.Random(seed)
+        elapsed = {'lists': 0.0, 'bitmask': 0.0}
+        shots = 0
+        for _ in range(games):
+            layout = generator.generate(rng.getrandbits(64))
+            if layout is None:
+                continue
+            game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+            game.generate_board(mode.ships, layout=layout)
+            lists = ListGame(game.state)
+            cells = [(x, y) for x in range(mode.rows) for y in range(mode.cols)]
+            rng.shuffle(cells)
+            results = {}
+            started = time.perf_counter()
+            for x, y in cells:
+                if lists.check_if_won():
+                    break
+                results[x, y] = lists.fire(x, y)
+                lists.check_if_won()
+            elapsed['lists'] += time.perf_counter() - started
+            started = time.perf_counter()
+            for x, y in cells:
+                if game.check_if_won():
+                    break
+                result = game.fire(x, y)
+                game.check_if_killed(x, y)
+                game.check_if_won()
+                assert result == results[x, y]
+            elapsed['bitmask'] += time.perf_counter() - started
+            shots += len(results)
+        print(f"{mode.name:10} {mode.label:>7} {shots / elapsed['lists']:14.0f} {shots / elapsed['bitmask']:16.0f} "
+              f"{elapsed['lists'] / elapsed['bitmask']:7.1f}x")
+
+
+def benchmark_ranks(seed, rows=1000000, users=500000, submissions=200):
+    # Submissions against a leaderboard of rows entries, the way they used to go to MySQL (INSERT, commit and
+    # SELECT COUNT(*) + 1 of the higher scores, ORDER BY score LIMIT 100 for every page shown; SQLite in memory
+    # stands in for it, with and without an index on score) and through the in-memory windows
+    rng = random.Random(seed)
+    history = [(rng.randrange(users), rng.randrange(600)) for _ in range(rows)]
+    scores = [(rng.randrange(users), rng.randrange(600)) for _ in range(submissions)]
+    print(f"{rows} leaderboard rows of {users} users, {submissions} submissions")
+
+    def report(label, submit, rank, top):
+        print(f"  {label}")
+        for name, values in (('submission', submit), ('rank', rank), ('top 100', top)):
+            print(f"    {name:11} {format_percentiles(values)}")
+
+    for indexed in (False, True):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE gamebot_leaderboard (id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT, '
+                     'score INTEGER, date TEXT DEFAULT CURRENT_TIMESTAMP)')
+        if indexed:
+            conn.execute('CREATE INDEX score ON gamebot_leaderboard (score)')
+        conn.executemany('INSERT INTO gamebot_leaderboard (user_id, name, score) VALUES (?, ?, ?)',
+                         ((user_id, 'Player', score) for user_id, score in history))
+        conn.commit()
+        submit, rank, top = [], [], []
+        for user_id, score in scores:
+            started = time.perf_counter()
+            conn.execute('INSERT INTO gamebot_leaderboard (user_id, name, score) VALUES (?, ?, ?)',
+                         (user_id, 'Player', score))
+            conn.commit()
+            ranked = time.perf_counter()
+            conn.execute('SELECT COUNT(*) + 1 FROM gamebot_leaderboard WHERE score > ?', (score,)).fetchone()
+            rank.append(time.perf_counter() - ranked)
+            submit.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            conn.execute('SELECT user_id, name, score, date FROM gamebot_leaderboard ORDER BY score DESC LIMIT 100').fetchall()
+            top.append(time.perf_counter() - started)
+        conn.close()
+        report('SQL, score indexed' if indexed else 'SQL, no index', submit, rank, top)
+
+    async def load_rows(top_size, starts):
+        best = {}
+        for user_id, score in history:
+            if score > best.get(user_id, -1):
+                best[user_id] = score
+        top = [{'user_id': user_id, 'name': 'Player', 'score': score, 'date': None}
+               for user_id, score in sorted(best.items(), key=lambda item: -item[1])[:top_size]]
+        return {period: (top, list(best.items())) for period in starts}
+
+    writer = SimpleNamespace(put=lambda kind, row: None, pending_rows=lambda kind: [])
+    leaderboard = Leaderboard(load_rows, writer, periods=('all',))
+    started = time.perf_counter()
+    asyncio.run(leaderboard.load())
+    loaded = time.perf_counter() - started
+    submit, rank, top = [], [], []
+    for user_id, score in scores:
+        started = time.perf_counter()
+        leaderboard.add(user_id, 'Player', score)
+        submit.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        leaderboard.user_position(user_id)
+        rank.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        leaderboard.top()
+        top.append(time.perf_counter() - started)
+    report(f"windows, loaded in {loaded:.1f} s", submit, rank, top)
+
+
+def benchmark_messages(seed, renders=200000):
+    # The texts and markups a click renders, looked up and filled the way bot_messages used to (a fallback
+    # chain per lookup, str.replace per argument over the whole template, the main keyboard built per message)
+    # against the compiled catalog and the keyboards rendered at import
+    def legacy_translation(language_code, key):
+        return bot_messages.translations.get(language_code, bot_messages.translations.get('en', {})).get(key, key)
+
+    def legacy_placeholders(template, *args):
+        for i, value in enumerate(args, start=1):
+            template = template.replace(f"%{i}", str(value))
+        return template
+
+    def legacy_time(language_code, time):
+        days, remainder = divmod(time, 86400)
+        hours, remainder = divmod(remainder, 3600)
+        minutes, _ = divmod(remainder, 60)
+        names = bot_messages.time_translations
+        time_str = ""
+        if days > 0:
+            time_str += f"{days} {names.get(language_code, names.get('en', {})).get('days', 'days')} "
+        if hours > 0:
+            time_str += f"{hours} {names.get(language_code, names.get('en', {})).get('hours', 'hours')} "
+        if minutes > 0:
+            time_str += f"{minutes} {names.get(language_code, names.get('en', {})).get('minutes', 'minutes')}"
+        return time_str
+
+    def legacy_main_keyboard(language_code):
+        games_bot.main_keyboards.pop(games_bot.resolve_language(language_code), None)
+        return games_bot.keyboard_builder.create_main_keyboard(language_code)
+
+    rng = random.Random(seed)
+    # de has no catalog of its own and falls back to the default language
+    languages = [rng.choice(['en', 'ru', 'de']) for _ in range(renders)]
+    keys = [rng.choice(list(bot_messages.translations['en'])) for _ in range(renders)]
+    numbers = [rng.randrange(1000000) for _ in range(renders)]
+    cases = {
+        'lookup': (lambda i: legacy_translation(languages[i], keys[i]),
+                   lambda i: bot_messages.get_translation(languages[i], keys[i])),
+        'template': (lambda i: legacy_placeholders(legacy_translation(languages[i], 'text_leaderboard_added'),
+                                                   'Player', numbers[i] % 1000, numbers[i] % 600),
+                     lambda i: bot_messages.format_translation(languages[i], 'text_leaderboard_added',
+                                                               'Player', numbers[i] % 1000, numbers[i] % 600)),
+        'time': (lambda i: legacy_time(languages[i], numbers[i]),
+                 lambda i: bot_messages.get_time_translation(languages[i], numbers[i])),
+        'main keyboard': (lambda i: legacy_main_keyboard(languages[i]),
+                          lambda i: games_bot.keyboard_builder.create_main_keyboard(languages[i])),
+    }
+    print(f"{'render':14} {'before/s':>11} {'now/s':>11} {'speedup':>8}")
+    for name, (before, now) in cases.items():
+        for i in range(min(renders, 1000)):
+            assert before(i) == now(i) or name == 'main keyboard'
+        elapsed = []
+        for render in (before, now):
+            started = time.perf_counter()
+            for i in range(renders):
+                render(i)
+            elapsed.append(time.perf_counter() - started)
+        print(f"{name:14} {renders / elapsed[0]:11.0f} {renders / elapsed[1]:11.0f} {elapsed[0] / elapsed[1]:7.1f}x")
+def benchmark_boards(seed, games=50):
+    print(f"{'mode':10} {'size':>7} {'generate p50/p99 ms':>20} {'shot p50 us':>12} {'render p50/p99 ms':>18} {'bytes':>6}")
+    for mode in games_bot.BOARD_MODES.values():
+        generator = games_bot.get_fleet_generator(mode.rows, mode.cols, mode.ships)
+        keyboards = games_bot.SeaFightKeyboardCache()
+        rng = random.Random(seed)
+        generate, shots, render = [], [], []
+        size = 0
+        for _ in range(games):
+            started = time.perf_counter()
+            layout = generator.generate(rng.getrandbits(64))
+            generate.append(time.perf_counter() - started)
+            if layout is None:
+                continue
+            game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+            game.generate_board(mode.ships, seed=layout[0])
+            size = len(game.state.to_bytes())
+            cells = [(x, y) for x in range(mode.rows) for y in range(mode.cols)]
+            rng.shuffle(cells)
+            for x, y in cells:
+                # The same work as a fire click: the shot, then the page around it
+                started = time.perf_counter()
+                game.fire(x, y)
+                shots.append(time.perf_counter() - started)
+                keyboards.get_rows(game.player_board, x - games_bot.VIEWPORT_ROWS // 2, y - games_bot.VIEWPORT_COLS // 2)
+                render.append(time.perf_counter() - started - shots[-1])
+                if game.check_if_won():
+                    break
+        pick = lambda values, q: sorted(values)[min(int(len(values) * q), len(values) - 1)]
+        print(f"{mode.name:10} {mode.label:>7} {pick(generate, 0.5) * 1000:9.3f} / {pick(generate, 0.99) * 1000:8.3f} "
+              f"{pick(shots, 0.5) * 1e6:12.2f} {pick(render, 0.5) * 1000:8.3f} / {pick(render, 0.99) * 1000:7.3f} {size:6}")
+
+
+def benchmark_layouts(seed, layouts=500):
+    # Fleet generation under the step budget: single seeds as a seeded game gets them, and unseeded calls that
+    # try several seeds as the layout pools do. dense8 doesn't fit at all; dense10 only fits after long searches
+    modes = [(mode.name, mode.rows, mode.cols, mode.ships) for mode in games_bot.BOARD_MODES.values()]
+    modes += [('dense8', 8, 8, [4, 4, 3, 3, 3, 2, 2, 2, 1, 1, 1, 1]),
+              ('dense10', 10, 10, [4, 4, 3, 3, 3, 3, 2, 2, 2, 2, 1, 1, 1, 1])]
+    pick = lambda values, q: sorted(values)[min(int(len(values) * q), len(values) - 1)]
+    print(f"{'mode':10} {'seeded/s':>9} {'failed':>7} {'unseeded/s':>11} {'failed':>7} {'p99/max ms':>16}")
+    for name, rows, cols, ships in modes:
+        generator = games_bot.FleetGenerator(rows, cols, ships)
+        rng = random.Random(seed)
+        seeded_failed = 0
+        started = time.perf_counter()
+        for _ in range(layouts):
+            seeded_failed += generator.generate(rng.getrandbits(64)) is None
+        seeded = time.perf_counter() - started
+        random.seed(seed)
+        unseeded_failed = 0
+        samples = []
+        for _ in range(layouts):
+            started = time.perf_counter()
+            unseeded_failed += generator.generate() is None
+            samples.append(time.perf_counter() - started)
+        print(f"{name:10} {layouts / seeded:9.0f} {seeded_failed / layouts:7.1%} {layouts / sum(samples):11.0f} "
+              f"{unseeded_failed / layouts:7.1%} {pick(samples, 0.99) * 1000:7.2f} / {max(samples) * 1000:6.2f}")
+
+
+def benchmark_leaderboard(seed, entries=10000000, users=500000, days=28):
+    # A history of entries spread over days, added one by one to the windows (as wins arrive), against
+    # ranking it from the entries: one pass grouping all of them, what every reload used to do
+    def history():
+        rng = random.Random(seed)
+        per_day = max(entries // days, 1)
+        for i in range(entries):
+            yield min(i // per_day, days - 1), rng.randrange(users), rng.randrange(600)
+
+    first_day = date(2026, 1, 5)
+    today = [first_day]
+    writer = SimpleNamespace(put=lambda kind, row: None, pending_rows=lambda kind: [])
+    leaderboard = Leaderboard(None, writer)
+    leaderboard.today = lambda: today[0]
+    samples, rollovers = [], []
+    current_day = 0
+    started = time.perf_counter()
+    for i, (day, user_id, score) in enumerate(history()):
+        if day != current_day:
+            current_day = day
+            today[0] = first_day + timedelta(days=day)
+            rolled = time.perf_counter()
+            for period in ('day', 'week'):
+                leaderboard.window(period)
+            rollovers.append(time.perf_counter() - rolled)
+        if i % 100:
+            leaderboard.add(user_id, 'Player', score)
+        else:
+            added = time.perf_counter()
+            leaderboard.add(user_id, 'Player', score)
+            samples.append(time.perf_counter() - added)
+    incremental = time.perf_counter() - started
+
+    started = time.perf_counter()
+    best = {}
+    for day, user_id, score in history():
+        if score > best.get(user_id, -1):
+            best[user_id] = score
+    counts = {}
+    for score in best.values():
+        counts[score] = counts.get(score, 0) + 1
+    top = sorted(best.values(), reverse=True)[:100]
+    recompute = time.perf_counter() - started
+
+    window = leaderboard.window('all')
+    assert [entry['score'] for entry in window.top_entries] == top
+    assert all(window.user_position(user_id) == (sum(count for other, count in counts.items() if other > score) + 1, score)
+               for user_id, score in itertools.islice(best.items(), 100))
+    pick = lambda values, q: sorted(values)[min(int(len(values) * q), len(values) - 1)]
+    print(f"{entries} entries, {len(best)} users, {days} days")
+    print(f"  incremental: {incremental:.1f} s in total, add p50 {pick(samples, 0.5) * 1e6:.2f} us "
+          f"p99 {pick(samples, 0.99) * 1e6:.2f} us, rollover max {max(rollovers or [0]) * 1e6:.1f} us")
+    print(f"  recompute from entries: {recompute:.1f} s for the all-time board alone")
+    print("  rows per user: " + ', '.join(f"{period} {len(leaderboard.window(period).best)}"
+                                          for period in leaderboard.windows))
+
+
+def benchmark_callbacks(seed, clicks=100000):
+    rng = random.Random(seed)
+    codec = games_bot.callbacks
+    data = [codec.encode(ACTION_FIRE, rng.getrandbits(32), rng.randrange(8), rng.randrange(8), 0, 0) for _ in range(clicks)]
+    legacy = [f'fire_{rng.randrange(8)}_{rng.randrange(8)}' for _ in range(clicks)]
+    forged = [item[:-2] + ('AA' if item[-2:] != 'AA' else 'BB') for item in data]
+
+    def decode_and_dispatch():
+        for item in data:
+            action, game_id, args = codec.decode(item)
+            games_bot.button_handlers[action]
+
+    def reject_forged():
+        for item in forged:
+            codec.decode(item)
+
+    def split_and_parse():
+        # What handle_button did before: split, compare the prefix, int() the coordinates
+        for item in legacy:
+            parts = item.split('_')
+            if parts[0] == 'fire':
+                int(parts[1]), int(parts[2])
+
+    print(f"callback_data: {len(data[0])} chars for a fire button")
+    for name, func in (('encode', lambda: [codec.encode(ACTION_FIRE, 1, 2, 3, 0, 0) for _ in range(clicks)]),
+                       ('decode + dispatch', decode_and_dispatch), ('reject forged', reject_forged),
+                       ('old split + int', split_and_parse)):
+        started = time.perf_counter()
+        func()
+        print(f"  {name:18} {(time.perf_counter() - started) / clicks * 1e6:.2f} us per click")
+
+
+def benchmark_ai(seed, games=100, max_moves=20000):
+    print(f"{'mode':10} {'size':>7} {'move p50/p99 ms':>16} {'moves/s':>8} {'shots to win':>13} {'random fire':>12}")
+    for mode in games_bot.BOARD_MODES.values():
+        generator = games_bot.get_fleet_generator(mode.rows, mode.cols, mode.ships)
+        engine = get_targeting_engine(generator)
+        rng = random.Random(seed)
+        moves, shots, baseline = [], [], []
+        for _ in range(games):
+            layout = generator.generate(rng.getrandbits(64))
+            if layout is None:
+                continue
+            game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+            game.generate_board(mode.ships, seed=layout[0])
+            state = game.state
+            while not state.is_won():
+                started = time.perf_counter()
+                x, y = engine.next_shot(state, rng)
+                moves.append(time.perf_counter() - started)
+                state.fire(x, y)
+            shots.append(bin(state.hits | state.misses).count('1'))
+
+            # The same fleet against shots in random order
+            game = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+            game.generate_board(mode.ships, seed=layout[0])
+            state = game.state
+            cells = [(x, y) for x in range(mode.rows) for y in range(mode.cols)]
+            rng.shuffle(cells)
+            for count, (x, y) in enumerate(cells, 1):
+                state.fire(x, y)
+                if state.is_won():
+                    baseline.append(count)
+                    break
+            if len(moves) > max_moves:
+                break
+        pick = lambda values, q: sorted(values)[min(int(len(values) * q), len(values) - 1)]
+        print(f"{mode.name:10} {mode.label:>7} {pick(moves, 0.5) * 1000:7.3f} / {pick(moves, 0.99) * 1000:6.3f} "
+              f"{len(moves) / sum(moves):8.0f} {sum(shots) / len(shots):13.1f} {sum(baseline) / len(baseline):12.1f}")
+
+
+worker_games = {}
+
+
+def build_worker_application(api_port):
+    # What a worker runs in the --workers test: the bot's update processor and a click handler that does the board
+    # work of a fire click, then reports the click number back to the fake API as the text of an edit
+    from telegram.ext import Application, CallbackQueryHandler
+    application = (Application.builder().token('1:loadtest').base_url(f'http://127.0.0.1:{api_port}/bot')
+                   .concurrent_updates(UserOrderedUpdateProcessor(256)).updater(None).build())
+    application.add_handler(CallbackQueryHandler(worker_click))
+    return application
+
+
+async def worker_click(update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    game = worker_games.get(user_id)
+    if game is None or game.check_if_won():
+        mode = games_bot.BOARD_MODES[games_bot.DEFAULT_BOARD_MODE]
+        game = worker_games[user_id] = games_bot.GameLogic(mode.rows, mode.cols, games_bot.EMPTY, games_bot.SHIP)
+        game.generate_board(mode.ships)
+    state = game.state
+    x, y = random.choice([(x, y) for x in range(state.rows) for y in range(state.cols) if not state.is_shot(x, y)])
+    game.fire(x, y)
+    games_bot.sea_fight_keyboards.get_rows(game.player_board)
+    await context.bot.edit_message_text(query.data, chat_id=user_id, message_id=query.message.message_id)
+
+
+async def run_workers_test(workers, users, clicks, kill, api_port=8091, port=8092, idle_timeout=5):
+    from aiohttp import ClientSession, web
+    from bot_replay import FakeBotApi
+
+    class OrderedBotApi(FakeBotApi):
+        # Each edit carries the number of the click it answers: per chat the numbers must only go up
+        def __init__(self):
+            super().__init__()
+            self.last = {}
+            self.edits = self.reordered = self.skipped = 0
+
+        def keep_keyboard(self, chat_id, message_id, text, markup):
+            number, last = int(text), self.last.get(chat_id, -1)
+            self.reordered += number <= last
+            self.skipped += number > last + 1
+            self.last[chat_id] = max(number, last)
+            self.edits += 1
+
+    api = OrderedBotApi()
+    app = web.Application()
+    app.router.add_post('/{token}/{method}', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', api_port).start()
+    server = RoutingWebhookServer(worker_starter(functools.partial(build_worker_application, api_port), 5), workers,
+                                  restart_interval=1, listen='127.0.0.1', port=port, max_pending=100000)
+    await server.start()
+    url = f'http://127.0.0.1:{port}/telegram'
+    rejected = sent = 0
+    try:
+        # Every worker calls getMe once it is up
+        while api.calls < workers:
+            await asyncio.sleep(0.05)
+        update_ids = itertools.count(1)
+
+        async def player(session, user_id):
+            nonlocal rejected, sent
+            user = {'id': user_id, 'is_bot': False, 'first_name': f'Player{user_id}'}
+            for number in range(clicks):
+                update_id = next(update_ids)
+                update = {'update_id': update_id, 'callback_query': {
+                    'id': str(update_id), 'chat_instance': str(user_id), 'from': user, 'data': str(number),
+                    'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}}}}
+                # Like Telegram, an update answered with an error is delivered again
+                while True:
+                    async with session.post(url, json=update) as response:
+                        if response.status == 200:
+                            sent += 1
+                            break
+                    rejected += 1
+                    await asyncio.sleep(0.1)
+
+        async def kill_one():
+            # Updates already queued for it are lost; the ones after go to the worker started in its place
+            while sent < users * clicks // 2:
+                await asyncio.sleep(0.01)
+            server.workers[0][1].kill()
+
+        started = time.perf_counter()
+        killer = asyncio.ensure_future(kill_one()) if kill else None
+        async with ClientSession() as session:
+            await asyncio.gather(*(player(session, user_id) for user_id in range(1, users + 1)))
+        # Done once every click is answered, or nothing more arrived for idle_timeout
+        last_edits, last_change = api.edits, time.perf_counter()
+        while api.edits < users * clicks and time.perf_counter() - last_change < idle_timeout:
+            await asyncio.sleep(0.05)
+            if api.edits != last_edits:
+                last_edits, last_change = api.edits, time.perf_counter()
+        elapsed = (last_change if api.edits < users * clicks else time.perf_counter()) - started
+        if killer:
+            killer.cancel()
+    finally:
+        await server.stop()
+        await stop_workers(server, 10)
+        await runner.cleanup()
+    return api, rejected, elapsed
+
+
+def benchmark_workers(counts, users, clicks=50, kill=False):
+    # Fails if a user's clicks were answered out of order, or were lost without a worker being killed
+    total = users * clicks
+    print(f"{users} users, {clicks} clicks each")
+    print(f"{'workers':>7} {'answered':>9} {'seconds':>8} {'clicks/s':>9} {'reordered':>9} {'lost':>5} {'503':>5}")
+    failed = []
+    for workers in counts:
+        api, rejected, elapsed = asyncio.run(run_workers_test(workers, users, clicks, kill))
+        print(f"{workers:7} {api.edits:9} {elapsed:8.2f} {api.edits / elapsed:9.0f} {api.reordered:9} "
+              f"{total - api.edits:5} {rejected:5}")
+        if api.reordered or (total - api.edits and not kill):
+            failed.append(workers)
+    if failed:
+        raise SystemExit(f"FAILED: clicks reordered or lost with {', '.join(map(str, failed))} workers")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the game handlers")
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--games', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db-latency', type=float, default=0.0, help="simulated seconds per DB job")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="simulated seconds per Bot API call")
+    parser.add_argument('--messages', action='store_true', help="benchmark message rendering instead")
+    parser.add_argument('--db-pool', action='store_true', help="benchmark DatabasePool against a connection per query instead")
+    parser.add_argument('--animations', action='store_true', help="fire only at ships, with and without the "
+                                                                  "sunk-ship animations, instead")
+    parser.add_argument('--shots', action='store_true', help="benchmark shots of the game state instead")
+    parser.add_argument('--ranks', action='store_true', help="benchmark ranks of 1M leaderboard rows instead")
+    parser.add_argument('--game-memory', action='store_true', help="measure memory of 100k concurrent games instead")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the configured outbox rate limits")
+    parser.add_argument('--outbox', action='store_true', help="run the outbox against a rate limited fake Bot API instead")
+    parser.add_argument('--callbacks', action='store_true', help="benchmark callback_data decoding instead")
+    parser.add_argument('--boards', action='store_true', help="benchmark every board mode instead")
+    parser.add_argument('--leaderboard', action='store_true', help="benchmark leaderboard windows instead")
+    parser.add_argument('--ai', action='store_true', help="benchmark the vs-bot targeting instead")
+    parser.add_argument('--pvp', action='store_true', help="simulate PvP matches of --players instead")
+    parser.add_argument('--record', help="write the games to this game log")
+    parser.add_argument('--gamelog', nargs='+', help="play back won games of the default board from these game logs")
+    parser.add_argument('--entries', type=int, default=10000000, help="score history size for --leaderboard")
+    parser.add_argument('--tracemalloc', action='store_true', help="measure allocations per click instead")
+    parser.add_argument('--workers', type=int, nargs='+', help="run webhook updates of --players through this many "
+                                                               "worker processes instead")
+    parser.add_argument('--kill-worker', action='store_true', help="with --workers, kill a worker halfway")
+    args = parser.parse_args()
+
+    if args.workers:
+        benchmark_workers(args.workers, args.players, kill=args.kill_worker)
+    elif args.messages:
+        benchmark_messages(args.seed)
+    elif args.db_pool:
+        benchmark_db_pool(args.seed)
+    elif args.animations:
+        benchmark_animations(args.players, args.seed, args.api_latency, args.rate_limits)
+    elif args.shots:
+        benchmark_shots(args.seed)
+    elif args.ranks:
+        benchmark_ranks(args.seed)
+    elif args.game_memory:
+        measure_game_memory(args.seed)
+    elif args.outbox:
+        benchmark_outbox(args.seed)
+    elif args.callbacks:
+        benchmark_callbacks(args.seed)
+    elif args.pvp:
+        asyncio.run(PvpLoadTest(args.players, args.seed, args.api_latency).run())
+    elif args.ai:
+        benchmark_ai(args.seed)
+    elif args.leaderboard:
+        benchmark_leaderboard(args.seed, args.entries)
+    elif args.boards:
+        benchmark_boards(args.seed)
+        print()
+        benchmark_layouts(args.seed)
+    elif args.tracemalloc:
+        asyncio.run(measure_allocations(args.seed))
+        measure_game_allocations(args.seed)
+    else:
+        mode = games_bot.BOARD_MODES[games_bot.DEFAULT_BOARD_MODE]
+        records = [record for record in iter_records(args.gamelog or ())
+                   if record.finished and not record.partial and (record.rows, record.cols) == (mode.rows, mode.cols)]
+        asyncio.run(LoadTest(args.players, args.games, args.seed, args.db_latency, args.api_latency, args.rate_limits,
+                             args.record, records).run())
+
+
+if __name__ == '__main__':
+    main()
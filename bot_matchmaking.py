@@ -0,0 +1,166 @@
+# bot_matchmaking.py
+
+import asyncio
+import itertools
+import time
+
+from bot_metrics import metrics
+
+
+class Match:
+    # Two players and their fleets: games[i] is player i's fleet, the one the other player fires at, and
+    # turn is the index of the player who shoots next. Clicks of both players change the match only under lock
+    __slots__ = ('match_id', 'mode', 'players', 'info', 'games', 'turn', 'lock', 'updated', 'waited', 'over')
+
+    def __init__(self, match_id, mode, players, info, games, waited):
+        self.match_id = match_id
+        self.mode = mode
+        self.players = players
+        self.info = info
+        self.games = games
+        self.turn = 0
+        self.lock = asyncio.Lock()
+        self.updated = time.monotonic()
+        self.waited = waited
+        self.over = False
+
+    def index(self, user_id):
+        return self.players.index(user_id)
+
+    def touch(self):
+        self.updated = time.monotonic()
+
+
+class Matchmaker:
+    # join() puts a player in the lobby queue and returns at once. The run loop pairs waiting players of the same
+    # board mode in the order they joined, builds their fleets with await create_games(mode) and hands the match
+    # to on_match(match). The sweep loop ends matches nobody moved in for match_timeout with on_timeout(match) and
+    # sends players who waited longer than lobby_timeout back with on_unmatched(user_id, info).
+    # Matches live in this process only: both players must reach the same one (workers route by user id)
+    def __init__(self, create_games, on_match, on_timeout, on_unmatched, match_timeout=300, lobby_timeout=120,
+                 sweep_interval=10):
+        self.create_games = create_games
+        self.on_match = on_match
+        self.on_timeout = on_timeout
+        self.on_unmatched = on_unmatched
+        self.match_timeout = match_timeout
+        self.lobby_timeout = lobby_timeout
+        self.sweep_interval = sweep_interval
+        self.waiting = {}
+        self.open = {}
+        self.matches = {}
+        # Paired players whose fleets are being built
+        self.pairing = set()
+        self.match_ids = itertools.count(1)
+        self.queue = None
+        self.tasks = set()
+        self.task = None
+        self.sweeper = None
+
+    def get(self, user_id):
+        return self.matches.get(user_id)
+
+    def is_waiting(self, user_id):
+        return user_id in self.waiting
+
+    def in_match(self, user_id):
+        return user_id in self.matches or user_id in self.pairing
+
+    def join(self, user_id, mode, info=None):
+        # False when the player is already in a match; joining again only refreshes the lobby entry
+        if self.in_match(user_id):
+            return False
+        self.leave(user_id)
+        self.waiting[user_id] = (mode, time.monotonic(), info)
+        self.queue.put_nowait((user_id, mode))
+        return True
+
+    def leave(self, user_id):
+        entry = self.waiting.pop(user_id, None)
+        if entry is not None and self.open.get(entry[0]) == user_id:
+            del self.open[entry[0]]
+        return entry
+
+    def finish(self, match):
+        match.over = True
+        for user_id in match.players:
+            if self.matches.get(user_id) is match:
+                del self.matches[user_id]
+
+    def spawn(self, coroutine):
+        # Pushes to players run on their own, so a slow send never holds up pairing
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            metrics.log('pvp_task_failed', error=str(task.exception()))
+
+    def pair(self, mode, first, second):
+        # Both leave the lobby at once; the match starts once their fleets are built
+        now = time.monotonic()
+        entries = (self.leave(first), self.leave(second))
+        self.pairing.update((first, second))
+        self.spawn(self.start_match(mode, (first, second), entries, now))
+
+    async def start_match(self, mode, players, entries, now):
+        try:
+            games = await self.create_games(mode)
+        except Exception as e:
+            metrics.log('pvp_pairing_failed', players=players, mode=mode, error=str(e))
+            games = None
+        finally:
+            self.pairing.difference_update(players)
+        if games is None:
+            for user_id, entry in zip(players, entries):
+                self.spawn(self.on_unmatched(user_id, entry[2]))
+            return
+        waited = tuple(now - entry[1] for entry in entries)
+        for seconds in waited:
+            metrics.observe('matchmaking_seconds', seconds)
+        match = Match(next(self.match_ids), mode, players, tuple(entry[2] for entry in entries), games, waited)
+        for user_id in players:
+            self.matches[user_id] = match
+        await self.on_match(match)
+
+    async def run(self):
+        while True:
+            user_id, mode = await self.queue.get()
+            entry = self.waiting.get(user_id)
+            if entry is None or entry[0] != mode:
+                # Left the lobby, or joined again with another board
+                continue
+            other = self.open.get(mode)
+            if other is None or other == user_id or other not in self.waiting:
+                self.open[mode] = user_id
+                continue
+            del self.open[mode]
+            self.pair(mode, other, user_id)
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = time.monotonic()
+            for user_id in [user_id for user_id, entry in self.waiting.items() if now - entry[1] > self.lobby_timeout]:
+                self.spawn(self.on_unmatched(user_id, self.leave(user_id)[2]))
+            # A match whose lock is taken is being played right now
+            idle = {match for match in self.matches.values()
+                    if now - match.updated > self.match_timeout and not match.lock.locked()}
+            for match in idle:
+                self.finish(match)
+                metrics.inc('matches_timed_out_total')
+                self.spawn(self.on_timeout(match))
+
+    def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+            self.sweeper = asyncio.get_running_loop().create_task(self.sweep())
+
+    async def close(self):
+        for task in [self.task, self.sweeper, *self.tasks]:
+            if task:
+                task.cancel()
+        self.task = self.sweeper = None
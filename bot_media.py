@@ -0,0 +1,90 @@
+# bot_media.py
+
+import asyncio
+import hashlib
+import json
+import os
+
+from telegram.error import BadRequest
+
+from bot_metrics import metrics
+
+
+class MediaAsset:
+    __slots__ = ('name', 'filename', 'data', 'digest')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.filename = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.digest = hashlib.sha1(self.data).hexdigest()
+
+
+class MediaCache:
+    # Static files are read into memory once and uploaded to Telegram once; later sends reuse
+    # the file_id Telegram returned, which is persisted so restarts don't upload again
+    def __init__(self, path):
+        self.path = path
+        self.assets = {}
+        self.file_ids = {}
+        self.locks = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.file_ids = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error while reading media cache: {e}")
+
+    def register(self, name, path):
+        self.assets[name] = MediaAsset(name, path)
+
+    def key(self, bot, asset):
+        # file_ids are only valid for the bot that uploaded them, and a changed file needs a new upload
+        return f'{bot.id}:{asset.name}:{asset.digest}'
+
+    def save_sync(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.file_ids, f)
+        os.replace(temp_path, self.path)
+
+    async def save(self):
+        if self.path:
+            await asyncio.get_running_loop().run_in_executor(None, self.save_sync)
+
+    async def send(self, outbox, bot, method, name, **kwargs):
+        # method is a send_<media> call, e.g. send_photo; the asset goes into its <media> argument
+        media = method[len('send_'):]
+        asset = self.assets[name]
+        key = self.key(bot, asset)
+
+        file_id = self.file_ids.get(key)
+        if file_id is not None:
+            try:
+                return await outbox.send(bot, method, **kwargs, **{media: file_id})
+            except BadRequest as e:
+                # "Wrong file identifier" and the like: Telegram no longer knows it, upload again below
+                if 'file' not in str(e).lower():
+                    raise
+                if self.file_ids.get(key) == file_id:
+                    del self.file_ids[key]
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self.file_ids.get(key)
+            if file_id is not None:
+                return await outbox.send(bot, method, **kwargs, **{media: file_id})
+            message = await outbox.send(bot, method, **kwargs, **{media: asset.data}, filename=asset.filename)
+            metrics.inc('media_uploads_total', asset=name)
+            uploaded = getattr(message, media, None)
+            if isinstance(uploaded, (list, tuple)):
+                # Photos come back in several sizes, the largest is the original
+                uploaded = uploaded[-1] if uploaded else None
+            if uploaded is not None:
+                self.file_ids[key] = uploaded.file_id
+                try:
+                    await self.save()
+                except OSError as e:
+                    print(f"Error while saving media cache: {e}")
+            return message
@@ -1,38 +1,59 @@
 # bot_messages.py
 
-def get_time_translation(language_code, time): #time_diff.seconds
-    time_translations = {
-        'en': {
-            "days": "days",
-            "hours": "hours",
-            "minutes": "minutes",
-        },
-        'ru': {
-            "days": "дней",
-            "hours": "часов",
-            "minutes": "минут",
-        }
+import re
+import sys
+
+DEFAULT_LANGUAGE = 'en'
+PLACEHOLDER = re.compile(r'%(\d)')
+
+time_translations = {
+    'en': {
+        "days": "days",
+        "hours": "hours",
+        "minutes": "minutes",
+    },
+    'ru': {
+        "days": "дней",
+        "hours": "часов",
+        "minutes": "минут",
     }
+}
 
+
+def get_time_translation(language_code, time): #time_diff.seconds
+    names = time_catalog.get(language_code, time_catalog[DEFAULT_LANGUAGE])
     days, remainder = divmod(time, 86400)
     hours, remainder = divmod(remainder, 3600)
     minutes, _ = divmod(remainder, 60)
     time_str = ""
     if days > 0:
-        time_str += f"{days} {time_translations.get(language_code, time_translations.get('en', {})).get('days', 'days')} "
+        time_str += f"{days} {names['days']} "
     if hours > 0:
-        time_str += f"{hours} {time_translations.get(language_code, time_translations.get('en', {})).get('hours', 'hours') } "
+        time_str += f"{hours} {names['hours']} "
     if minutes > 0:
-        time_str += f"{minutes} {time_translations.get(language_code, time_translations.get('en', {})).get('minutes', 'minutes')}"
+        time_str += f"{minutes} {names['minutes']}"
 
     return time_str
 
-def replace_placeholders(template, *args):
 
-    for i, value in enumerate(args, start=1):
-        placeholder = f"%{i}"
-        template = template.replace(placeholder, str(value))
-    return template
+def compile_template(template):
+    # 'a %1 b {x}' -> ('a {0} b {{x}}', 1): a str.format string and the number of arguments it takes
+    parts = PLACEHOLDER.split(template)
+    count = max((int(part) for part in parts[1::2]), default=0)
+    text = ''.join(f'{{{int(part) - 1}}}' if i % 2 else part.replace('{', '{{').replace('}', '}}')
+                   for i, part in enumerate(parts))
+    return text, count
+
+
+def replace_placeholders(template, *args):
+    compiled = compiled_templates.get(template)
+    if compiled is None:
+        compiled = compile_template(template)
+    text, count = compiled
+    if len(args) < count:
+        # Placeholders without an argument stay as they are
+        args = args + tuple(f'%{i}' for i in range(len(args) + 1, count + 1))
+    return text.format(*args)
 
 
 translations = {
@@ -45,6 +66,10 @@ translations = {
         "text_killed": "Sunk!",
         'text_you_won': 'Game over',
         'text_leaderboard': '<b>Leaderboard</b>',
+        'text_leaderboard_all': '<b>Leaderboard</b>: all time',
+        'text_leaderboard_week': '<b>Leaderboard</b>: this week',
+        'text_leaderboard_day': '<b>Leaderboard</b>: today',
+        'text_leaderboard_you': 'You are in place %1 with a score of %2',
         'text_need_your_name': 'Wow! Let\'s add this to the leaderboard? Send your nickname to add it 👇',
         'text_leaderboard_adding': 'Hooray! Let\'s add this to the leaderboard 👏',
         'text_send_your_name': 'Send your nickname in a reply message 👇',
@@ -56,12 +81,43 @@ translations = {
         'text_share_text': "Check it out, I scored %1 points in <a href='https://t.me/games_telegram_robot?start=share'>Sea Battle</a>! Can you score more? 😉",
         'text_win': "⬛⬛⬛⬛⬛⬛⬛⬛⬛⬛\nYou win!\nYour score: %1\n⬛⬛⬛⬛⬛⬛⬛⬛⬛⬛",
         'text_win1': "🟩🟧🟥🟨🟪🟫⬛\nYou win!\nYour score: %1\n🟩🟧🟥🟨🟪🟫⬛",
+        'text_place_ship': "Place your fleet: a ship of %1 cells (%2 ships left). Tap where it starts, then one of the 🟩 cells where it ends.",
+        'text_place_ship_single': "Place your fleet: a ship of one cell (%2 ships left). Tap a cell.",
+        'text_duel_start': "Your fleet is ready. Fire!",
+        'text_your_fleet': "Your fleet:",
+        'text_bot_shot': "Bot fires at %1: %2",
+        'text_duel_win': "You win! 🎉",
+        'text_duel_lose': "The bot sank your fleet. Try again!",
+        'text_pvp_waiting': "Looking for an opponent on the %1 board…",
+        'text_pvp_found': "Your opponent: %1. Ships are placed at random.",
+        'text_pvp_your_turn': "Your turn.",
+        'text_pvp_their_turn': "Opponent's turn.",
+        'text_pvp_opponent_shot': "Opponent fires at %1: %2",
+        'text_pvp_win': "You win! 🎉",
+        'text_pvp_lose': "Your opponent sank your fleet.",
+        'text_pvp_resigned': "You gave up the match.",
+        'text_pvp_opponent_resigned': "Your opponent gave up. You win!",
+        'text_pvp_timeout': "The match ended: nobody moved for too long.",
+        'text_pvp_nobody': "Nobody joined in time. Try again later.",
+        'text_pvp_left': "You left the lobby.",
+        'text_pvp_in_match': "Finish your current match first.",
 
         'error_text_leaderboard_name': "You can only use letters, numbers, spaces, and underscores. Send another option.",
         'error_text_cant_generate_board': "Failed to place ships on the board.",
+        'error_text_cant_place': "The remaining ships don't fit. Tap Reset to start over.",
 
         "btn_new_game": "New Game",
         "btn_leaderboard": "Leaderboard",
+        "btn_board_size": "Board size",
+        "btn_leaderboard_all": "All time",
+        "btn_leaderboard_week": "Week",
+        "btn_leaderboard_day": "Today",
+        "btn_vs_bot": "Play vs bot",
+        "btn_vs_player": "Play vs player",
+        "btn_pvp_cancel": "Cancel",
+        "btn_pvp_resign": "🏳 Give up",
+        "btn_place_random": "🎲 Random",
+        "btn_place_reset": "↩ Reset",
     },
     'ru': {
         'text_start_msg': 'Привет! ',
@@ -72,6 +128,10 @@ translations = {
         "text_killed": "Потопил!",
         'text_you_won': 'Игра окончена',
         'text_leaderboard': '<b>Таблица результатов</b>',
+        'text_leaderboard_all': '<b>Таблица результатов</b>: за всё время',
+        'text_leaderboard_week': '<b>Таблица результатов</b>: за неделю',
+        'text_leaderboard_day': '<b>Таблица результатов</b>: за сегодня',
+        'text_leaderboard_you': 'Твоё место: %1 с результатом %2',
         'text_need_your_name': 'Вау! Давай добавим это в таблицу рекордов? Пришли свой ник для добавления 👇',
         'text_leaderboard_adding': 'Ура! Давай добавим это в таблицу рекордов 👏',
         'text_send_your_name': 'Пришли свой ник в ответном сообщении 👇',
@@ -83,18 +143,85 @@ translations = {
         'text_share_text': "Смотри, я набрал %1 очков в <a href='https://t.me/games_telegram_robot?start=share'>Морской бой</a>! Сможешь набрать больше? 😉",
         'text_win': "⬛⬛⬛⬛⬛⬛⬛⬛⬛⬛\nПобеда!\nТвой результат: %1\n⬛⬛⬛⬛⬛⬛⬛⬛⬛⬛",
         'text_win1': "🟩🟧🟥🟨🟪🟫⬛\nПобеда!\nТвой результат: %1\n🟩🟧🟥🟨🟪🟫⬛",
+        'text_place_ship': "Расставь флот: корабль на %1 клетки (осталось кораблей: %2). Нажми, где он начинается, а потом на одну из 🟩 клеток, где он заканчивается.",
+        'text_place_ship_single': "Расставь флот: однопалубный корабль (осталось кораблей: %2). Нажми на клетку.",
+        'text_duel_start': "Флот готов. Огонь!",
+        'text_your_fleet': "Твой флот:",
+        'text_bot_shot': "Бот стреляет в %1: %2",
+        'text_duel_win': "Победа! 🎉",
+        'text_duel_lose': "Бот потопил твой флот. Попробуй ещё раз!",
+        'text_pvp_waiting': "Ищем соперника на поле %1…",
+        'text_pvp_found': "Твой соперник: %1. Корабли расставлены случайно.",
+        'text_pvp_your_turn': "Твой ход.",
+        'text_pvp_their_turn': "Ход соперника.",
+        'text_pvp_opponent_shot': "Соперник стреляет в %1: %2",
+        'text_pvp_win': "Победа! 🎉",
+        'text_pvp_lose': "Соперник потопил твой флот.",
+        'text_pvp_resigned': "Матч сдан.",
+        'text_pvp_opponent_resigned': "Соперник сдался. Победа!",
+        'text_pvp_timeout': "Матч окончен: слишком долго никто не ходил.",
+        'text_pvp_nobody': "Никто не присоединился. Попробуй позже.",
+        'text_pvp_left': "Поиск соперника отменён.",
+        'text_pvp_in_match': "Сначала закончи текущий матч.",
 
         'error_text_leaderboard_name': "Можно использовать только буквы, цифры, пробелы и нижние подчеркивания. Пришли другой вариант.",
         'error_text_cant_generate_board': "Не удалось разместить корабли на поле.",
+        'error_text_cant_place': "Оставшиеся корабли не помещаются. Нажми «Заново», чтобы начать сначала.",
 
         "btn_new_game": "Новая игра",
         "btn_leaderboard": "Таблица рекордов",
+        "btn_board_size": "Размер поля",
+        "btn_leaderboard_all": "Всё время",
+        "btn_leaderboard_week": "Неделя",
+        "btn_leaderboard_day": "Сегодня",
+        "btn_vs_bot": "Играть с ботом",
+        "btn_vs_player": "Играть с игроком",
+        "btn_pvp_cancel": "Отмена",
+        "btn_pvp_resign": "🏳 Сдаться",
+        "btn_place_random": "🎲 Случайно",
+        "btn_place_reset": "↩ Заново",
     }
 }
 
 
+def compile_catalog(tables):
+    # Every language gets the full key set, missing keys falling back to the default language
+    default = tables[DEFAULT_LANGUAGE]
+    return {language: {**default, **table} for language, table in tables.items()}
+
+
+catalog = compile_catalog(translations)
+time_catalog = compile_catalog(time_translations)
+languages = tuple(catalog)
+compiled_templates = {text: compile_template(text) for table in catalog.values() for text in table.values()}
+
+
+def resolve_language(language_code):
+    return language_code if language_code in catalog else DEFAULT_LANGUAGE
+
+
 def get_translation(language_code, key):
-    return translations.get(language_code, translations.get('en', {})).get(key, key)
+    return catalog.get(language_code, catalog[DEFAULT_LANGUAGE]).get(key, key)
+
+
+def format_translation(language_code, key, *args):
+    return replace_placeholders(get_translation(language_code, key), *args)
+
+
+def missing_translations():
+    missing = []
+    for tables in (translations, time_translations):
+        keys = set().union(*tables.values())
+        for language, table in tables.items():
+            missing.extend((language, key) for key in sorted(keys - set(table)))
+    return missing
+
+
+monthNames = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 
 
-monthNames = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
\ No newline at end of file
+if __name__ == '__main__':
+    # python bot_messages.py: fails when a language is missing a key
+    for language, key in missing_translations():
+        print(f"Missing translation: {language}.{key}")
+    sys.exit(1 if missing_translations() else 0)
@@ -0,0 +1,179 @@
+# bot_metrics.py
+
+import asyncio
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+from bisect import bisect_left
+
+from telegram.request import HTTPXRequest
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.sample_rate = 0.0
+        self.logger = None
+        self.listener = None
+        self.host = '127.0.0.1'
+        self.port = None
+        self.server = None
+
+    def configure(self, settings):
+        # Called once at import: with metrics off, the decorators below hand back the plain handlers
+        if not settings:
+            return
+        self.enabled = True
+        self.host = settings.get('host', '127.0.0.1')
+        self.port = settings.get('port', 9100)
+        self.sample_rate = settings.get('log_sample_rate', 0.01)
+
+        # Log lines are queued and written by a background thread, never on the event loop
+        path = settings.get('log_path')
+        target = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler()
+        target.setFormatter(logging.Formatter('%(message)s'))
+        log_queue = queue.SimpleQueue()
+        self.logger = logging.getLogger('games_bot.events')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(log_queue, target)
+        self.listener.start()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def log(self, event, **fields):
+        if self.logger and random.random() < self.sample_rate:
+            self.logger.info(json.dumps({'ts': time.time(), 'event': event, **fields}, ensure_ascii=False, default=str))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {histogram.count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle_scrape(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self):
+        if self.enabled and self.port and self.server is None:
+            self.server = await asyncio.start_server(self.handle_scrape, self.host, self.port)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+
+metrics = Metrics()
+
+
+def timed(name, label=None):
+    def decorator(func):
+        if not metrics.enabled:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # label(result) names the handler from what it returned; one that raised keeps its function name
+            started = time.perf_counter()
+            handler = func.__name__
+            try:
+                result = await func(*args, **kwargs)
+                if label:
+                    handler = label(result)
+                return result
+            finally:
+                metrics.observe(name, time.perf_counter() - started, handler=handler)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - started, method=url.rsplit('/', 1)[-1])
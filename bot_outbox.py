@@ -0,0 +1,200 @@
+# bot_outbox.py
+
+import asyncio
+import itertools
+import time
+from heapq import heapify, heappop, heappush
+
+from telegram.error import RetryAfter
+
+from bot_metrics import metrics
+
+PRIORITY_DIRECT = 0
+PRIORITY_ANIMATION = 1
+COALESCED_METHODS = ('edit_message_text', 'edit_message_reply_markup')
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # 0 when a token was taken, otherwise seconds until one is available
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def put_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class OutboundRequest:
+    __slots__ = ('bot', 'method', 'kwargs', 'key', 'futures', 'retries')
+
+    def __init__(self, bot, method, kwargs, key, future):
+        self.bot = bot
+        self.method = method
+        self.kwargs = kwargs
+        self.key = key
+        self.futures = [future]
+        self.retries = 0
+
+    def is_cancelled(self):
+        return all(future.done() for future in self.futures)
+
+
+class ChatQueue:
+    __slots__ = ('heap', 'edits', 'bucket', 'paused_until', 'task')
+
+    def __init__(self, rate, burst):
+        self.heap = []
+        self.edits = {}
+        self.bucket = TokenBucket(rate, burst)
+        self.paused_until = 0.0
+        self.task = None
+
+
+class Outbox:
+    def __init__(self, chat_rate=1.0, chat_burst=4, global_rate=30.0, global_burst=30, max_retries=3, max_chats=10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.chats = {}
+        self.waiting_direct = 0
+        self.seq = itertools.count()
+
+    def get_chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            if len(self.chats) >= self.max_chats:
+                # Idle chats with a full bucket carry no rate-limit state worth keeping
+                for idle in [key for key, queue in self.chats.items() if queue.task is None and queue.bucket.is_full()]:
+                    del self.chats[idle]
+            chat = self.chats[chat_id] = ChatQueue(self.chat_rate, self.chat_burst)
+        return chat
+
+    def queued(self):
+        return sum(len(chat.heap) for chat in self.chats.values())
+
+    async def send(self, bot, method, priority=PRIORITY_DIRECT, **kwargs):
+        chat_id = kwargs['chat_id']
+        chat = self.get_chat(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        key = (method, kwargs.get('message_id')) if method in COALESCED_METHODS else None
+
+        entry = chat.edits.get(key) if key is not None else None
+        if entry is not None:
+            # An edit of the same message is still queued: send only the latest content
+            request = entry[2]
+            request.kwargs = kwargs
+            request.futures.append(future)
+            if priority < entry[0]:
+                entry[0] = priority
+                heapify(chat.heap)
+        else:
+            entry = [priority, next(self.seq), OutboundRequest(bot, method, kwargs, key, future)]
+            heappush(chat.heap, entry)
+            if key is not None:
+                chat.edits[key] = entry
+
+        if chat.task is None:
+            chat.task = asyncio.get_running_loop().create_task(self.drain(chat))
+        return await future
+
+    async def drain(self, chat):
+        try:
+            while chat.heap:
+                if chat.heap[0][2].is_cancelled():
+                    self.pop(chat)
+                    continue
+                wait = max(chat.paused_until - time.monotonic(), 0) or chat.bucket.take()
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+
+                # The request stays queued until it has a global token, so a direct response queued meanwhile
+                # overtakes an animation frame, or is coalesced into it
+                if not await self.wait_global(chat):
+                    # Everything queued was cancelled, the chat's token was never used
+                    chat.bucket.put_back()
+                    continue
+                entry = self.pop(chat)
+                request = entry[2]
+                try:
+                    result = await getattr(request.bot, request.method)(**request.kwargs)
+                except Exception as e:
+                    if isinstance(e, RetryAfter) and request.retries < self.max_retries:
+                        self.retry(chat, entry, e)
+                        continue
+                    for future in request.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future in request.futures:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            chat.task = None
+
+    def pop(self, chat):
+        entry = heappop(chat.heap)
+        if entry[2].key is not None and chat.edits.get(entry[2].key) is entry:
+            del chat.edits[entry[2].key]
+        return entry
+
+    async def wait_global(self, chat):
+        # Animation frames only take global tokens when no direct response is waiting for one. False when every
+        # queued request of the chat was cancelled meanwhile
+        while chat.heap:
+            if chat.heap[0][2].is_cancelled():
+                self.pop(chat)
+                continue
+            direct = chat.heap[0][0] == PRIORITY_DIRECT
+            wait = self.global_bucket.take() if direct or not self.waiting_direct else 1 / self.global_bucket.rate
+            if not wait:
+                return True
+            if direct:
+                self.waiting_direct += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                if direct:
+                    self.waiting_direct -= 1
+        return False
+
+    def retry(self, chat, entry, error):
+        # The chat pauses and the request goes back into its queue, so what is queued meanwhile keeps its priority
+        # and a newer edit of the same message is sent in its place
+        request = entry[2]
+        request.retries += 1
+        delay = error.retry_after.total_seconds() if hasattr(error.retry_after, 'total_seconds') else error.retry_after
+        chat.paused_until = time.monotonic() + delay
+        metrics.inc('telegram_retry_after_total', method=request.method)
+        newer = chat.edits.get(request.key) if request.key is not None else None
+        if newer is None:
+            heappush(chat.heap, entry)
+            if request.key is not None:
+                chat.edits[request.key] = entry
+        else:
+            newer[2].futures.extend(request.futures)
+            if entry[0] < newer[0]:
+                newer[0] = entry[0]
+                heapify(chat.heap)
@@ -0,0 +1,61 @@
+# bot_profiles.py
+
+import time
+from collections import OrderedDict
+
+from bot_metrics import metrics
+
+
+class UserProfileCache:
+    # Bounded LRU of user rows (user_id, first_name, leader_board_name) with a TTL, so repeat
+    # players don't hit MySQL on /start, on a win or when picking their leaderboard name
+    def __init__(self, load, register, save_name, max_size=10000, ttl=600):
+        self.load_profile = load
+        self.register_profile = register
+        self.save_name = save_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_id):
+        entry = self.profiles.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            metrics.inc('user_profile_cache_total', result='miss')
+            return None
+        self.profiles.move_to_end(user_id)
+        self.hits += 1
+        metrics.inc('user_profile_cache_total', result='hit')
+        return entry[0]
+
+    def store(self, user_id, profile):
+        self.profiles[user_id] = (profile, time.monotonic() + self.ttl)
+        self.profiles.move_to_end(user_id)
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+        return profile
+
+    async def get(self, user_id):
+        # None when the user has no row (yet): callers go on without the profile
+        profile = self.lookup(user_id)
+        if profile is None:
+            profile = await self.load_profile(user_id)
+            if profile == -1:
+                return None
+            self.store(user_id, profile)
+        return profile
+
+    async def register(self, user, phone_number, source):
+        profile = self.lookup(user.id)
+        if profile is None:
+            self.store(user.id, await self.register_profile(user, phone_number, source))
+
+    async def set_leader_board_name(self, user_id, name):
+        if not await self.save_name(user_id, name):
+            return False
+        entry = self.profiles.get(user_id)
+        if entry is not None:
+            self.store(user_id, dict(entry[0], leader_board_name=name))
+        return True
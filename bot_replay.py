@@ -0,0 +1,255 @@
+# bot_replay.py
+#
+# Offline load harness for webhook mode.
+#
+#   python bot_replay.py fake-api --port 8081
+#       Serves a stand-in Bot API; set BOT_SETTINGS['api_base_url'] = 'http://127.0.0.1:8081/bot'
+#   python bot_replay.py fake-api --chat-limit 1 --global-limit 30
+#       Same, but answers 429 with retry_after like Telegram once a chat or the bot exceeds the limit per second
+#   python bot_replay.py replay updates.jsonl --url http://127.0.0.1:8443/telegram --concurrency 50
+#       POSTs recorded updates (one JSON per line, see webhook 'record_path') and reports updates/s and latency
+#   python bot_replay.py play --clicks 10000 --users 100 --port 8081 --url http://127.0.0.1:8443/telegram
+#       Serves the stand-in Bot API itself and has every user click buttons of the last keyboard the bot sent them,
+#       so clicks carry callback data the bot signed for their current game; reports clicks/s and the time until
+#       the bot answers each one
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import deque
+
+from aiohttp import ClientSession, web
+
+
+class FakeBotApi:
+    def __init__(self, chat_limit=0, global_limit=0):
+        self.message_ids = itertools.count(1000)
+        self.calls = 0
+        self.limited = 0
+        self.started = time.monotonic()
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.chat_calls = {}
+        self.global_calls = deque()
+        # For play(): the last keyboard sent to each chat and the answers clicks are waiting for
+        self.keyboards = {}
+        self.waiting = {}
+
+    def retry_after(self, calls, limit, now):
+        # Sliding one-second window; seconds until the oldest call leaves it, 0 if under the limit
+        while calls and now - calls[0] >= 1:
+            calls.popleft()
+        if len(calls) < limit:
+            return 0
+        return max(1, round(1 - (now - calls[0])))
+
+    def check_limits(self, chat_id):
+        now = time.monotonic()
+        chat_calls = self.chat_calls.setdefault(chat_id, deque())
+        wait = max(self.chat_limit and self.retry_after(chat_calls, self.chat_limit, now),
+                   self.global_limit and self.retry_after(self.global_calls, self.global_limit, now))
+        if not wait:
+            chat_calls.append(now)
+            self.global_calls.append(now)
+        return wait
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls += 1
+
+        if 'chat_id' in params and (self.chat_limit or self.global_limit):
+            retry_after = self.check_limits(int(params['chat_id']))
+            if retry_after:
+                self.limited += 1
+                return web.json_response({'ok': False, 'error_code': 429,
+                                          'description': f'Too Many Requests: retry after {retry_after}',
+                                          'parameters': {'retry_after': retry_after}}, status=429)
+
+        if method == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Sea fight', 'username': 'sea_fight_bot'}
+        elif method in ('sendmessage', 'sendphoto', 'editmessagetext'):
+            chat_id = int(params.get('chat_id', 0))
+            message_id = int(params['message_id']) if 'message_id' in params else next(self.message_ids)
+            result = {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                      'chat': {'id': chat_id, 'type': 'private'}}
+            self.keep_keyboard(chat_id, message_id, params.get('text'), params.get('reply_markup'))
+            self.answer(('chat', chat_id))
+        else:
+            if method == 'answercallbackquery':
+                self.answer(('query', params.get('callback_query_id')))
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def keep_keyboard(self, chat_id, message_id, text, markup):
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if not markup or 'inline_keyboard' not in markup:
+            return
+        buttons = [button['callback_data'] for row in markup['inline_keyboard'] for button in row
+                   if 'callback_data' in button]
+        if buttons:
+            self.keyboards[chat_id] = (message_id, text, buttons)
+
+    def answer(self, key):
+        future = self.waiting.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        print(f"Bot API calls: {self.calls}, {self.calls / elapsed:.1f}/s, answered 429: {self.limited}")
+
+
+def run_fake_api(port, chat_limit=0, global_limit=0):
+    api = FakeBotApi(chat_limit, global_limit)
+    app = web.Application()
+    app.router.add_post('/{token}/{method}', api.handle)
+    try:
+        web.run_app(app, host='127.0.0.1', port=port)
+    finally:
+        api.report()
+
+
+def start_update(update_id, user):
+    return {'update_id': update_id,
+            'message': {'message_id': 1, 'date': 0, 'text': '/start',
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+                        'chat': {'id': user['id'], 'type': 'private'}, 'from': user}}
+
+
+def click_update(update_id, user, message_id, text, data):
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'chat_instance': str(user['id']), 'from': user, 'data': data,
+                               'message': {'message_id': message_id, 'date': 0, 'text': text or '',
+                                           'chat': {'id': user['id'], 'type': 'private'}}}}
+
+
+async def play(api, port, url, clicks, users, seed, secret_token, timeout=10):
+    # Each user sends /start, then keeps clicking a random button of the last keyboard the bot sent them: cells of
+    # the board mostly, the name and leaderboard buttons after a win. The bot signs that data itself, so the
+    # clicks land on the user's current game. A click counts as answered once answerCallbackQuery arrives
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    app = web.Application()
+    app.router.add_post('/{token}/{method}', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    rng = random.Random(seed)
+    update_ids = itertools.count(1)
+    latencies = []
+    unanswered = 0
+    loop = asyncio.get_running_loop()
+
+    async def player(session, user_id, count):
+        nonlocal unanswered
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'Player{user_id}', 'language_code': 'en'}
+        for _ in range(count):
+            update_id = next(update_ids)
+            keyboard = api.keyboards.get(user_id)
+            if keyboard is None or rng.random() < 0.01:
+                update, key = start_update(update_id, user), ('chat', user_id)
+            else:
+                message_id, text, buttons = keyboard
+                update, key = click_update(update_id, user, message_id, text, rng.choice(buttons)), ('query', str(update_id))
+            answered = api.waiting[key] = loop.create_future()
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                await response.read()
+            try:
+                latencies.append(await asyncio.wait_for(answered, timeout) - started)
+            except asyncio.TimeoutError:
+                api.waiting.pop(key, None)
+                unanswered += 1
+
+    started = time.perf_counter()
+    try:
+        async with ClientSession() as session:
+            await asyncio.gather(*(player(session, user_id, clicks // users + (user_id <= clicks % users))
+                                   for user_id in range(1, users + 1)))
+    finally:
+        await runner.cleanup()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"Clicks: {clicks}, answered: {len(latencies)}, unanswered after {timeout} s: {unanswered}, "
+          f"{clicks / elapsed:.1f}/s")
+    if latencies:
+        print(f"Answer p50: {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+              f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    api.report()
+
+
+async def replay(updates, url, concurrency, secret_token):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    latencies = []
+    rejected = 0
+    queue = iter(updates)
+
+    async def worker(session):
+        nonlocal rejected
+        for update in queue:
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                await response.read()
+                if response.status != 200:
+                    rejected += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"Updates: {len(latencies)}, rejected: {rejected}, {len(latencies) / elapsed:.1f}/s")
+    print(f"Latency p50: {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+          f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline webhook load harness")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fake = commands.add_parser('fake-api')
+    fake.add_argument('--port', type=int, default=8081)
+    fake.add_argument('--chat-limit', type=int, default=0, help="calls per second per chat before 429 (0: no limit)")
+    fake.add_argument('--global-limit', type=int, default=0, help="calls per second in total before 429 (0: no limit)")
+
+    rep = commands.add_parser('replay')
+    rep.add_argument('path')
+    rep.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    rep.add_argument('--concurrency', type=int, default=50)
+    rep.add_argument('--secret-token')
+
+    clicks = commands.add_parser('play')
+    clicks.add_argument('--port', type=int, default=8081)
+    clicks.add_argument('--chat-limit', type=int, default=0)
+    clicks.add_argument('--global-limit', type=int, default=0)
+    clicks.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    clicks.add_argument('--secret-token')
+    clicks.add_argument('--clicks', type=int, default=10000)
+    clicks.add_argument('--users', type=int, default=100)
+    clicks.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == 'fake-api':
+        run_fake_api(args.port, args.chat_limit, args.global_limit)
+    elif args.command == 'play':
+        api = FakeBotApi(args.chat_limit, args.global_limit)
+        asyncio.run(play(api, args.port, args.url, args.clicks, args.users, args.seed, args.secret_token))
+    else:
+        with open(args.path, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+        asyncio.run(replay(updates, args.url, args.concurrency, args.secret_token))
+
+
+if __name__ == '__main__':
+    main()
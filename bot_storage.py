@@ -0,0 +1,179 @@
+# bot_storage.py
+
+import asyncio
+import sqlite3
+import threading
+import time
+
+
+class SQLiteGameStore:
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def get_conn(self):
+        # Opened on first use, so worker processes never share a connection with their parent
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS games (
+                    user_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    updated REAL NOT NULL
+                )
+            ''')
+            self.conn.commit()
+        return self.conn
+
+    def load_sync(self, user_id):
+        with self.lock:
+            row = self.get_conn().execute('SELECT data FROM games WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_many_sync(self, items):
+        now = time.time()
+        with self.lock:
+            self.get_conn().executemany('INSERT OR REPLACE INTO games (user_id, data, updated) VALUES (?, ?, ?)',
+                                        [(user_id, data, now) for user_id, data in items])
+            self.conn.commit()
+
+    def expire_sync(self):
+        with self.lock:
+            self.get_conn().execute('DELETE FROM games WHERE updated < ?', (time.time() - self.retention,))
+            self.conn.commit()
+
+    async def load(self, user_id):
+        return await asyncio.get_running_loop().run_in_executor(None, self.load_sync, user_id)
+
+    async def save_many(self, items):
+        await asyncio.get_running_loop().run_in_executor(None, self.save_many_sync, items)
+
+    async def expire(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.expire_sync)
+
+    async def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class RedisGameStore:
+    def __init__(self, url, retention, prefix='seafight:game:'):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImportError("Redis game store requires the 'redis' package (pip install redis)")
+        self.retention = retention
+        self.prefix = prefix
+        self.redis = redis.from_url(url)
+
+    async def load(self, user_id):
+        return await self.redis.get(f'{self.prefix}{user_id}')
+
+    async def save_many(self, items):
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, data in items:
+            pipe.set(f'{self.prefix}{user_id}', data, ex=int(self.retention))
+        await pipe.execute()
+
+    async def expire(self):
+        # Keys carry their own TTL
+        pass
+
+    async def close(self):
+        await self.redis.close()
+
+
+def open_game_backend(url, retention):
+    if not url:
+        return None
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisGameStore(url, retention)
+    return SQLiteGameStore(url, retention)
+
+
+class GameStore:
+    def __init__(self, backend, encode, decode, flush_interval=5, idle_ttl=3600):
+        self.backend = backend
+        self.encode = encode
+        self.decode = decode
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self.games = {}
+        self.dirty = set()
+        self.task = None
+
+    async def get(self, user_id):
+        entry = self.games.get(user_id)
+        if entry:
+            entry[1] = time.monotonic()
+            return entry[0]
+        if self.backend is None:
+            return None
+
+        data = await self.backend.load(user_id)
+        if not data:
+            return None
+        if user_id in self.games:
+            return self.games[user_id][0]
+        game = self.decode(data)
+        self.games[user_id] = [game, time.monotonic()]
+        return game
+
+    def put(self, user_id, game):
+        entry = self.games.get(user_id)
+        if entry is not None and entry[0] is game:
+            # Games are mutated in place, so a click only refreshes the access time
+            entry[1] = time.monotonic()
+        else:
+            self.games[user_id] = [game, time.monotonic()]
+        self.dirty.add(user_id)
+
+    async def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        if self.backend is None or not dirty:
+            return
+        items = [(user_id, self.encode(self.games[user_id][0])) for user_id in dirty if user_id in self.games]
+        try:
+            await self.backend.save_many(items)
+        except Exception:
+            self.dirty |= dirty
+            raise
+
+    async def evict_idle(self):
+        await self.flush()
+        deadline = time.monotonic() - self.idle_ttl
+        for user_id in [user_id for user_id, (_, last_access) in self.games.items() if last_access < deadline]:
+            if user_id not in self.dirty:
+                del self.games[user_id]
+        if self.backend is not None:
+            await self.backend.expire()
+
+    async def run(self):
+        last_eviction = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                if time.monotonic() - last_eviction >= min(self.idle_ttl, 60):
+                    last_eviction = time.monotonic()
+                    await self.evict_idle()
+                else:
+                    await self.flush()
+            except Exception as e:
+                print(f"Error while saving games: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+        if self.backend is not None:
+            await self.backend.close()
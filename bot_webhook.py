@@ -0,0 +1,191 @@
+# bot_webhook.py
+
+import asyncio
+import json
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.locks = {}
+        self.waiting = {}
+        self.running = 0
+
+    async def process_update(self, update, coroutine):
+        # Updates of one user run one at a time and in arrival order; a user waiting for their
+        # previous click does not take one of the shared concurrency slots
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+
+        key = user.id
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.waiting[key] = self.waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self.waiting[key] -= 1
+            if not self.waiting[key]:
+                del self.waiting[key]
+                del self.locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class WebhookServer:
+    def __init__(self, application, listen='0.0.0.0', port=8443, path='/telegram', secret_token=None,
+                 max_pending=1000, record_path=None):
+        if web is None:
+            raise ImportError("Webhook mode requires the 'aiohttp' package (pip install aiohttp)")
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.max_pending = max_pending
+        self.record = open(record_path, 'a', encoding='utf-8') if record_path else None
+        self.closing = False
+        self.runner = None
+
+    async def handle_update(self, request):
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=403)
+        # Telegram redelivers on errors, so shedding load here is safe
+        if self.closing or self.pending() >= self.max_pending:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if self.record:
+            self.record.write(json.dumps(data, ensure_ascii=False) + '\n')
+        if not await self.enqueue(data):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def enqueue(self, data):
+        # False when nothing can take the update right now
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        return True
+
+    def pending(self):
+        return self.application.update_queue.qsize()
+
+    def is_idle(self):
+        return application_idle(self.application)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+
+    async def drain(self, timeout):
+        self.closing = True
+        await wait_until_idle(self.is_idle, timeout)
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+        if self.record:
+            self.record.close()
+
+
+def application_idle(application):
+    # current_concurrent_updates only exists from python-telegram-bot 22; before it, only our processor counts them
+    processor = application.update_processor
+    running = getattr(processor, 'current_concurrent_updates', getattr(processor, 'running', 0))
+    return application.update_queue.empty() and not running
+
+
+async def wait_until_idle(is_idle, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not is_idle():
+        await asyncio.sleep(0.05)
+
+
+def stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+def webhook_options(settings):
+    return dict(
+        listen=settings.get('listen', '0.0.0.0'),
+        port=settings.get('port', 8443),
+        path=settings.get('path', '/telegram'),
+        secret_token=settings.get('secret_token'),
+        max_pending=settings.get('max_pending', 1000),
+        record_path=settings.get('record_path'),
+    )
+
+
+async def start_application(application):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def stop_application(application):
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def set_webhook(bot, settings):
+    if settings.get('url'):
+        await bot.set_webhook(settings['url'], secret_token=settings.get('secret_token'),
+                              max_connections=settings.get('max_connections', 40),
+                              allowed_updates=Update.ALL_TYPES)
+
+
+async def run_webhook(application, settings):
+    server = WebhookServer(application, **webhook_options(settings))
+    stop = stop_signal()
+
+    await start_application(application)
+    await server.start()
+    await set_webhook(application.bot, settings)
+    print(f"Start game bot webhook on {server.listen}:{server.port}{server.path}: done.")
+
+    try:
+        await stop.wait()
+    finally:
+        await server.drain(settings.get('drain_timeout', 10))
+        await server.stop()
+        await stop_application(application)
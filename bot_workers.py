@@ -0,0 +1,141 @@
+# bot_workers.py
+
+import asyncio
+import multiprocessing
+import signal
+import time
+
+from telegram import Update
+
+from bot_metrics import metrics
+from bot_writes import writes
+from bot_gamelog import game_log
+from bot_webhook import (WebhookServer, start_application, stop_application, set_webhook, stop_signal,
+                         application_idle, wait_until_idle, webhook_options)
+
+UPDATE_USER_KEYS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                    'chat_join_request')
+
+
+def update_user_id(data):
+    for key in UPDATE_USER_KEYS:
+        item = data.get(key)
+        if item:
+            user = item.get('from') or item.get('user')
+            if user:
+                return user['id']
+    return data.get('update_id', 0)
+
+
+def worker_main(index, queue, build_application, drain_timeout):
+    # The router stops workers with a sentinel once it has stopped accepting updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if metrics.port:
+        metrics.port += index + 1
+    if writes.journal_path:
+        writes.journal_path = f'{writes.journal_path}.{index}'
+    if writes.dead_letter_path:
+        writes.dead_letter_path = f'{writes.dead_letter_path}.{index}'
+    if game_log.path:
+        game_log.path = f'{game_log.path}.{index}'
+    asyncio.run(run_worker(queue, build_application, drain_timeout))
+
+
+async def run_worker(queue, build_application, drain_timeout):
+    application = build_application()
+    loop = asyncio.get_running_loop()
+    await start_application(application)
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await wait_until_idle(lambda: application_idle(application), drain_timeout)
+    finally:
+        await stop_application(application)
+
+
+def worker_starter(build_application, drain_timeout):
+    # start_worker(index) -> (queue, process); spawn, not fork: the parent already holds sockets and executor threads
+    context = multiprocessing.get_context('spawn')
+
+    def start_worker(index):
+        queue = context.Queue()
+        process = context.Process(target=worker_main, args=(index, queue, build_application, drain_timeout), daemon=True)
+        process.start()
+        return queue, process
+    return start_worker
+
+
+class RoutingWebhookServer(WebhookServer):
+    # Each user always lands on the same worker, so their clicks stay in order and hit that worker's warm game cache.
+    # A worker found dead is started again on a fresh queue (updates it had queued are lost), at most once per
+    # restart_interval; until then its users are answered 503 and Telegram delivers their updates again
+    def __init__(self, start_worker, workers, restart_interval=10, **kwargs):
+        super().__init__(None, **kwargs)
+        self.start_worker = start_worker
+        self.workers = [start_worker(index) for index in range(workers)]
+        self.restart_interval = restart_interval
+        self.restarted = [0.0] * workers
+
+    def worker_queue(self, index):
+        queue, process = self.workers[index]
+        if process.is_alive():
+            return queue
+        now = time.monotonic()
+        if self.closing or now - self.restarted[index] < self.restart_interval:
+            return None
+        print(f"Worker {index} exited with code {process.exitcode}, starting it again")
+        metrics.inc('worker_restarts_total')
+        self.restarted[index] = now
+        # Nobody reads the old queue any more: exiting must not wait to flush it
+        queue.cancel_join_thread()
+        self.workers[index] = self.start_worker(index)
+        return self.workers[index][0]
+
+    async def enqueue(self, data):
+        queue = self.worker_queue(update_user_id(data) % len(self.workers))
+        if queue is None:
+            return False
+        queue.put(data)
+        return True
+
+    def pending(self):
+        try:
+            return max(queue.qsize() for queue, _ in self.workers)
+        except NotImplementedError:
+            return 0
+
+    def is_idle(self):
+        return True
+
+
+async def stop_workers(server, timeout):
+    for queue, process in server.workers:
+        if not process.is_alive():
+            queue.cancel_join_thread()
+        queue.put(None)
+    loop = asyncio.get_running_loop()
+    for _, process in server.workers:
+        await loop.run_in_executor(None, process.join, timeout)
+
+
+async def run_workers(build_application, bot, settings, workers):
+    drain_timeout = settings.get('drain_timeout', 10)
+    server = RoutingWebhookServer(worker_starter(build_application, drain_timeout), workers,
+                                  settings.get('worker_restart_interval', 10), **webhook_options(settings))
+    stop = stop_signal()
+    await server.start()
+    async with bot:
+        await set_webhook(bot, settings)
+    print(f"Start game bot webhook on {server.listen}:{server.port}{server.path} with {workers} workers: done.")
+
+    try:
+        await stop.wait()
+    finally:
+        await server.drain(0)
+        await server.stop()
+        await stop_workers(server, drain_timeout + 5)
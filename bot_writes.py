@@ -0,0 +1,174 @@
+# bot_writes.py
+
+import asyncio
+import json
+import os
+
+from bot_metrics import metrics
+
+
+class WriteBehindQueue:
+    # Writes that nobody waits for (registrations, leaderboard names and scores) are queued as
+    # (kind, row) and committed together in one transaction per batch, on size or time.
+    # With a journal, every queued write is appended to a local file first and replayed on restart.
+    # After max_failures failed batches in a row the writes are retried one by one: a row the database
+    # refuses goes to the dead-letter file instead of holding up the rest, while an error is_transient(error)
+    # accepts (the database is unreachable) keeps it queued
+    def __init__(self):
+        self.write_batch = None
+        self.max_batch = 500
+        self.flush_interval = 1
+        self.journal_path = None
+        self.fsync = False
+        self.max_failures = 3
+        self.dead_letter_path = None
+        self.is_transient = lambda error: False
+        self.failures = 0
+        self.pending = []
+        self.inflight = []
+        self.journal = None
+        self.lock = None
+        self.wakeup = None
+        self.closing = False
+        self.task = None
+
+    def configure(self, write_batch, max_batch=500, flush_interval=1, journal_path=None, fsync=False, max_failures=3,
+                  dead_letter_path=None, is_transient=None):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path or None
+        self.fsync = fsync
+        self.max_failures = max_failures
+        self.dead_letter_path = dead_letter_path or None
+        if is_transient is not None:
+            self.is_transient = is_transient
+
+    def replay_journal(self):
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    kind, row = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short by a crash
+                    continue
+                self.pending.append((kind, tuple(row)))
+        if self.pending:
+            print(f"Replaying {len(self.pending)} queued writes from {self.journal_path}")
+
+    def write_journal(self, ops):
+        self.journal.write(''.join(json.dumps([kind, row], ensure_ascii=False, default=str) + '\n' for kind, row in ops))
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+    def rewrite_journal(self):
+        # The new journal is complete on disk before it replaces the old one, so a crash leaves one or the other
+        if self.journal:
+            self.journal.close()
+        temp_path = f'{self.journal_path}.tmp'
+        self.journal = open(temp_path, 'w', encoding='utf-8')
+        self.write_journal(self.pending)
+        os.replace(temp_path, self.journal_path)
+
+    def write_dead_letter(self, op, error):
+        kind, row = op
+        metrics.inc('db_dead_letters_total')
+        print(f"Dropping a queued {kind} write the database refuses: {error}")
+        if not self.dead_letter_path:
+            return
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps([kind, row, str(error)], ensure_ascii=False, default=str) + '\n')
+
+    async def write_rows(self, ops):
+        # Returns the writes still queued when the database went away halfway
+        for i, op in enumerate(ops):
+            try:
+                await self.write_batch([op])
+            except Exception as e:
+                if self.is_transient(e):
+                    print(f"Error while saving queued writes one by one: {e}")
+                    return ops[i:]
+                self.write_dead_letter(op, e)
+        return []
+
+    def put(self, kind, row):
+        self.pending.append((kind, row))
+        if self.journal:
+            self.write_journal([(kind, row)])
+        if len(self.pending) >= self.max_batch and self.wakeup:
+            self.wakeup.set()
+
+    def pending_rows(self, kind):
+        return [row for op_kind, row in self.inflight + self.pending if op_kind == kind]
+
+    async def flush(self):
+        async with self.lock:
+            ops, self.pending = self.pending, []
+            if not ops:
+                return
+            self.inflight = ops
+            try:
+                if self.failures < self.max_failures:
+                    await self.write_batch(ops)
+                    left = []
+                else:
+                    left = await self.write_rows(ops)
+            except Exception:
+                self.failures += 1
+                self.pending = ops + self.pending
+                raise
+            finally:
+                self.inflight = []
+            if left:
+                self.pending = left + self.pending
+            else:
+                self.failures = 0
+            metrics.inc('db_batched_writes_total', len(ops) - len(left))
+            if self.journal:
+                # Only what was queued during the commit is still uncommitted
+                self.rewrite_journal()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error while saving queued writes: {e}")
+            if self.closing:
+                return
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.replay_journal()
+        if self.journal_path:
+            # Replayed writes go into a fresh journal before the old one is replaced
+            self.rewrite_journal()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        # The run loop makes a last flush and stops; a commit in progress is never cancelled halfway
+        if self.task is None:
+            return
+        self.closing = True
+        self.wakeup.set()
+        try:
+            await self.task
+        finally:
+            self.task = None
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+
+writes = WriteBehindQueue()
@@ -1,18 +1,43 @@
 from games_bot_config import DB_CONFIG, API_TOKEN, BOT_SETTINGS
-from bot_messages import get_translation, replace_placeholders
+from bot_ai import get_targeting_engine
+from bot_callbacks import (CallbackCodec, action_name, ACTION_FIRE, ACTION_VIEW, ACTION_NEW_GAME, ACTION_BOARDS, ACTION_NAME_TG,
+                           ACTION_NAME_LASTUSED, ACTION_NAME_NEW, ACTION_LEADERBOARD_SHOW, ACTION_LEADERBOARD_SKIP,
+                           ACTION_DUEL, ACTION_PLACE, ACTION_PLACE_AUTO, ACTION_PLACE_RESET, ACTION_PVP_JOIN,
+                           ACTION_PVP_FIRE, ACTION_PVP_LEAVE)
+from bot_outbox import Outbox, PRIORITY_DIRECT, PRIORITY_ANIMATION
+from bot_messages import get_translation, format_translation, resolve_language, languages
+from bot_leaderboard import Leaderboard, PERIODS, period_start
+from bot_matchmaking import Matchmaker
+from bot_media import MediaCache
+from bot_profiles import UserProfileCache
+from bot_metrics import metrics, timed, InstrumentedRequest
+from bot_writes import writes
+from bot_gamelog import game_log
+from bot_storage import GameStore, open_game_backend
+from bot_webhook import UserOrderedUpdateProcessor, run_webhook
+from bot_workers import run_workers
 
 from abc import ABC
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+import asyncio
+import hashlib
+import html
 import random
 import os
 import re
+import struct
+import threading
 import time
 
 import mysql.connector
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, MessageHandler, filters, ApplicationBuilder, ContextTypes
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
+from mysql.connector import pooling
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, MessageHandler, filters
+from telegram.ext import CommandHandler, CallbackQueryHandler, CallbackContext
 from telegram import ReplyKeyboardRemove
+from telegram.error import BadRequest
 
 ROWS = 8
 COLS = 8
@@ -27,25 +52,85 @@ MISS = ' 💠 '
 SHIPS = [4, 3, 3, 2, 2, 2, 1, 1, 1, 1]
 # SHIPS = [1]
 
-class bcolors:
-    HEADER = '\033[95m'
-    OKBLUE = '\033[94m'
-    OKCYAN = '\033[96m'
-    OKGREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
-
-class DatabaseConnectionManager:
-    def __enter__(self):
-        self.conn = mysql.connector.connect(**DB_CONFIG)
-        return self.conn
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.conn:
-            self.conn.close()
+metrics.configure(BOT_SETTINGS.get('metrics'))
+callbacks = CallbackCodec(BOT_SETTINGS.get('callback_secret') or hashlib.sha256(f'callbacks:{API_TOKEN}'.encode()).digest())
+
+
+class BoardMode:
+    __slots__ = ('name', 'rows', 'cols', 'ships', 'label')
+
+    def __init__(self, name, rows, cols, ships, label=None):
+        # GameState keeps rows and cols in one byte each and ship ids in a bytearray;
+        # the name goes into callback data, which is split on '_'
+        if not name.isalnum() or not (0 < rows < 256 and 0 < cols < 256 and 0 < len(ships) < 255):
+            raise ValueError(f"Unsupported board mode {name}: {rows}x{cols} with {len(ships)} ships")
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+        self.ships = list(ships)
+        self.label = label or f'{rows}×{cols}'
+
+
+BOARD_MODES = {name: BoardMode(name, **mode) for name, mode in {
+    'classic8': {'rows': ROWS, 'cols': COLS, 'ships': SHIPS},
+    'classic10': {'rows': 10, 'cols': 10, 'ships': [4, 3, 3, 2, 2, 2, 1, 1, 1, 1]},
+    'large16': {'rows': 16, 'cols': 16, 'ships': [5, 4, 4, 3, 3, 3, 2, 2, 2, 2, 1, 1, 1, 1, 1]},
+    **BOT_SETTINGS.get('board_modes', {})
+}.items()}
+BOARD_MODE_NAMES = list(BOARD_MODES)
+DEFAULT_BOARD_MODE = BOT_SETTINGS.get('default_board_mode', 'classic8')
+
+# Telegram allows 8 buttons in a row and 100 per keyboard: bigger boards are shown a page at a time,
+# with a row of arrows under the page
+VIEWPORT_COLS = min(BOT_SETTINGS.get('viewport_cols', 8), 8)
+VIEWPORT_ROWS = min(BOT_SETTINGS.get('viewport_rows', 8), (100 - 4) // VIEWPORT_COLS)
+
+class DatabasePool:
+    def __init__(self, pool_size=5, pool_name='games_bot'):
+        self.pool_size = pool_size
+        self.pool_name = pool_name
+        self.pool = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = pooling.MySQLConnectionPool(pool_name=self.pool_name, pool_size=self.pool_size,
+                                                        pool_reset_session=True, **DB_CONFIG)
+            return self.pool
+
+    def get_connection(self):
+        conn = self.get_pool().get_connection()
+        try:
+            # Health check: pooled connections may have been dropped by the server while idle
+            conn.ping(reconnect=True, attempts=3, delay=1)
+        except mysql.connector.Error:
+            conn.close()
+            raise
+        return conn
+
+    def run_sync(self, func, *args):
+        conn = self.get_connection()
+        started = time.perf_counter()
+        try:
+            return func(conn, *args)
+        finally:
+            conn.close()
+            if metrics.enabled:
+                metrics.observe('db_query_seconds', time.perf_counter() - started, query=func.__name__)
+
+    async def run(self, func, *args):
+        # Blocking queries go to a thread pool sized like the connection pool, so the event loop never waits on MySQL
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.run_sync, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+db_pool = DatabasePool(BOT_SETTINGS.get('db_pool_size', 5))
+
 
 class UserManager:
     def __init__(self, conn):
@@ -53,14 +138,16 @@ class UserManager:
 
     def get_user_info(self, user_id):
         cursor = self.conn.cursor(dictionary=True)
-        cursor.execute(f"SELECT * FROM {BOT_SETTINGS['users_table']} WHERE user_id = %s", (user_id,))
+        cursor.execute(f"SELECT user_id, first_name, leader_board_name FROM {BOT_SETTINGS['users_table']} WHERE user_id = %s",
+                       (user_id,))
         user_info = cursor.fetchone()
         cursor.close()
         return user_info if user_info else -1
 
-    def save_user_info(self, user_id, first_name, last_name, username, phone_number, is_bot, language_code, is_premium, source):
+    def save_users_info(self, rows):
+        # The caller commits
         cursor = self.conn.cursor()
-        cursor.execute(f'''
+        cursor.executemany(f'''
             INSERT INTO {BOT_SETTINGS['users_table']} (user_id, first_name, last_name, username, phone_number, is_bot, language_code, is_premium, source)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             ON DUPLICATE KEY UPDATE
@@ -72,23 +159,18 @@ class UserManager:
             language_code = VALUES(language_code),
             is_premium = VALUES(is_premium),
             source = VALUES(source)
-        ''', (user_id, first_name, last_name, username, phone_number, is_bot, language_code, is_premium, source))
-        self.conn.commit()
+        ''', rows)
         cursor.close()
 
-    def update_leader_board_name(self, user_id, leader_board_name):
-        if not is_safe_leader_board_name(leader_board_name):
-            return False
-
+    def update_leader_board_names(self, rows):
+        # rows of (leader_board_name, user_id); the caller commits
         cursor = self.conn.cursor()
-        cursor.execute(f'''
+        cursor.executemany(f'''
             UPDATE {BOT_SETTINGS['users_table']}
             SET leader_board_name = %s
             WHERE user_id = %s
-        ''', (leader_board_name, user_id))
-        self.conn.commit()
+        ''', rows)
         cursor.close()
-        return True
 
 class BaseBoard(ABC):
     def __init__(self, rows, cols, empty_symbol, initial_board=None):
@@ -100,157 +182,619 @@ class BaseBoard(ABC):
         else:
             self.board = [[empty_symbol for _ in range(cols)] for _ in range(rows)]
 
-    def display(self):
-        for line in self.board:
-            print(" ".join(line))
-
     def update_cell(self, x, y, symbol):
         if 0 <= x < self.rows and 0 <= y < self.cols:
             self.board[x][y] = symbol
         else:
             raise ValueError("Wrong coordinates")
 
-class Board(BaseBoard):
-    def __init__(self, rows, cols, empty_symbol, initial_board=None):
-        super().__init__(rows, cols, empty_symbol, initial_board)
-
-    def is_cell_empty(self, x, y):
-        return self.board[x][y] == self.empty_symbol
-
-    def place_ship(self, ship):
-        for x, y in ship.get_coordinates():
-            self.update_cell(x, y, ship.symbol)
-
-    def is_ship_placed(self, x, y):
-        return self.board[x][y] == SHIP
-
 class PlayerBoard(BaseBoard):
-    def __init__(self, rows, cols, empty_symbol, initial_board=None):
+    def __init__(self, rows, cols, empty_symbol, initial_board=None, game_id=0):
         super().__init__(rows, cols, empty_symbol, initial_board)
+        self.game_id = game_id
+
+SHOT_MISS = 0
+SHOT_HIT = 1
+SHOT_SUNK = 2
+SHOT_TEXT_KEYS = {SHOT_MISS: 'text_miss', SHOT_HIT: 'text_damaged', SHOT_SUNK: 'text_killed'}
+SHOT_POINTS = {SHOT_MISS: -1, SHOT_HIT: 10, SHOT_SUNK: 10}
+
+GAME_HEADER = struct.Struct('>BBiQ')
+# A duel starts with a 0 where a solo game has its number of rows, then the placement anchor and the size
+# of the bot's fleet record
+DUEL_MARKER = 0
+DUEL_HEADER = struct.Struct('>BiH')
+
+class GameState:
+    # Cell (x, y) is bit x * cols + y of the ships/hits/misses/sunk masks.
+    # ship_index maps the same cell number to ship id + 1 (0 for water)
+    __slots__ = ('rows', 'cols', 'seed', 'score', 'ships', 'hits', 'misses', 'sunk', 'ship_index', 'ship_masks',
+                 'ship_cells', 'ship_remaining', 'remaining')
+
+    def __init__(self, rows, cols, seed=None):
+        self.rows = rows
+        self.cols = cols
+        self.seed = seed
+        self.score = 0
+        self.ships = 0
+        self.hits = 0
+        self.misses = 0
+        self.sunk = 0
+        self.ship_index = bytearray(rows * cols)
+        self.ship_masks = []
+        self.ship_cells = []
+        self.ship_remaining = []
+        self.remaining = 0
+
+    def to_bytes(self):
+        # Header (rows, cols, score, seed) followed by the ships, hits and misses masks: 38 bytes for 8x8
+        size = (self.rows * self.cols + 7) // 8
+        return (GAME_HEADER.pack(self.rows, self.cols, self.score, self.seed or 0)
+                + self.ships.to_bytes(size, 'big') + self.hits.to_bytes(size, 'big') + self.misses.to_bytes(size, 'big'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        rows, cols, score, seed = GAME_HEADER.unpack_from(data)
+        size = (rows * cols + 7) // 8
+        offset = GAME_HEADER.size
+        ships, hits, misses = (int.from_bytes(data[offset + i * size:offset + (i + 1) * size], 'big') for i in range(3))
+
+        state = cls(rows, cols, seed)
+        state.score = score
+        # Ships never touch, so each one is a straight run starting at its first cell in row-major order
+        seen = 0
+        for i in range(rows * cols):
+            if not ships >> i & 1 or seen >> i & 1:
+                continue
+            x, y = divmod(i, cols)
+            dx, dy = (0, 1) if y + 1 < cols and ships >> (i + 1) & 1 else (1, 0)
+            coordinates = []
+            while x < rows and y < cols and ships >> (x * cols + y) & 1:
+                coordinates.append((x, y))
+                seen |= 1 << (x * cols + y)
+                x, y = x + dx, y + dy
+            state.add_ship(coordinates)
+        for i in range(rows * cols):
+            if hits >> i & 1:
+                state.fire(*divmod(i, cols))
+        state.misses = misses
+        return state
+
+    def bit(self, x, y):
+        if 0 <= x < self.rows and 0 <= y < self.cols:
+            return 1 << (x * self.cols + y)
+        raise ValueError("Wrong coordinates")
+
+    def add_ship(self, coordinates):
+        ship_id = len(self.ship_masks)
+        mask = 0
+        for x, y in coordinates:
+            mask |= self.bit(x, y)
+            self.ship_index[x * self.cols + y] = ship_id + 1
+        self.ships |= mask
+        self.ship_masks.append(mask)
+        self.ship_cells.append(tuple(coordinates))
+        self.ship_remaining.append(len(coordinates))
+        self.remaining += len(coordinates)
+
+    def find_ship(self, x, y):
+        return self.ship_index[x * self.cols + y] - 1
+
+    def fire(self, x, y):
+        bit = self.bit(x, y)
+        if (self.hits | self.misses) & bit:
+            return None
+        ship_id = self.find_ship(x, y)
+        if ship_id < 0:
+            self.misses |= bit
+            return SHOT_MISS
+
+        self.hits |= bit
+        self.remaining -= 1
+        self.ship_remaining[ship_id] -= 1
+        if self.ship_remaining[ship_id] == 0:
+            self.sunk |= self.ship_masks[ship_id]
+            return SHOT_SUNK
+        return SHOT_HIT
+
+    def is_sunk(self, x, y):
+        return bool(self.sunk & self.bit(x, y))
+
+    def is_shot(self, x, y):
+        return bool((self.hits | self.misses) & self.bit(x, y))
+
+    @property
+    def game_id(self):
+        # Callback data carries it so keyboards of earlier games can be told apart
+        return (self.seed or 0) & 0xFFFFFFFF
+
+    def is_won(self):
+        return self.remaining == 0
+
+    def symbol(self, bit):
+        if self.sunk & bit:
+            return BIGBANG
+        if self.hits & bit:
+            return BANG
+        if self.misses & bit:
+            return MISS
+        return EMPTY
+
+    def render(self):
+        return [[self.symbol(1 << (x * self.cols + y)) for y in range(self.cols)] for x in range(self.rows)]
+
 
 class GameLogic:
-    def __init__(self, rows, cols, empty_symbol, ship_symbol, initial_board=None, initial_player_board=None):
+    # One per game, kept in game_store for its whole life: clicks mutate the state and the rendered board
+    # in place instead of rebuilding them
+    __slots__ = ('rows', 'cols', 'empty_symbol', 'ship_symbol', 'state', 'is_board_generated', 'board')
+
+    def __init__(self, rows, cols, empty_symbol, ship_symbol, state=None):
         self.rows = rows
         self.cols = cols
         self.empty_symbol = empty_symbol
         self.ship_symbol = ship_symbol
-        self.board = Board(rows, cols, empty_symbol, initial_board)
-        self.player_board = PlayerBoard(rows, cols, empty_symbol, initial_player_board)
-        self.is_board_generated = False
-
-    def generate_board(self, ships):
+        self.state = state if state else GameState(rows, cols)
+        self.is_board_generated = state is not None
+        self.board = None
+
+    def to_bytes(self):
+        return self.state.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[0] == DUEL_MARKER:
+            return DuelGame.from_bytes(data)
+        state = GameState.from_bytes(data)
+        return cls(state.rows, state.cols, EMPTY, SHIP, state)
+
+    @property
+    def player_board(self):
+        if self.board is None:
+            self.board = PlayerBoard(self.rows, self.cols, self.empty_symbol, self.state.render(), self.state.game_id)
+        return self.board
+
+    def generate_board(self, ships, seed=None, layout=None):
+        # layout is a (seed, fleet) generated beforehand, e.g. taken from a LayoutPool
         if self.is_board_generated:
             return True
-        max_attempts = 20
-        placed = False
-        for attempt in range(max_attempts):
-            board = Board(self.rows, self.cols, self.empty_symbol)
-
-            for ship_size in ships:
-                ship = Ship(ship_size, self.ship_symbol)
-                placed = False
-                tries = 200
-
-                while not placed and tries > 0:
-                    x = random.randint(0, self.rows - 1)
-                    y = random.randint(0, self.cols - 1)
-                    direction = random.choice(['horizontal', 'vertical'])
-                    placed = ship.place(x, y, direction, board)
-                    tries -= 1
-
-                if not placed:
-                    break
-            if placed:
-                break
-
-        if not placed:
+        if layout is None:
+            layout = get_fleet_generator(self.rows, self.cols, ships).generate(seed)
+        if layout is None:
             return False
 
+        seed, fleet = layout
+        state = GameState(self.rows, self.cols, seed)
+        for coordinates in fleet:
+            state.add_ship(coordinates)
         self.is_board_generated = True
-        self.board = board
+        self.state = state
+        self.board = None
         return True
 
+    def fire(self, x, y):
+        result = self.state.fire(x, y)
+        if result is None or self.board is None:
+            return result
+        if result == SHOT_SUNK:
+            for cell_x, cell_y in self.get_ship_cells(x, y):
+                self.board.update_cell(cell_x, cell_y, BIGBANG)
+        else:
+            self.board.update_cell(x, y, MISS if result == SHOT_MISS else BANG)
+        return result
+
     def check_if_killed(self, x, y):
-        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-            for i in range(self.rows):
-                nx, ny = x + dx * i, y + dy * i
-                if 0 <= nx < self.rows and 0 <= ny < self.cols and self.board.is_ship_placed(nx, ny):
-                    return False
-                elif 0 <= nx < self.rows and 0 <= ny < self.cols and self.board.is_cell_empty(nx, ny):
-                    break
-        return True
+        return self.state.is_sunk(x, y)
+
+    def get_ship_cells(self, x, y):
+        ship_id = self.state.find_ship(x, y)
+        return self.state.ship_cells[ship_id] if ship_id >= 0 else ()
 
     def check_if_won(self):
-        return all(not self.board.is_ship_placed(x, y) for x in range(self.rows) for y in range(self.cols))
+        return self.state.is_won()
+
+
+class DuelGame(GameLogic):
+    # The player against the bot. state is the bot's fleet, the one the player fires at (its seed is the
+    # game id); own is the player's fleet, placed ship by ship before the battle. A hit shoots again
+    __slots__ = ('own', 'anchor')
+
+    def __init__(self, rows, cols, empty_symbol, ship_symbol, state=None, own=None):
+        super().__init__(rows, cols, empty_symbol, ship_symbol, state)
+        self.own = own if own else GameState(rows, cols)
+        self.anchor = None
+
+    def to_bytes(self):
+        enemy = self.state.to_bytes()
+        return (DUEL_HEADER.pack(DUEL_MARKER, -1 if self.anchor is None else self.anchor, len(enemy))
+                + enemy + self.own.to_bytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        _, anchor, size = DUEL_HEADER.unpack_from(data)
+        state = GameState.from_bytes(data[DUEL_HEADER.size:DUEL_HEADER.size + size])
+        own = GameState.from_bytes(data[DUEL_HEADER.size + size:])
+        game = cls(state.rows, state.cols, EMPTY, SHIP, state, own)
+        game.anchor = None if anchor < 0 else anchor
+        return game
+
+    @property
+    def placing(self):
+        return len(self.own.ship_masks) < len(self.state.ship_masks)
+
+    def is_over(self):
+        return self.state.is_won() or self.own.is_won()
+
+    def generator(self):
+        return get_fleet_generator(self.rows, self.cols, sorted((len(cells) for cells in self.state.ship_cells), reverse=True))
+
+    def sizes_to_place(self):
+        sizes = sorted((len(cells) for cells in self.state.ship_cells), reverse=True)
+        for cells in self.own.ship_cells:
+            sizes.remove(len(cells))
+        return sizes
+
+    def own_blocked(self):
+        zones = get_targeting_engine(self.generator()).zones
+        blocked = 0
+        for mask in self.own.ship_masks:
+            blocked |= zones[mask]
+        return blocked
+
+    def placement_ends(self, x, y):
+        # Cells that finish the next ship if it starts at (x, y), each mapped to the ship's cells
+        blocked = self.own_blocked()
+        ends = {}
+        for mask, zone, cells in self.generator().placements[self.sizes_to_place()[0]]:
+            if mask & blocked:
+                continue
+            if cells[0] == (x, y):
+                ends[cells[-1]] = cells
+            elif cells[-1] == (x, y):
+                ends[cells[0]] = cells
+        return ends
+
+    def place(self, x, y):
+        # The first tap picks where the ship starts, the second one of its ends; False when nothing changed
+        cell = x * self.cols + y
+        if self.anchor == cell:
+            self.anchor = None
+            return True
+        if self.anchor is not None:
+            ends = self.placement_ends(*divmod(self.anchor, self.cols))
+            if (x, y) in ends:
+                self.own.add_ship(ends[(x, y)])
+                self.anchor = None
+                return True
+        ends = self.placement_ends(x, y)
+        if not ends:
+            return False
+        if list(ends) == [(x, y)]:
+            self.own.add_ship(ends[(x, y)])
+            self.anchor = None
+        else:
+            self.anchor = cell
+        return True
+
+    def auto_place(self, rng=random, attempts=100):
+        # The ships still to place go to random free positions; False when they don't fit around the placed ones
+        placements = self.generator().placements
+        sizes = self.sizes_to_place()
+        placed = self.own_blocked()
+        for _ in range(attempts):
+            blocked = placed
+            fleet = []
+            for size in sizes:
+                options = [item for item in placements[size] if not item[0] & blocked]
+                if not options:
+                    break
+                mask, zone, cells = rng.choice(options)
+                blocked |= zone
+                fleet.append(cells)
+            else:
+                for cells in fleet:
+                    self.own.add_ship(cells)
+                self.anchor = None
+                return True
+        return False
+
+    def reset_fleet(self):
+        self.own = GameState(self.rows, self.cols)
+        self.anchor = None
+
+    def placement_board(self):
+        board = [[EMPTY] * self.cols for _ in range(self.rows)]
+        for cells in self.own.ship_cells:
+            for x, y in cells:
+                board[x][y] = SHIP
+        if self.anchor is not None:
+            anchor_x, anchor_y = divmod(self.anchor, self.cols)
+            for x, y in self.placement_ends(anchor_x, anchor_y):
+                board[x][y] = AVALIABLE
+            board[anchor_x][anchor_y] = BUILDING_SHIP
+        return PlayerBoard(self.rows, self.cols, EMPTY, board, self.state.game_id)
+
+    def bot_turn(self, rng=random):
+        # The bot fires until it misses or sinks the last ship: [(x, y, result)]
+        engine = get_targeting_engine(self.generator())
+        shots = []
+        while not self.own.is_won():
+            x, y = engine.next_shot(self.own, rng)
+            result = self.own.fire(x, y)
+            shots.append((x, y, result))
+            if result == SHOT_MISS:
+                break
+        return shots
+
+    def own_grid(self):
+        return fleet_grid(self.own)
+
+
+fleet_grid_rows = OrderedDict()
+
+
+def fleet_grid(state, max_rows=10000):
+    # A fleet as its owner sees it, as text: ships, and the other side's shots at them.
+    # A shot changes one row (a sunk ship at most a few), so rows are cached by their bits
+    cols = state.cols
+    row_mask = (1 << cols) - 1
+    shots = state.hits | state.misses
+    lines = []
+    for offset in range(0, state.rows * cols, cols):
+        key = (cols, state.ships >> offset & row_mask, shots >> offset & row_mask, state.sunk >> offset & row_mask)
+        line = fleet_grid_rows.get(key)
+        if line is None:
+            line = fleet_grid_rows[key] = ''.join(
+                (state.symbol(bit) if shots & bit else SHIP if state.ships & bit else EMPTY).strip()
+                for bit in (1 << cell for cell in range(offset, offset + cols)))
+            if len(fleet_grid_rows) > max_rows:
+                fleet_grid_rows.popitem(last=False)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class FleetGenerator:
+    # A search gives up after max_steps ship placements: most seeds need a dozen, but a fleet that barely
+    # fits can backtrack for minutes. Without a seed, generate() tries up to attempts seeds
+    def __init__(self, rows, cols, ships, max_steps=2000, attempts=5):
+        self.rows = rows
+        self.cols = cols
+        self.ships = sorted(ships, reverse=True)
+        self.placements = {size: self.list_placements(size) for size in set(ships)}
+        self.max_steps = max_steps
+        self.attempts = attempts
+
+    def list_placements(self, size):
+        # Every in-bounds (ship mask, no-touch zone mask, cells) for a ship of this size
+        placements = []
+        directions = [(0, 1)] if size == 1 else [(0, 1), (1, 0)]
+        for dx, dy in directions:
+            for x in range(self.rows - dx * (size - 1)):
+                for y in range(self.cols - dy * (size - 1)):
+                    coordinates = tuple((x + dx * i, y + dy * i) for i in range(size))
+                    mask = 0
+                    zone = 0
+                    for cx, cy in coordinates:
+                        mask |= 1 << (cx * self.cols + cy)
+                        for nx in range(max(cx - 1, 0), min(cx + 2, self.rows)):
+                            for ny in range(max(cy - 1, 0), min(cy + 2, self.cols)):
+                                zone |= 1 << (nx * self.cols + ny)
+                    placements.append((mask, zone, coordinates))
+        return placements
+
+    def generate(self, seed=None):
+        # (seed, fleet), or None when no seed tried gave a fleet within max_steps
+        seeds = [seed] if seed is not None else [random.getrandbits(64) for _ in range(self.attempts)]
+        for seed in seeds:
+            rng = random.Random(seed)
+            candidates = {}
+            for size, placements in self.placements.items():
+                candidates[size] = placements[:]
+                rng.shuffle(candidates[size])
+
+            fleet = []
+            if self.place(0, 0, 0, candidates, fleet, [self.max_steps]):
+                return seed, fleet
+        return None
+
+    def place(self, index, blocked, start, candidates, fleet, steps):
+        # Backtracking over valid placements only; ships of equal size take candidates in increasing order,
+        # so the same set of positions is never tried in another permutation. steps[0] is the budget left
+        if index == len(self.ships):
+            return True
+        size = self.ships[index]
+        placements = candidates[size]
+        if self.rows * self.cols - bin(blocked).count('1') < sum(self.ships[index:]):
+            return False
+        for i in range(start, len(placements)):
+            mask, zone, coordinates = placements[i]
+            if mask & blocked:
+                continue
+            steps[0] -= 1
+            if steps[0] < 0:
+                return False
+            fleet.append(coordinates)
+            next_start = i + 1 if index + 1 < len(self.ships) and self.ships[index + 1] == size else 0
+            if self.place(index + 1, blocked | zone, next_start, candidates, fleet, steps):
+                return True
+            fleet.pop()
+        return False
+
+
+fleet_generators = {}
+
+
+def get_fleet_generator(rows, cols, ships):
+    key = (rows, cols, tuple(ships))
+    if key not in fleet_generators:
+        fleet_generators[key] = FleetGenerator(rows, cols, ships)
+    return fleet_generators[key]
+
+
+class LayoutPool:
+    # Layouts are generated in the default executor, so a slow search never holds up the event loop
+    def __init__(self, generator, size):
+        self.generator = generator
+        self.size = size
+        self.layouts = deque()
+        self.refill_task = None
+
+    async def get(self):
+        if self.layouts:
+            layout = self.layouts.popleft()
+        else:
+            layout = await asyncio.get_running_loop().run_in_executor(None, self.generator.generate)
+        self.schedule_refill()
+        return layout
+
+    def schedule_refill(self):
+        if len(self.layouts) >= self.size or (self.refill_task and not self.refill_task.done()):
+            return
+        try:
+            self.refill_task = asyncio.get_running_loop().create_task(self.refill())
+        except RuntimeError:
+            pass
+
+    async def refill(self):
+        loop = asyncio.get_running_loop()
+        while len(self.layouts) < self.size:
+            layout = await loop.run_in_executor(None, self.generator.generate)
+            if layout is None:
+                return
+            self.layouts.append(layout)
+
+
+def check_board_modes():
+    # A fleet that doesn't fit its board, or only after a long search, fails at startup instead of on every new game
+    for name, mode in BOARD_MODES.items():
+        if get_fleet_generator(mode.rows, mode.cols, mode.ships).generate() is None:
+            raise ValueError(f"Unsupported board mode {name}: no {mode.rows}x{mode.cols} fleet of {mode.ships} found")
+
+
+# Only the default mode's pool is filled at startup, the others once someone plays them
+layout_pools = {name: LayoutPool(get_fleet_generator(mode.rows, mode.cols, mode.ships), BOT_SETTINGS.get('layout_pool_size', 100))
+                for name, mode in BOARD_MODES.items()}
+outbox = Outbox(**BOT_SETTINGS.get('outbox', {}))
+media = MediaCache(BOT_SETTINGS.get('media_cache', os.path.join(os.path.dirname(__file__), 'media_cache.json')))
+media.register('seafight', os.path.join(os.path.dirname(__file__), 'img', 'seafight.jpg'))
+game_store = GameStore(
+    open_game_backend(BOT_SETTINGS.get('game_store', os.path.join(os.path.dirname(__file__), 'games_state.db')),
+                      BOT_SETTINGS.get('game_store_retention', 7 * 86400)),
+    lambda game: game.to_bytes(), GameLogic.from_bytes,
+    BOT_SETTINGS.get('game_store_flush_interval', 5), BOT_SETTINGS.get('game_store_idle_ttl', 3600)
+)
+
 
 class LeaderboardManager:
     def __init__(self, conn):
         self.conn = conn
 
-    def add_leaderboard_entry(self, user_id, name, score):
+    def add_leaderboard_entries(self, entries):
+        # The caller commits
         cursor = self.conn.cursor()
-        cursor.execute('''
+        cursor.executemany('''
             INSERT INTO gamebot_leaderboard (user_id, name, score)
             VALUES (%s, %s, %s)
-        ''', (user_id, name, score))
-        self.conn.commit()
+        ''', entries)
+        cursor.close()
 
+    def create_best_scores_table(self):
+        # gamebot_leaderboard_best keeps one row per user and period: their best score of the day,
+        # week or all time (period_start 1970-01-01). It is updated with every batch of scores
+        cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT COUNT(*) + 1 AS position
-            FROM gamebot_leaderboard
-            WHERE score > %s
-        ''', (score,))
-        position = cursor.fetchone()[0]
+            CREATE TABLE IF NOT EXISTS gamebot_leaderboard_best (
+                period VARCHAR(8) NOT NULL,
+                period_start DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                name VARCHAR(255),
+                score INT NOT NULL,
+                date DATETIME,
+                PRIMARY KEY (period, period_start, user_id),
+                KEY period_score (period, period_start, score)
+            )
+        ''')
         cursor.close()
-        return position
 
-    def update_leader_board_name(self, user_id, leader_board_name):
+    def has_best_scores(self, period, start):
         cursor = self.conn.cursor()
         cursor.execute('''
-            UPDATE gamebot_users
-            SET leader_board_name = %s
-            WHERE user_id = %s
-        ''', (leader_board_name, user_id))
+            SELECT 1 FROM gamebot_leaderboard_best WHERE period = %s AND period_start = %s LIMIT 1
+        ''', (period, start))
+        found = cursor.fetchone() is not None
+        cursor.close()
+        return found
+
+    def backfill_best_scores(self, period, start):
+        # One pass over the entries of the period; afterwards the rollup is only ever updated in place
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT INTO gamebot_leaderboard_best (period, period_start, user_id, name, score, date)
+            SELECT %s, %s, l.user_id, MAX(l.name), b.score, MAX(l.date)
+            FROM gamebot_leaderboard l
+            JOIN (
+                SELECT user_id, MAX(score) AS score
+                FROM gamebot_leaderboard
+                WHERE date >= %s
+                GROUP BY user_id
+            ) b ON l.user_id = b.user_id AND l.score = b.score
+            WHERE l.date >= %s
+            GROUP BY l.user_id, b.score
+            ON DUPLICATE KEY UPDATE
+                name = IF(VALUES(score) > score, VALUES(name), name),
+                date = IF(VALUES(score) > score, VALUES(date), date),
+                score = GREATEST(score, VALUES(score))
+        ''', (period, start, start, start))
+        cursor.close()
+
+    def add_best_scores(self, rows):
+        # (period, period_start, user_id, name, score, date); the caller commits.
+        # Assignments run left to right, so score is compared before it is raised
+        cursor = self.conn.cursor()
+        cursor.executemany('''
+            INSERT INTO gamebot_leaderboard_best (period, period_start, user_id, name, score, date)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                name = IF(VALUES(score) > score, VALUES(name), name),
+                date = IF(VALUES(score) > score, VALUES(date), date),
+                score = GREATEST(score, VALUES(score))
+        ''', rows)
+        cursor.close()
+
+    def expire_best_scores(self, starts):
+        # Days and weeks that are over go by primary key range, the entries table is never touched
+        cursor = self.conn.cursor()
+        for period, start in starts.items():
+            if period != 'all':
+                cursor.execute('''
+                    DELETE FROM gamebot_leaderboard_best WHERE period = %s AND period_start < %s
+                ''', (period, start))
         self.conn.commit()
         cursor.close()
 
-    def get_top_leaderboard(self, limit=100):
+    def get_best_top(self, period, start, limit=100):
         cursor = self.conn.cursor(dictionary=True)
         cursor.execute('''
             SELECT user_id, name, score, date
-            FROM gamebot_leaderboard
+            FROM gamebot_leaderboard_best
+            WHERE period = %s AND period_start = %s
             ORDER BY score DESC
             LIMIT %s
-        ''', (limit,))
+        ''', (period, start, limit))
         results = cursor.fetchall()
         cursor.close()
         return results
 
-class Ship:
-    def __init__(self, size, symbol):
-        self.size = size
-        self.symbol = symbol
-        self.coordinates = []
-        self.empty_zone = []
-
-    def get_coordinates(self):
-        return self.coordinates
-
-    def place(self, x, y, direction, board):
-        if direction == 'horizontal':
-            self.coordinates = [(x, y + i) for i in range(self.size)]
-            self.empty_zone = [(x + dx, y + dy) for dx in range(-1, 2) for dy in range(-1, self.size + 1)]
-
-        elif direction == 'vertical':
-            self.coordinates = [(x + i, y) for i in range(self.size)]
-            self.empty_zone = [(x + dx, y + dy) for dx in range(-1, self.size + 1) for dy in range(-1, 2)]
-
-        if all(0 <= x < board.rows and 0 <= y < board.cols and board.is_cell_empty(x, y) for x, y in self.coordinates):
-            if all(board.is_cell_empty(x, y) for x, y in self.empty_zone if 0 <= x < board.rows and 0 <= y < board.cols):
-                board.place_ship(self)
-                return True
-        return False
-
+    def get_best_scores(self, period, start):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT user_id, score
+            FROM gamebot_leaderboard_best
+            WHERE period = %s AND period_start = %s
+        ''', (period, start))
+        results = cursor.fetchall()
+        cursor.close()
+        return results
 
 class ButtonFactory:
     def create_button(self, text_key, callback_data, language_code, **format_kwargs):
@@ -261,11 +805,107 @@ class ButtonFactory:
 
         return InlineKeyboardButton(text, callback_data=callback_data)
 
+class SeaFightKeyboardCache:
+    def __init__(self, max_rows=10000, max_pages=2000, max_messages=10000):
+        self.max_rows = max_rows
+        self.max_pages = max_pages
+        self.max_messages = max_messages
+        self.pages = OrderedDict()
+        self.rows = OrderedDict()
+        self.messages = OrderedDict()
+
+    def get_page(self, action, game_id, top, left, height, width):
+        # Callback data of a page's cells is signed once per game; each cell then keeps its buttons per symbol
+        key = (action, game_id, top, left)
+        page = self.pages.get(key)
+        if page is None:
+            page = self.pages[key] = [[(callbacks.encode(action, game_id, x, y, top, left), {})
+                                       for y in range(left, left + width)] for x in range(top, top + height)]
+            if len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(key)
+        return page
+
+    def get_button(self, cell, sym):
+        button = cell[1].get(sym)
+        if button is None:
+            button = cell[1][sym] = InlineKeyboardButton(sym, callback_data=cell[0])
+        return button
+
+    def cache_row(self, key, build):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = build()
+            if len(self.rows) > self.max_rows:
+                self.rows.popitem(last=False)
+        else:
+            self.rows.move_to_end(key)
+        return row
+
+    def get_rows(self, player_board, top=0, left=0, action=ACTION_FIRE):
+        # Rows are cached by game and content, so only rows that changed since the last render are rebuilt
+        board_rows, board_cols, game_id = player_board.rows, player_board.cols, player_board.game_id
+        paged = board_rows > VIEWPORT_ROWS or board_cols > VIEWPORT_COLS
+        if paged:
+            top = max(0, min(top, board_rows - VIEWPORT_ROWS))
+            left = max(0, min(left, board_cols - VIEWPORT_COLS))
+        else:
+            top = left = 0
+
+        height = min(VIEWPORT_ROWS, board_rows) if paged else board_rows
+        width = min(VIEWPORT_COLS, board_cols) if paged else board_cols
+        page = self.get_page(action, game_id, top, left, height, width)
+        rows = []
+        for y in range(top, top + height):
+            line = player_board.board[y][left:left + width]
+            rows.append(self.cache_row(
+                (action, game_id, y, top, left, tuple(line)),
+                lambda: tuple(self.get_button(cell, sym) for cell, sym in zip(page[y - top], line))))
+        if paged:
+            rows.append(self.cache_row(('view', game_id, board_rows, board_cols, top, left),
+                                       lambda: self.get_view_row(board_rows, board_cols, top, left, game_id)))
+        return tuple(rows)
+
+    def get_view_row(self, board_rows, board_cols, top, left, game_id):
+        # Arrows move the page by a whole page, clamped to the board; an arrow that can't move is left out
+        moves = (('◀', top, left - VIEWPORT_COLS), ('▲', top - VIEWPORT_ROWS, left),
+                 ('▼', top + VIEWPORT_ROWS, left), ('▶', top, left + VIEWPORT_COLS))
+        row = []
+        for sym, new_top, new_left in moves:
+            new_top = max(0, min(new_top, board_rows - VIEWPORT_ROWS))
+            new_left = max(0, min(new_left, board_cols - VIEWPORT_COLS))
+            if (new_top, new_left) != (top, left):
+                row.append(InlineKeyboardButton(sym, callback_data=callbacks.encode(ACTION_VIEW, game_id, new_top, new_left)))
+        return tuple(row)
+
+    def get_text(self, chat_id, message_id):
+        message = self.messages.get((chat_id, message_id))
+        return message[0] if message else None
+
+    def update_message(self, chat_id, message_id, text, rows):
+        key = (chat_id, message_id)
+        if self.messages.get(key) == (text, rows):
+            return False
+        self.messages[key] = (text, rows)
+        self.messages.move_to_end(key)
+        if len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+        return True
+
+    def forget_message(self, chat_id, message_id):
+        self.messages.pop((chat_id, message_id), None)
+
+
+sea_fight_keyboards = SeaFightKeyboardCache()
+
+
 class KeyboardBuilder:
     def __init__(self, button_factory):
         self.button_factory = button_factory
 
-    def create_name_keyboard(self, language_code, current_user_info):
+    def create_name_keyboard(self, language_code, current_user_info, game_id):
+        # Bound to the won game, so the buttons go stale once another game starts
         keyboard = []
         row = []
 
@@ -273,246 +913,722 @@ class KeyboardBuilder:
         if name:
             button = self.button_factory.create_button(
                 'text_use_name',
-                'name_tg' if not current_user_info.get('leader_board_name') else 'name_lastused',
+                callbacks.encode(ACTION_NAME_TG if not current_user_info.get('leader_board_name') else ACTION_NAME_LASTUSED,
+                                 game_id),
                 language_code=language_code,
                 name=name  # Передаем имя для форматирования
             )
             row.append(button)
 
-        row.append(self.button_factory.create_button('text_use_other_name', 'name_new', language_code))
+        row.append(self.button_factory.create_button('text_use_other_name', callbacks.encode(ACTION_NAME_NEW, game_id), language_code))
         keyboard.append(row)
 
         keyboard.append([
-            self.button_factory.create_button('text_leaderboard_skip', 'leaderboard_skip', language_code)
+            self.button_factory.create_button('text_leaderboard_skip', callbacks.encode(ACTION_LEADERBOARD_SKIP, game_id),
+                                              language_code)
         ])
 
         return InlineKeyboardMarkup(keyboard)
 
     def create_main_keyboard(self, language_code):
+        # Static per language, so pre-rendered once
+        language_code = resolve_language(language_code)
+        if language_code in main_keyboards:
+            return main_keyboards[language_code]
         keyboard = [
-            [self.button_factory.create_button('btn_new_game', 'newgame', language_code)],
-            [self.button_factory.create_button('btn_leaderboard', 'leaderboard_show', language_code)]
+            [self.button_factory.create_button('btn_new_game', callbacks.encode(ACTION_NEW_GAME), language_code),
+             self.button_factory.create_button('btn_board_size', callbacks.encode(ACTION_BOARDS), language_code)],
+            [self.button_factory.create_button('btn_vs_bot', callbacks.encode(ACTION_DUEL), language_code),
+             self.button_factory.create_button('btn_vs_player', callbacks.encode(ACTION_PVP_JOIN), language_code)],
+            [self.button_factory.create_button('btn_leaderboard', callbacks.encode(ACTION_LEADERBOARD_SHOW), language_code)]
         ]
-        return InlineKeyboardMarkup(keyboard)
-
-    def create_sea_fight_keyboard(self, player_board):
+        main_keyboards[language_code] = InlineKeyboardMarkup(keyboard)
+        return main_keyboards[language_code]
+
+    def create_sea_fight_keyboard(self, player_board, top=0, left=0):
+        return InlineKeyboardMarkup(sea_fight_keyboards.get_rows(player_board, top, left))
+
+    def create_leaderboard_keyboard(self, language_code, period, page, pages):
+        # Period tabs and arrows to the neighbouring pages above the main keyboard; a handful per language, built once
+        key = (language_code, period, page, pages)
+        if key in leaderboard_keyboards:
+            return leaderboard_keyboards[key]
+        period_index = PERIODS.index(period)
+        tabs = [InlineKeyboardButton(f"✅ {get_translation(language_code, f'btn_leaderboard_{other}')}" if other == period
+                                     else get_translation(language_code, f'btn_leaderboard_{other}'),
+                                     callback_data=callbacks.encode(ACTION_LEADERBOARD_SHOW, 0, 0, index))
+                for index, other in enumerate(PERIODS)]
+        keyboard = [tabs] + list(self.create_main_keyboard(language_code).inline_keyboard)
+        arrows = [InlineKeyboardButton(sym, callback_data=callbacks.encode(ACTION_LEADERBOARD_SHOW, 0, new_page, period_index))
+                  for sym, new_page in (('◀', page - 1), ('▶', page + 1)) if 0 <= new_page < pages]
+        if arrows:
+            keyboard.insert(0, arrows)
+        leaderboard_keyboards[key] = InlineKeyboardMarkup(keyboard)
+        return leaderboard_keyboards[key]
+
+    def create_placement_row(self, language_code, game_id):
+        return sea_fight_keyboards.cache_row(('placing', game_id, language_code), lambda: (
+            self.button_factory.create_button('btn_place_random', callbacks.encode(ACTION_PLACE_AUTO, game_id), language_code),
+            self.button_factory.create_button('btn_place_reset', callbacks.encode(ACTION_PLACE_RESET, game_id), language_code)))
+
+    def create_pvp_row(self, language_code, key):
+        # Leaves the lobby, or gives up the match
+        return sea_fight_keyboards.cache_row(('pvp', key, language_code), lambda: (
+            self.button_factory.create_button(key, callbacks.encode(ACTION_PVP_LEAVE), language_code),))
+
+    def create_board_mode_keyboard(self, current_mode):
         keyboard = []
-        for y in range(player_board.rows):
-            row = []
-            for x in range(player_board.cols):
-                sym = player_board.board[y][x]
-                row.append(InlineKeyboardButton(sym, callback_data=f'fire_{x}_{y}'))
-            keyboard.append(row)
+        for index, mode in enumerate(BOARD_MODES.values()):
+            label = f'✅ {mode.label}' if mode is current_mode else mode.label
+            keyboard.append([InlineKeyboardButton(label, callback_data=callbacks.encode(ACTION_NEW_GAME, 0, index))])
         return InlineKeyboardMarkup(keyboard)
 
 
-async def send_game_start_message(update, context, user, game_manager):
-    image_path = os.path.join(os.path.dirname(__file__), 'img', f"seafight.jpg")
-    button_factory = ButtonFactory()
-    keyboard_builder = KeyboardBuilder(button_factory)
-    with open(image_path, 'rb') as photo:
-        main_keyboard = keyboard_builder.create_main_keyboard(user.language_code)
-        await context.bot.send_photo(chat_id=user.id, photo=photo, parse_mode='HTML',
-                                     reply_markup=main_keyboard)
+# Both are stateless, so one of each serves every handler
+button_factory = ButtonFactory()
+keyboard_builder = KeyboardBuilder(button_factory)
+
+
+async def register_user(user, phone_number, source):
+    user_info = await db_pool.run(fetch_user_info, user.id)
+    if user_info == -1:
+        writes.put('user', (user.id, user.first_name, user.last_name, user.username, phone_number,
+                            user.is_bot, user.language_code, user.is_premium, source))
+        user_info = {'user_id': user.id, 'first_name': user.first_name, 'leader_board_name': None}
+    return user_info
 
-    kbd = keyboard_builder.create_sea_fight_keyboard(game_manager.player_board)
+async def queue_leader_board_name(user_id, name):
+    if not is_safe_leader_board_name(name):
+        return False
+    writes.put('name', (name, user_id))
+    return True
+
+def fetch_user_info(conn, user_id):
+    return UserManager(conn).get_user_info(user_id)
+
+main_keyboards = {}
+leaderboard_keyboards = {}
+for language in languages:
+    keyboard_builder.create_main_keyboard(language)
+
+
+def prepare_leaderboard(conn, starts):
+    leaderboard_manager = LeaderboardManager(conn)
+    leaderboard_manager.create_best_scores_table()
+    for period, start in starts.items():
+        if not leaderboard_manager.has_best_scores(period, start):
+            leaderboard_manager.backfill_best_scores(period, start)
+    conn.commit()
+
+def load_leaderboard(conn, limit, starts):
+    leaderboard_manager = LeaderboardManager(conn)
+    leaderboard_manager.expire_best_scores(starts)
+    return {period: (leaderboard_manager.get_best_top(period, start, limit), leaderboard_manager.get_best_scores(period, start))
+            for period, start in starts.items()}
+
+def write_batch(conn, ops):
+    # One transaction per batch: new users first, so name updates and scores never precede their user
+    users, names, scores = [], {}, []
+    for kind, row in ops:
+        if kind == 'user':
+            users.append(row)
+        elif kind == 'name':
+            names[row[1]] = row
+        elif kind == 'score':
+            scores.append(row)
+    try:
+        if users:
+            UserManager(conn).save_users_info(users)
+        if names:
+            UserManager(conn).update_leader_board_names(list(names.values()))
+        if scores:
+            leaderboard_manager = LeaderboardManager(conn)
+            leaderboard_manager.add_leaderboard_entries([row[:3] for row in scores])
+            leaderboard_manager.add_best_scores(best_score_rows(scores))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def best_score_rows(scores):
+    # Rollup rows of (user_id, name, score, date) entries, one per user and period: the batch's best.
+    # Entries journaled before they carried their time count as now
+    best = {}
+    for user_id, name, score, *when in scores:
+        when = when[0] if when else datetime.now().isoformat(sep=' ', timespec='seconds')
+        day = date.fromisoformat(when[:10])
+        for period in PERIODS:
+            key = (period, period_start(period, day), user_id)
+            if key not in best or score > best[key][4]:
+                best[key] = key + (name, score, when)
+    return list(best.values())
+
+
+game_log.configure(
+    BOT_SETTINGS.get('game_log', os.path.join(os.path.dirname(__file__), 'games.log')),
+    max_bytes=BOT_SETTINGS.get('game_log_max_bytes', 64 * 1024 * 1024),
+    backups=BOT_SETTINGS.get('game_log_backups', 5),
+    flush_interval=BOT_SETTINGS.get('game_log_flush_interval', 5)
+)
+
+
+writes.configure(
+    lambda ops: db_pool.run(write_batch, ops),
+    max_batch=BOT_SETTINGS.get('write_batch_size', 500),
+    flush_interval=BOT_SETTINGS.get('write_flush_interval', 1),
+    journal_path=BOT_SETTINGS.get('write_journal', os.path.join(os.path.dirname(__file__), 'writes_journal.log')),
+    fsync=BOT_SETTINGS.get('write_journal_fsync', False),
+    max_failures=BOT_SETTINGS.get('write_max_failures', 3),
+    dead_letter_path=BOT_SETTINGS.get('write_dead_letter', os.path.join(os.path.dirname(__file__), 'writes_dead_letter.log')),
+    # The server being unreachable says nothing about the rows
+    is_transient=lambda error: isinstance(error, (mysql.connector.OperationalError, mysql.connector.InterfaceError))
+)
+
+
+user_profiles = UserProfileCache(
+    lambda user_id: db_pool.run(fetch_user_info, user_id),
+    register_user,
+    queue_leader_board_name,
+    max_size=BOT_SETTINGS.get('user_cache_size', 10000),
+    ttl=BOT_SETTINGS.get('user_cache_ttl', 600)
+)
+def render_leaderboard_page(language_code, period, entries, first_position, page, pages):
+    title = get_translation(language_code, f'text_leaderboard_{period}')
+    lines = [f"{title} ({page + 1}/{pages})" if pages > 1 else title]
+    # Names picked from Telegram profiles are not validated, and the page is sent as HTML
+    lines.extend(f"{position}. {html.escape(entry['name'] or '')} [{entry['score']}]"
+                 for position, entry in enumerate(entries, first_position))
+    return '\n'.join(lines)
+
+leaderboard = Leaderboard(
+    lambda limit, starts: db_pool.run(load_leaderboard, limit, starts),
+    writes,
+    refresh_interval=BOT_SETTINGS.get('leaderboard_refresh_interval', 300),
+    page_size=BOT_SETTINGS.get('leaderboard_page_size', 10),
+    render=render_leaderboard_page,
+    languages=languages,
+    render_delay=BOT_SETTINGS.get('leaderboard_render_delay', 1)
+)
+
+
+async def edit_sea_fight_message(context, chat_id, message_id, text, rows, priority=PRIORITY_DIRECT):
+    # Skipping identical edits avoids Telegram's "message is not modified" round trip
+    if not sea_fight_keyboards.update_message(chat_id, message_id, text, rows):
+        return
+    try:
+        await outbox.send(context.bot, 'edit_message_text', priority, chat_id=chat_id, message_id=message_id, text=text,
+                          parse_mode='HTML', reply_markup=InlineKeyboardMarkup(rows))
+    except Exception:
+        sea_fight_keyboards.forget_message(chat_id, message_id)
+        raise
+
+
+async def send_game_start_message(update, context, user, game_manager):
+    main_keyboard = keyboard_builder.create_main_keyboard(user.language_code)
+    await media.send(outbox, context.bot, 'send_photo', 'seafight', chat_id=user.id, parse_mode='HTML',
+                     reply_markup=main_keyboard)
 
-    await context.bot.send_message(chat_id=user.id, parse_mode='HTML', text=get_translation(user.language_code, "text_sea_fight"), reply_markup=kbd)
+    rows = sea_fight_keyboards.get_rows(game_manager.player_board)
+    text = get_translation(user.language_code, "text_sea_fight")
+    message = await outbox.send(context.bot, 'send_message', chat_id=user.id, parse_mode='HTML', text=text, reply_markup=InlineKeyboardMarkup(rows))
+    sea_fight_keyboards.update_message(user.id, message.message_id, text, rows)
 
 async def send_error_message(update, context, user):
-    button_factory = ButtonFactory()
-    keyboard_builder = KeyboardBuilder(button_factory)
     kbd = keyboard_builder.create_main_keyboard(user.language_code)
-    await context.bot.send_message(chat_id=user.id, parse_mode='HTML', text=get_translation(user.language_code, "error_text_cant_generate_board"), reply_markup=kbd)
+    await outbox.send(context.bot, 'send_message', chat_id=user.id, parse_mode='HTML', text=get_translation(user.language_code, "error_text_cant_generate_board"), reply_markup=kbd)
+
+def get_board_mode(context):
+    return BOARD_MODES.get(context.user_data.get('board_mode'), BOARD_MODES[DEFAULT_BOARD_MODE])
 
+@timed('handler_seconds')
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
-    with DatabaseConnectionManager() as conn:
-        user_manager = UserManager(conn)
-        current_user_info = user_manager.get_user_info(user.id)
-        if current_user_info == -1:
-            user_manager.save_user_info(
-                user.id, user.first_name, user.last_name, user.username,
-                update.message.contact.phone_number if update.message.contact else None,
-                user.is_bot, user.language_code, user.is_premium,
-                context.args[0][:50] if context.args else None
-            )
-
-    await update.message.reply_text(
-        get_translation(user.language_code, "text_start_msg"),
-        reply_markup=ReplyKeyboardRemove()
+    await user_profiles.register(
+        user,
+        update.message.contact.phone_number if update.message.contact else None,
+        context.args[0][:50] if context.args else None
     )
 
-    game_manager = GameLogic(ROWS, COLS, EMPTY, SHIP)
-    if game_manager.generate_board(SHIPS):
+    await outbox.send(context.bot, 'send_message', chat_id=user.id,
+                      text=get_translation(user.language_code, "text_start_msg"), reply_markup=ReplyKeyboardRemove())
+
+    mode = get_board_mode(context)
+    game_manager = GameLogic(mode.rows, mode.cols, EMPTY, SHIP)
+    layout = await layout_pools[mode.name].get()
+    if layout and game_manager.generate_board(mode.ships, layout=layout):
         await send_game_start_message(update, context, user, game_manager)
-        context.user_data['board'] = game_manager.board.board
-        context.user_data['player_board'] = game_manager.player_board.board
+        game_store.put(user.id, game_manager)
     else:
         await send_error_message(update, context, user)
 
 
+class ButtonClick:
+    __slots__ = ('update', 'context', 'user', 'user_id', 'chat_id', 'message_id', 'language_code', 'game', 'state',
+                 'score', 'game_id', 'args')
+
+    def __init__(self, update, context, user, game, game_id, args):
+        self.update = update
+        self.context = context
+        self.user = user
+        self.user_id = user.id
+        self.chat_id = update.effective_chat.id
+        self.message_id = update.callback_query.message.message_id
+        self.language_code = user.language_code
+        self.game = game
+        self.state = game.state if game else None
+        self.score = game.state.score if game else 0
+        self.game_id = game_id
+        self.args = args
+
+
+@timed('handler_seconds', lambda action: f"handle_button_{action_name(action)}")
 async def handle_button(update: Update, context: CallbackContext):
+    # Returns the decoded action for the handler_seconds label, so the data is only decoded once
     query = update.callback_query
     user = query.from_user
-    user_id = user.id
-    print(f'[{user_id}] {bcolors.OKCYAN}handle_callback_query{bcolors.ENDC}  {datetime.now()}')
+    metrics.log('callback_query', user_id=user.id, data=query.data)
     await query.answer()
-    data = query.data
-    print(f'[{user_id}] data = {data}')
-    language_code = update.effective_user.language_code
-    chat_id = update.effective_chat.id
-    message_id = query.message.message_id
-
-    data = data.split('_')
-    score = context.user_data.get('score', 0)
-    initial_board = context.user_data.get('board', None)
-    initial_player_board = context.user_data.get('player_board', None)
-
-    game_logic = GameLogic(ROWS, COLS, EMPTY, SHIP, initial_board, initial_player_board)
-    button_factory = ButtonFactory()
-    keyboard_builder = KeyboardBuilder(button_factory)
-
-    if data[0] == 'fire':
-        if game_logic and not game_logic.check_if_won():
-            _, y, x = data
-            x = int(x)
-            y = int(y)
-
-            text = get_translation(language_code, 'text_miss')
-
-            if game_logic.board.is_ship_placed(x, y):
-                game_logic.player_board.update_cell(x, y, BANG)
-                game_logic.board.update_cell(x, y, BANG)
-                score += 10
-
-                if game_logic.check_if_killed(x, y):
-                    text = get_translation(language_code, 'text_killed')
-                    await blinking_sea_fight(x, y, game_logic.board.board, game_logic.player_board, context, chat_id, message_id, text + f"\n{get_translation(language_code, 'text_score')}: {score}")
-                else:
-                    text = get_translation(language_code, 'text_damaged')
-
-            elif game_logic.board.is_cell_empty(x, y):
-                game_logic.player_board.update_cell(x, y, MISS)
-                score -= 1
-            else:
+
+    decoded = callbacks.decode(query.data)
+    if decoded is None:
+        # Forged, or signed with a previous callback_secret
+        return None
+    action, game_id, args = decoded
+    handler, uses_game, needs_current_game = button_handlers.get(action, (None, False, False))
+    if handler is None:
+        return action
+
+    game = await game_store.get(user.id) if uses_game else None
+    if needs_current_game and (game is None or game.state.game_id != game_id):
+        # A keyboard of an earlier game
+        return action
+    await handler(ButtonClick(update, context, user, game, game_id, args))
+    return action
+
+
+async def on_fire(click):
+    # Arguments are signed and bound to this game, so they are always on the board
+    if isinstance(click.game, DuelGame):
+        return await on_duel_fire(click)
+    x, y, top, left = click.args
+    game_logic, state = click.game, click.state
+    if state.is_won() or state.is_shot(x, y):
+        return
+
+    context, chat_id, message_id, language_code = click.context, click.chat_id, click.message_id, click.language_code
+    user_id, score = click.user_id, click.score
+    text = get_translation(language_code, 'text_miss')
+    sunk_ship = None
+
+    result = game_logic.fire(x, y)
+    score += SHOT_POINTS[result]
+    if result == SHOT_SUNK:
+        text = get_translation(language_code, 'text_killed')
+        sunk_ship = game_logic.get_ship_cells(x, y)
+    elif result == SHOT_HIT:
+        text = get_translation(language_code, 'text_damaged')
+
+    cancel_animation(chat_id, message_id)
+    player_board = game_logic.player_board
+    rows = sea_fight_keyboards.get_rows(player_board, top, left)
+
+    state.score = score
+    game_store.put(user_id, game_logic)
+    game_log.shot(user_id, state, x, y, click.score)
+    if context.user_data.get('operation'):
+        context.user_data['operation'] = ""
+
+    if game_logic.check_if_won():
+        text = format_translation(language_code, 'text_win', score)
+        await edit_sea_fight_message(context, chat_id, message_id, text, rows)
+        # The last ship blinks too; its frames carry the win text, so they don't overwrite it
+        start_blinking_sea_fight(sunk_ship, player_board, context, chat_id, message_id, text, top, left)
+
+        await outbox.send(context.bot, 'send_message', chat_id=user_id, text=get_translation(language_code, 'text_share_msg'))
+        text = format_translation(language_code, 'text_share_text', score)
+        await outbox.send(context.bot, 'send_message', chat_id=user_id, text=text, parse_mode='HTML')
+
+        current_user_info = await user_profiles.get(user_id)
+        if current_user_info is None:
+            # Without the profile there is no name to offer; the win itself is already shown
+            return
+
+        name_kbd = keyboard_builder.create_name_keyboard(language_code, current_user_info, state.game_id)
+
+        if not current_user_info['leader_board_name'] or current_user_info['leader_board_name'] == '':
+            await outbox.send(context.bot, 'send_message', chat_id=user_id, text=get_translation(language_code, 'text_need_your_name'), reply_markup=name_kbd)
+            context.user_data['operation'] = "waiting_for_name"
+        else:
+            await outbox.send(context.bot, 'send_message', chat_id=user_id, text=get_translation(language_code, 'text_leaderboard_adding'), reply_markup=name_kbd)
+
+    else:
+        text += f"\n{get_translation(language_code, 'text_score')}: {score}"
+        await edit_sea_fight_message(context, chat_id, message_id, text, rows)
+        if sunk_ship:
+            start_blinking_sea_fight(sunk_ship, player_board, context, chat_id, message_id, text, top, left)
+
+
+def can_submit_score(user_data, game):
+    # Only a won solo game goes to the leaderboard, and only once
+    return (game is not None and not isinstance(game, DuelGame) and game.state.is_won()
+            and user_data.get('leaderboard_game') != game.state.game_id)
+
+
+async def add_to_leaderboard(click, name):
+    click.context.user_data['operation'] = ""
+    if not can_submit_score(click.context.user_data, click.game):
+        return
+    click.context.user_data['leaderboard_game'] = click.state.game_id
+    position = leaderboard.add(click.user_id, name, click.score)
+
+    text = format_translation(click.language_code, 'text_leaderboard_added', name, position, click.score)
+    new_kbd = keyboard_builder.create_main_keyboard(click.language_code)
+
+    try:
+        await outbox.send(click.context.bot, 'delete_message', chat_id=click.user_id, message_id=click.message_id)
+    except Exception as e:
+        metrics.log('leaderboard_delete_failed', user_id=click.user_id, message_id=click.message_id, error=str(e))
+
+    await outbox.send(click.context.bot, 'send_message', chat_id=click.user_id, text=text, reply_markup=new_kbd)
+
+
+async def on_name_tg(click):
+    current_user_info = await user_profiles.get(click.user_id)
+    await add_to_leaderboard(click, current_user_info['first_name'] if current_user_info else click.user.first_name)
+
+
+async def on_name_lastused(click):
+    current_user_info = await user_profiles.get(click.user_id)
+    if current_user_info is None:
+        return
+    await add_to_leaderboard(click, current_user_info['leader_board_name'])
+
+
+async def on_name_new(click):
+    await outbox.send(click.context.bot, 'send_message', chat_id=click.user_id,
+                      text=get_translation(click.language_code, 'text_send_your_name'))
+    click.context.user_data['operation'] = "waiting_for_name"
+
+
+async def on_leaderboard_skip(click):
+    new_kbd = keyboard_builder.create_main_keyboard(click.language_code)
+    await outbox.send(click.context.bot, 'edit_message_text', chat_id=click.chat_id, message_id=click.message_id,
+                      text=f"{get_translation(click.language_code, 'text_you_won')}: {click.score}",
+                      parse_mode='HTML', reply_markup=new_kbd)
+
+
+async def on_leaderboard_show(click):
+    # Pages are rendered by the leaderboard's refresh job; only the user's own place is added here
+    # Arguments are (page, period index); keyboards sent before periods existed only carry the page
+    language_code = resolve_language(click.language_code)
+    page = click.args[0] if click.args else 0
+    period = PERIODS[click.args[1]] if len(click.args) > 1 and click.args[1] < len(PERIODS) else 'all'
+    text, page, pages = leaderboard.page(language_code, page, period)
+    position = leaderboard.user_position(click.user_id, period)
+    if position:
+        text = f"{text}\n\n{format_translation(language_code, 'text_leaderboard_you', *position)}"
+    new_kbd = keyboard_builder.create_leaderboard_keyboard(language_code, period, page, pages)
+
+    # The start photo has no text to edit, so it gets a new message without a failed edit first
+    if getattr(click.update.callback_query.message, 'text', None):
+        try:
+            await outbox.send(click.context.bot, 'edit_message_text', chat_id=click.chat_id, message_id=click.message_id,
+                              text=text, parse_mode='HTML', reply_markup=new_kbd)
+            return
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
                 return
+            metrics.log('leaderboard_edit_failed', user_id=click.user_id, message_id=click.message_id, error=str(e))
+    await outbox.send(click.context.bot, 'send_message', chat_id=click.chat_id, text=text,
+                      parse_mode='HTML', reply_markup=new_kbd)
+
+
+async def on_view(click):
+    top, left = click.args
+    rows = sea_fight_keyboards.get_rows(click.game.player_board, top, left)
+    text = sea_fight_keyboards.get_text(click.chat_id, click.message_id)
+    if text is None:
+        text = (f"{get_translation(click.language_code, 'text_sea_fight')}\n"
+                f"{get_translation(click.language_code, 'text_score')}: {click.score}")
+    cancel_animation(click.chat_id, click.message_id)
+    await edit_sea_fight_message(click.context, click.chat_id, click.message_id, text, rows)
+
+
+async def on_boards(click):
+    keyboard = keyboard_builder.create_board_mode_keyboard(get_board_mode(click.context))
+    await outbox.send(click.context.bot, 'edit_message_reply_markup', chat_id=click.chat_id,
+                      message_id=click.message_id, reply_markup=keyboard)
+
+
+async def on_new_game(click):
+    if click.args and click.args[0] < len(BOARD_MODE_NAMES):
+        click.context.user_data['board_mode'] = BOARD_MODE_NAMES[click.args[0]]
+    mode = get_board_mode(click.context)
+    game_manager = GameLogic(mode.rows, mode.cols, EMPTY, SHIP)
+    layout = await layout_pools[mode.name].get()
+    if layout and game_manager.generate_board(mode.ships, layout=layout):
+        await send_game_start_message(click.update, click.context, click.user, game_manager)
+        game_store.put(click.user_id, game_manager)
+        metrics.log('new_game', user_id=click.user_id, seed=game_manager.state.seed)
+    else:
+        await send_error_message(click.update, click.context, click.user)
 
-            new_kbd = keyboard_builder.create_sea_fight_keyboard(game_logic.player_board)
 
-            context.user_data['score'] = score
-            context.user_data['board'] = game_logic.board.board
-            context.user_data['player_board'] = game_logic.player_board.board
-            context.user_data['operation'] = ""
+def cell_name(x, y):
+    return f"{chr(ord('A') + y)}{x + 1}"
 
-            if game_logic.check_if_won():
-                text = get_translation(language_code, 'text_win')
-                text = replace_placeholders(text, score)
-                await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
-                                                    parse_mode='HTML', reply_markup=new_kbd)
 
-                await context.bot.send_message(chat_id=user_id, text=get_translation(language_code, 'text_share_msg'))
-                text = get_translation(language_code, 'text_share_text')
-                text = replace_placeholders(text, score)
-                await context.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML')
+def get_placement_view(duel, language_code):
+    sizes = duel.sizes_to_place()
+    text = format_translation(language_code, 'text_place_ship' if sizes[0] > 1 else 'text_place_ship_single',
+                              sizes[0], len(sizes))
+    rows = sea_fight_keyboards.get_rows(duel.placement_board(), action=ACTION_PLACE)
+    return text, rows + (keyboard_builder.create_placement_row(language_code, duel.state.game_id),)
 
-                with DatabaseConnectionManager() as conn:
-                    user_manager = UserManager(conn)
-                    current_user_info = user_manager.get_user_info(user_id)
 
-                name_kbd = keyboard_builder.create_name_keyboard(language_code, current_user_info)
+def get_duel_view(duel, language_code, status):
+    text = f"{status}\n\n{get_translation(language_code, 'text_your_fleet')}\n{duel.own_grid()}"
+    return text, sea_fight_keyboards.get_rows(duel.player_board)
 
-                if not current_user_info['leader_board_name'] or current_user_info['leader_board_name'] == '':
-                    await context.bot.send_message(chat_id=user_id, text=get_translation(language_code, 'text_need_your_name'), reply_markup=name_kbd)
-                    context.user_data['operation'] = "waiting_for_name"
-                else:
-                    await context.bot.send_message(chat_id=user_id, text=get_translation(language_code, 'text_leaderboard_adding'), reply_markup=name_kbd)
 
-            else:
-                text += f"\n{get_translation(language_code, 'text_score')}: {score}"
-                await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
-                                                    parse_mode='HTML', reply_markup=new_kbd)
+async def on_duel(click):
+    mode = get_board_mode(click.context)
+    if mode.rows > VIEWPORT_ROWS or mode.cols > VIEWPORT_COLS:
+        # Fleets are placed on a single page, so bigger boards play the duel on the default one
+        mode = BOARD_MODES[DEFAULT_BOARD_MODE]
+    duel = DuelGame(mode.rows, mode.cols, EMPTY, SHIP)
+    layout = await layout_pools[mode.name].get()
+    if not layout or not duel.generate_board(mode.ships, layout=layout):
+        await send_error_message(click.update, click.context, click.user)
+        return
+    game_store.put(click.user_id, duel)
+    metrics.log('new_duel', user_id=click.user_id, seed=duel.state.seed)
 
-    elif data[0] == 'name':
-        if data[1] == 'tg':
-            context.user_data['operation'] = ""
-            with DatabaseConnectionManager() as conn:
-                user_manager = UserManager(conn)
-                current_user_info = user_manager.get_user_info(user_id)
-                name = current_user_info['first_name']
-                leaderboard_manager = LeaderboardManager(conn)
-                position = leaderboard_manager.add_leaderboard_entry(user_id, name, score)
+    text, rows = get_placement_view(duel, click.language_code)
+    message = await outbox.send(click.context.bot, 'send_message', chat_id=click.user_id, text=text, parse_mode='HTML',
+                                reply_markup=InlineKeyboardMarkup(rows))
+    sea_fight_keyboards.update_message(click.user_id, message.message_id, text, rows)
 
-            text = get_translation(language_code, 'text_leaderboard_added')
-            text = replace_placeholders(text, name, position, score)
-            new_kbd = keyboard_builder.create_main_keyboard(language_code)
 
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=message_id)
-            except Exception as e:
-                print(f"Error while deleting message with message_id {message_id}: {e}")
+async def show_placement(click, duel):
+    game_store.put(click.user_id, duel)
+    if duel.placing:
+        text, rows = get_placement_view(duel, click.language_code)
+    else:
+        text, rows = get_duel_view(duel, click.language_code, get_translation(click.language_code, 'text_duel_start'))
+    await edit_sea_fight_message(click.context, click.chat_id, click.message_id, text, rows)
 
-            await context.bot.send_message(chat_id=user_id, text=text, reply_markup=new_kbd)
 
-        elif data[1] == 'lastused':
-            context.user_data['operation'] = ""
-            with DatabaseConnectionManager() as conn:
-                user_manager = UserManager(conn)
-                current_user_info = user_manager.get_user_info(user_id)
-                name = current_user_info['leader_board_name']
-                leaderboard_manager = LeaderboardManager(conn)
-                position = leaderboard_manager.add_leaderboard_entry(user_id, name, score)
-
-            text = get_translation(language_code, 'text_leaderboard_added')
-            text = replace_placeholders(text, name, position, score)
-            new_kbd = keyboard_builder.create_main_keyboard(language_code)
-
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=message_id)
-            except Exception as e:
-                print(f"Error while deleting message with message_id {message_id}: {e}")
-
-            await context.bot.send_message(chat_id=user_id, text=text, reply_markup=new_kbd)
-
-        elif data[1] == 'new':
-            await context.bot.send_message(chat_id=user_id,
-                                           text=get_translation(language_code, 'text_send_your_name'))
-            context.user_data['operation'] = "waiting_for_name"
+async def on_place(click):
+    duel = click.game
+    if not isinstance(duel, DuelGame) or not duel.placing:
+        return
+    if duel.place(*click.args[:2]):
+        await show_placement(click, duel)
 
-    elif data[0] == 'leaderboard':
-        if data[1] == 'skip':
-            new_kbd = keyboard_builder.create_main_keyboard(language_code)
-            await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"{get_translation(language_code, 'text_you_won')}: {score}",
-                                                parse_mode='HTML', reply_markup=new_kbd)
-        if data[1] == 'show':
-            with DatabaseConnectionManager() as conn:
-                leaderboard_manager = LeaderboardManager(conn)
-                top = leaderboard_manager.get_top_leaderboard()
-            text = get_translation(language_code, 'text_leaderboard')
-            position = 1
-            for entry in top:
-                text += f"\n{position}. {entry['name']} [{entry['score']}]"
-                position += 1
-            new_kbd = keyboard_builder.create_main_keyboard(language_code)
-            try:
-                await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
-                                                parse_mode='HTML', reply_markup=new_kbd)
-            except:
-                await context.bot.send_message(chat_id=chat_id, text=text,
-                                                parse_mode='HTML', reply_markup=new_kbd)
-
-    elif data[0] == 'newgame':
-        context.user_data['score'] = 0
-
-        game_manager = GameLogic(ROWS, COLS, EMPTY, SHIP)
-        if game_manager.generate_board(SHIPS):
-            await send_game_start_message(update, context, user, game_manager)
-            context.user_data['board'] = game_manager.board.board
-            context.user_data['player_board'] = game_manager.player_board.board
-            game_manager.board.display()
-        else:
-            await send_error_message(update, context, user)
 
+async def on_place_auto(click):
+    duel = click.game
+    if not isinstance(duel, DuelGame) or not duel.placing:
+        return
+    if duel.auto_place():
+        await show_placement(click, duel)
+    else:
+        await outbox.send(click.context.bot, 'send_message', chat_id=click.chat_id,
+                          text=get_translation(click.language_code, 'error_text_cant_place'))
+
+
+async def on_place_reset(click):
+    duel = click.game
+    if not isinstance(duel, DuelGame) or not duel.placing:
+        return
+    duel.reset_fleet()
+    await show_placement(click, duel)
+
+
+async def on_duel_fire(click):
+    x, y, top, left = click.args
+    duel, language_code = click.game, click.language_code
+    if duel.placing or duel.is_over() or duel.state.is_shot(x, y):
+        return
+
+    result = duel.fire(x, y)
+    lines = [f"{cell_name(x, y)}: {get_translation(language_code, SHOT_TEXT_KEYS[result])}"]
+    if result == SHOT_MISS and not duel.state.is_won():
+        # The bot moves within the same update, a few milliseconds per shot
+        for bot_x, bot_y, bot_result in duel.bot_turn():
+            lines.append(format_translation(language_code, 'text_bot_shot', cell_name(bot_x, bot_y),
+                                            get_translation(language_code, SHOT_TEXT_KEYS[bot_result])))
+    if duel.state.is_won():
+        lines.append(get_translation(language_code, 'text_duel_win'))
+    elif duel.own.is_won():
+        lines.append(get_translation(language_code, 'text_duel_lose'))
+    if duel.is_over():
+        metrics.log('duel_over', user_id=click.user_id, won=duel.state.is_won())
+
+    cancel_animation(click.chat_id, click.message_id)
+    game_store.put(click.user_id, duel)
+    text, rows = get_duel_view(duel, language_code, '\n'.join(lines))
+    await edit_sea_fight_message(click.context, click.chat_id, click.message_id, text, rows)
+    if result == SHOT_SUNK and not duel.is_over():
+        start_blinking_sea_fight(duel.get_ship_cells(x, y), duel.player_board, click.context, click.chat_id,
+                                 click.message_id, text, top, left)
+
+
+async def create_pvp_games(mode_name):
+    mode = BOARD_MODES[mode_name]
+    games = []
+    for _ in range(2):
+        game = GameLogic(mode.rows, mode.cols, EMPTY, SHIP)
+        layout = await layout_pools[mode.name].get()
+        if not layout or not game.generate_board(mode.ships, layout=layout):
+            return None
+        games.append(game)
+    return games
+
+
+def get_pvp_view(match, index, status):
+    # Player index sees the other fleet as the keyboard to fire at and their own fleet as text
+    info, target = match.info[index], match.games[1 - index]
+    language_code = info['language_code']
+    lines = [status] if status else []
+    if match.over:
+        rows = sea_fight_keyboards.get_rows(target.player_board, action=ACTION_PVP_FIRE)
+    else:
+        lines.append(get_translation(language_code, 'text_pvp_your_turn' if match.turn == index else 'text_pvp_their_turn'))
+        rows = sea_fight_keyboards.get_rows(target.player_board, action=ACTION_PVP_FIRE) + (
+            keyboard_builder.create_pvp_row(language_code, 'btn_pvp_resign'),)
+    lines += ['', get_translation(language_code, 'text_your_fleet'), fleet_grid(match.games[index].state)]
+    return '\n'.join(lines), rows
+
+
+async def push_pvp_views(context, match, statuses):
+    # Both players' messages are edited at once; each chat has its own outbox queue
+    views = [get_pvp_view(match, index, statuses[index]) for index in range(2)]
+    await asyncio.gather(*(edit_sea_fight_message(context, match.players[index], match.info[index]['message_id'],
+                                                  *views[index]) for index in range(2)), return_exceptions=True)
+
+
+async def on_pvp_join(click):
+    if matchmaker.in_match(click.user_id):
+        await outbox.send(click.context.bot, 'send_message', chat_id=click.chat_id,
+                          text=get_translation(click.language_code, 'text_pvp_in_match'))
+        return
+    mode = get_board_mode(click.context)
+    if mode.rows > VIEWPORT_ROWS or mode.cols > VIEWPORT_COLS:
+        mode = BOARD_MODES[DEFAULT_BOARD_MODE]
+    # The lobby message becomes the match once an opponent is found
+    text = format_translation(click.language_code, 'text_pvp_waiting', mode.label)
+    rows = (keyboard_builder.create_pvp_row(click.language_code, 'btn_pvp_cancel'),)
+    message = await outbox.send(click.context.bot, 'send_message', chat_id=click.chat_id, text=text,
+                                reply_markup=InlineKeyboardMarkup(rows))
+    sea_fight_keyboards.update_message(click.chat_id, message.message_id, text, rows)
+    matchmaker.join(click.user_id, mode.name, {'name': click.user.first_name, 'language_code': click.language_code,
+                                               'message_id': message.message_id, 'context': click.context})
+    metrics.log('pvp_join', user_id=click.user_id, mode=mode.name)
+
+
+async def on_pvp_leave(click):
+    entry = matchmaker.leave(click.user_id)
+    if entry is not None:
+        info = entry[2]
+        await edit_sea_fight_message(click.context, click.chat_id, info['message_id'],
+                                     get_translation(click.language_code, 'text_pvp_left'), ())
+        return
+    match = matchmaker.get(click.user_id)
+    if match is None:
+        return
+    async with match.lock:
+        if match.over:
+            return
+        index = match.index(click.user_id)
+        matchmaker.finish(match)
+        metrics.log('pvp_over', match_id=match.match_id, winner=match.players[1 - index], resigned=True)
+        await push_pvp_views(click.context, match, [
+            get_translation(info['language_code'], 'text_pvp_resigned' if player == index else 'text_pvp_opponent_resigned')
+            for player, info in enumerate(match.info)])
+
+
+async def on_pvp_fire(click):
+    match = matchmaker.get(click.user_id)
+    if match is None:
+        return
+    x, y = click.args[:2]
+    index = match.index(click.user_id)
+    target = match.games[1 - index]
+    # Simultaneous clicks of both players are applied one at a time
+    async with match.lock:
+        if (match.over or match.turn != index or target.state.game_id != click.game_id
+                or target.state.is_shot(x, y)):
+            metrics.inc('pvp_rejected_clicks_total')
+            return
+        result = target.fire(x, y)
+        match.touch()
+        if result == SHOT_MISS:
+            match.turn = 1 - index
+        cell = cell_name(x, y)
+        statuses = [None, None]
+        for player in range(2):
+            language_code = match.info[player]['language_code']
+            shot = get_translation(language_code, SHOT_TEXT_KEYS[result])
+            statuses[player] = (f"{cell}: {shot}" if player == index else
+                                format_translation(language_code, 'text_pvp_opponent_shot', cell, shot))
+        if target.check_if_won():
+            matchmaker.finish(match)
+            metrics.log('pvp_over', match_id=match.match_id, winner=click.user_id)
+            for player in range(2):
+                statuses[player] += '\n' + get_translation(match.info[player]['language_code'],
+                                                           'text_pvp_win' if player == index else 'text_pvp_lose')
+        await push_pvp_views(click.context, match, statuses)
+
+
+async def on_pvp_match(match):
+    metrics.log('pvp_match', match_id=match.match_id, players=match.players, mode=match.mode)
+    await push_pvp_views(match.info[0]['context'], match, [
+        format_translation(info['language_code'], 'text_pvp_found', html.escape(match.info[1 - index]['name'] or ''))
+        for index, info in enumerate(match.info)])
+
+
+async def on_pvp_timeout(match):
+    await push_pvp_views(match.info[0]['context'], match,
+                         [get_translation(info['language_code'], 'text_pvp_timeout') for info in match.info])
+
+
+async def on_pvp_unmatched(user_id, info):
+    await edit_sea_fight_message(info['context'], user_id, info['message_id'],
+                                 get_translation(info['language_code'], 'text_pvp_nobody'), ())
+
+
+matchmaker = Matchmaker(
+    create_pvp_games, on_pvp_match, on_pvp_timeout, on_pvp_unmatched,
+    match_timeout=BOT_SETTINGS.get('pvp_match_timeout', 300),
+    lobby_timeout=BOT_SETTINGS.get('pvp_lobby_timeout', 120),
+    sweep_interval=BOT_SETTINGS.get('pvp_sweep_interval', 10)
+)
+
+
+# action -> (handler, whether it reads the user's game, whether the callback must belong to that game)
+button_handlers = {
+    ACTION_FIRE: (on_fire, True, True),
+    ACTION_VIEW: (on_view, True, True),
+    ACTION_NEW_GAME: (on_new_game, False, False),
+    ACTION_BOARDS: (on_boards, False, False),
+    ACTION_NAME_TG: (on_name_tg, True, True),
+    ACTION_NAME_LASTUSED: (on_name_lastused, True, True),
+    ACTION_NAME_NEW: (on_name_new, True, True),
+    ACTION_LEADERBOARD_SHOW: (on_leaderboard_show, False, False),
+    ACTION_LEADERBOARD_SKIP: (on_leaderboard_skip, True, True),
+    ACTION_DUEL: (on_duel, False, False),
+    ACTION_PLACE: (on_place, True, True),
+    ACTION_PLACE_AUTO: (on_place_auto, True, True),
+    ACTION_PLACE_RESET: (on_place_reset, True, True),
+    ACTION_PVP_JOIN: (on_pvp_join, False, False),
+    ACTION_PVP_FIRE: (on_pvp_fire, False, False),
+    ACTION_PVP_LEAVE: (on_pvp_leave, False, False),
+}
+
+@timed('handler_seconds')
 async def handle_text_message(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     language_code = update.effective_user.language_code
@@ -523,17 +1639,18 @@ async def handle_text_message(update: Update, context: CallbackContext) -> None:
     if operation == "waiting_for_name":
         name = text[:50]
         if not is_safe_leader_board_name(name):
-            await update.message.reply_text(get_translation(language_code, 'error_text_leaderboard_name'))
+            await outbox.send(context.bot, 'send_message', chat_id=user_id, text=get_translation(language_code, 'error_text_leaderboard_name'))
         else:
-            with DatabaseConnectionManager() as conn:
-                user_manager = UserManager(conn)
-                user_manager.update_leader_board_name(user_id, name)
-                text = get_translation(language_code, 'text_leaderboard_added')
-                score = context.user_data.get('score', 0)
-                leaderboard_manager = LeaderboardManager(conn)
-                position = leaderboard_manager.add_leaderboard_entry(user_id, name, score)
-            text = replace_placeholders(text, name, position, score)
-            await update.message.reply_text(text)
+            context.user_data['operation'] = ""
+            game = await game_store.get(user_id)
+            if not can_submit_score(context.user_data, game):
+                return
+            context.user_data['leaderboard_game'] = game.state.game_id
+            score = game.state.score
+            await user_profiles.set_leader_board_name(user_id, name)
+            position = leaderboard.add(user_id, name, score)
+            text = format_translation(language_code, 'text_leaderboard_added', name, position, score)
+            await outbox.send(context.bot, 'send_message', chat_id=user_id, text=text)
 
 
 def is_safe_leader_board_name(name):
@@ -542,113 +1659,106 @@ def is_safe_leader_board_name(name):
     pattern = r'^[a-zA-Zа-яА-Я0-9_ .-]+$'
     return re.match(pattern, name) is not None
 
-def create_name_keyboard(language_code, current_user_info):
-    keyboard = []
-    row = []
-    if not current_user_info['leader_board_name'] or current_user_info['leader_board_name'] == '':
-        name = current_user_info['first_name']
-        if name != '':
-            row.append(InlineKeyboardButton(f"{get_translation(language_code, 'text_use_name')} '{name}'", callback_data=f'name_tg'))
-    else:
-        name = current_user_info['leader_board_name']
-        row.append(InlineKeyboardButton(f"{get_translation(language_code, 'text_use_name')} '{name}'", callback_data=f'name_lastused'))
-
-    row.append(InlineKeyboardButton(get_translation(language_code, 'text_use_other_name'), callback_data=f'name_new'))
-
-    keyboard.append(row)
-
-    keyboard.append([InlineKeyboardButton(get_translation(language_code, 'text_leaderboard_skip'), callback_data=f'leaderboard_skip')])
-    return InlineKeyboardMarkup(keyboard)
-
-def create_main_keyboard(language_code):
-    keyboard = [
-        [InlineKeyboardButton(get_translation(language_code, 'btn_new_game'), callback_data=f'newgame')],
-        [InlineKeyboardButton(get_translation(language_code, 'btn_leaderboard'), callback_data=f'leaderboard_show')]
-    ]
-
-    return InlineKeyboardMarkup(keyboard)
 
-def create_sea_fight_keyboard(player_board):
-    keyboard = []
-    y = 0
-    for line in player_board:
-        row = []
-        x = 0
-        for sym in line:
-            row.append(InlineKeyboardButton(sym, callback_data=f'fire_{x}_{y}'))
-            x += 1
-        keyboard.append(row)
-        y += 1
-    return InlineKeyboardMarkup(keyboard)
-
-async def blinking_sea_fight(x, y, board, player_board, context, chat_id, message_id, text):
-
-    ship = []
-    button_factory = ButtonFactory()
-    keyboard_builder = KeyboardBuilder(button_factory)
-
-    for i in range(ROWS):
-        if 0 <= x + i < ROWS:
-            if board[x + i][y] == BANG:
-                ship.append([x + i, y])
-            else:
-                break
-    for i in range(ROWS):
-        if 0 <= x - i < ROWS:
-            if board[x - i][y] == BANG:
-                ship.append([x - i, y])
-            else:
-                break
-    for i in range(ROWS):
-        if 0 <= y + i < ROWS:
-            if board[x][y + i] == BANG:
-                ship.append([x, y + i])
-            else:
-                break
-    for i in range(ROWS):
-        if 0 <= y - i < ROWS:
-            if board[x][y - i] == BANG:
-                ship.append([x, y - i])
-            else:
-                break
-
-    for i in range(3):
-        for e in ship:
-            x, y = e
-            player_board.update_cell(x, y, BIGBANG)
-
-        new_kbd = keyboard_builder.create_sea_fight_keyboard(player_board)
+animation_tasks = {}
 
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='HTML', reply_markup=new_kbd)
 
-        for e in ship:
-            x, y = e
-            player_board.update_cell(x, y, BANG)
-        time.sleep(DELAY)
+def cancel_animation(chat_id, message_id):
+    task = animation_tasks.pop((chat_id, message_id), None)
+    if task:
+        task.cancel()
 
-        new_kbd = keyboard_builder.create_sea_fight_keyboard(player_board)
 
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='HTML', reply_markup=new_kbd)
+def start_blinking_sea_fight(ship, player_board, context, chat_id, message_id, text, top=0, left=0):
+    cancel_animation(chat_id, message_id)
 
-        time.sleep(DELAY)
-
-    for e in ship:
-        x, y = e
+    # The board belongs to the game, so the hit frame is rendered from it and the cells are put back
+    sunk_rows = sea_fight_keyboards.get_rows(player_board, top, left)
+    for x, y in ship:
+        player_board.update_cell(x, y, BANG)
+    hit_rows = sea_fight_keyboards.get_rows(player_board, top, left)
+    for x, y in ship:
         player_board.update_cell(x, y, BIGBANG)
 
-
-def main():
-    application = Application.builder().token(API_TOKEN).build()
+    key = (chat_id, message_id)
+    task = context.application.create_task(
+        blinking_sea_fight([hit_rows, sunk_rows] * 3, context, chat_id, message_id, text))
+    animation_tasks[key] = task
+
+    def forget(done_task):
+        if animation_tasks.get(key) is done_task:
+            del animation_tasks[key]
+
+    task.add_done_callback(forget)
+
+
+async def blinking_sea_fight(frames, context, chat_id, message_id, text):
+    for rows in frames:
+        await asyncio.sleep(DELAY)
+        await edit_sea_fight_message(context, chat_id, message_id, text, rows, PRIORITY_ANIMATION)
+
+
+async def post_init(application):
+    layout_pools[DEFAULT_BOARD_MODE].schedule_refill()
+    game_store.start()
+    writes.start()
+    game_log.start()
+    await db_pool.run(prepare_leaderboard, {period: period_start(period, date.today()) for period in PERIODS})
+    await leaderboard.load()
+    leaderboard.start()
+    matchmaker.start()
+    metrics.gauge('active_games', lambda: len(game_store.games))
+    metrics.gauge('pvp_matches', lambda: len(matchmaker.matches) // 2)
+    metrics.gauge('pvp_waiting', lambda: len(matchmaker.waiting))
+    metrics.gauge('animations_running', lambda: len(animation_tasks))
+    metrics.gauge('outbox_queued', outbox.queued)
+    metrics.gauge('writes_pending', lambda: len(writes.pending))
+    await metrics.start_server()
+
+
+async def post_shutdown(application):
+    await game_store.close()
+    await leaderboard.close()
+    await matchmaker.close()
+    await game_log.close()
+    await writes.close()
+    await metrics.close()
+
+
+def build_application():
+    builder = Application.builder().token(API_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    if BOT_SETTINGS.get('api_base_url'):
+        builder = builder.base_url(BOT_SETTINGS['api_base_url'])
+    if metrics.enabled:
+        builder = builder.request(InstrumentedRequest(connection_pool_size=256))
+    if BOT_SETTINGS.get('concurrent_updates'):
+        builder = builder.concurrent_updates(UserOrderedUpdateProcessor(BOT_SETTINGS['concurrent_updates']))
+    if BOT_SETTINGS.get('webhook'):
+        builder = builder.updater(None)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(handle_button))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-    print("Start game bot: done.")
+    return application
 
-    application.run_polling()
+
+def main():
+    check_board_modes()
+    webhook = BOT_SETTINGS.get('webhook')
+    workers = BOT_SETTINGS.get('workers', 1)
+    try:
+        if webhook and workers > 1:
+            bot = Bot(API_TOKEN, base_url=BOT_SETTINGS.get('api_base_url', 'https://api.telegram.org/bot'))
+            asyncio.run(run_workers(build_application, bot, webhook, workers))
+        elif webhook:
+            asyncio.run(run_webhook(build_application(), webhook))
+        else:
+            application = build_application()
+            print("Start game bot: done.")
+            application.run_polling()
+    finally:
+        db_pool.close()
 
 if __name__ == '__main__':
     main()
-
-
-